@@ -0,0 +1,5 @@
+"""
+Benchmarks for coyote. Run from the repository root, e.g.
+
+    python -m benchmarks.decode_variants
+"""
@@ -0,0 +1,104 @@
+"""
+Cold start benchmark: import time, init_app time and first request latency.
+
+Every measurement runs in a fresh interpreter. Modes:
+
+    baseline     no template precompiling, no bytecode cache
+    bytecode     bytecode cache directory primed by an earlier process
+    precompile   all templates compiled in init_app
+    preload      precompiled app forked as gunicorn --preload does, request served in the child
+
+The request is GET /login, plus the first get_template() of the variant
+list template, the largest one. No database is needed.
+
+    python -m benchmarks.cold_start [repeats]
+"""
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import BENCH_DIR, write_results
+
+MODES = ("baseline", "bytecode", "precompile", "preload")
+
+
+def child(mode: str, cache_dir: str) -> dict:
+    start = time.perf_counter()
+    import config
+    from benchmarks.common import bench_app
+
+    # Timed with the imports above, bench_app would import it anyway
+    importlib.import_module("coyote")
+
+    imported = time.perf_counter()
+    config.TestConfig.PRECOMPILE_TEMPLATES = mode in ("precompile", "preload")
+    config.TestConfig.JINJA_BYTECODE_CACHE_DIR = cache_dir if mode == "bytecode" else None
+    app = bench_app()
+    initialized = time.perf_counter()
+
+    def first_requests() -> dict:
+        client = app.test_client()
+        t0 = time.perf_counter()
+        client.get("/login")
+        t1 = time.perf_counter()
+        client.get("/login")
+        t2 = time.perf_counter()
+        app.jinja_env.get_template("list_variants_vep.html")
+        t3 = time.perf_counter()
+        return {"first_request": t1 - t0, "second_request": t2 - t1, "variants_template": t3 - t2}
+
+    if mode == "preload":
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write_fd, json.dumps(first_requests()).encode())
+            os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd) as fh:
+            requests = json.load(fh)
+    else:
+        requests = first_requests()
+
+    return {
+        "import": imported - start,
+        "init_app": initialized - imported,
+        **requests,
+    }
+
+
+def run_child(mode: str, cache_dir: str) -> dict:
+    out = subprocess.run(
+        [sys.executable, "-m", "benchmarks.cold_start", "--child", mode, cache_dir],
+        cwd=BENCH_DIR.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(repeats: int = 5) -> None:
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Prime the bytecode cache
+        run_child("bytecode", cache_dir)
+        for mode in MODES:
+            runs = [run_child(mode, cache_dir) for _ in range(repeats)]
+            results[mode] = {key: min(run[key] for run in runs) for key in runs[0]}
+
+    print(f"{'mode':<12}" + "".join(f"{key:>20}" for key in results["baseline"]))
+    for mode, timings in results.items():
+        print(f"{mode:<12}" + "".join(f"{value * 1000:>18.1f}ms" for value in timings.values()))
+    print(f"results: {write_results('cold_start', results)}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        print(json.dumps(child(sys.argv[2], sys.argv[3])))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,58 @@
+"""
+Shared helpers for the benchmarks
+"""
+import json
+import os
+import platform
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+RESULTS_DIR = BENCH_DIR / "results"
+# Scratch database of the benchmarks that need a mongod, dropped afterwards
+BENCH_DB = os.getenv("BENCH_MONGO_DB", "coyote_bench")
+
+os.environ.setdefault("FLASK_GROUPS_CONFIG", str(BENCH_DIR / "config" / "groups.toml"))
+
+
+def bench_app():
+    """
+    Flask app in testing mode using the benchmark group config. Importing
+    the variants blueprint needs an app, so create this before importing
+    anything from coyote.blueprints.
+    """
+    from coyote import init_app
+
+    app = init_app(testing=True)
+    app.config["WTF_CSRF_ENABLED"] = False
+    return app
+
+
+def timed(func, *args, repeat: int = 5, **kwargs) -> dict:
+    """
+    Run func repeat times, return best/mean wall time in seconds and the last result
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "mean": sum(times) / len(times), "result": result}
+
+
+def write_results(name: str, results: dict) -> Path:
+    """
+    Store results as json in benchmarks/results/<name>-<timestamp>.json
+    """
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = RESULTS_DIR / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    payload = {
+        "name": name,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    with path.open("w") as fh:
+        json.dump(payload, fh, indent=2, default=str)
+    return path
@@ -0,0 +1,144 @@
+"""
+Concurrency check for the threaded and gevent workers.
+
+Seeds one synthetic sample per group of benchmarks/config/groups.toml into
+a scratch database, renders each variant page once serially, then
+requests the pages from many threads at once, in random order, and checks
+that every response is identical to the serial one. Shared state modified
+by a request (group defaults, form classes, cached documents) shows up as
+pages of one group carrying the filters of another.
+
+Needs a mongod as configured in TestConfig, the scratch database
+(BENCH_MONGO_DB, default coyote_bench) is dropped afterwards.
+
+    python -m benchmarks.concurrency [threads] [requests]
+"""
+import copy
+import random
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId
+
+from benchmarks.common import BENCH_DB, bench_app, write_results
+from benchmarks.synthetic import make_variants
+
+N_VARIANTS = 300
+SUBPANEL = "lung"
+CSRF_RE = re.compile(r'(name="csrf_token" type="hidden" value=")[^"]*"')
+
+
+def seed(db, groups: list) -> list:
+    """
+    One sample per group with its own variants, and the gene lists of their assays
+    """
+    names = []
+    for seed_no, group in enumerate(groups, start=1):
+        sample_id = ObjectId()
+        name = f"bench_{group}"
+        db.samples.insert_one(
+            {
+                "_id": sample_id,
+                "name": name,
+                "groups": [group],
+                "subpanel": SUBPANEL,
+                "GT": [
+                    {"type": "case", "sample": "case"},
+                    {"type": "control", "sample": "control"},
+                ],
+            }
+        )
+        db.variants_idref.insert_many(
+            make_variants(N_VARIANTS, sample_id=str(sample_id), seed=seed_no)
+        )
+        names.append(name)
+    db.panels.insert_many(
+        [
+            {
+                "name": SUBPANEL,
+                "type": "genelist",
+                "assays": ["solid"],
+                "genes": ["EGFR", "KRAS", "ALK"],
+            },
+            {
+                "name": "core",
+                "type": "genelist",
+                "assays": ["myeloid", "tumwgs"],
+                "genes": ["FLT3", "NPM1", "TP53"],
+            },
+        ]
+    )
+    return names
+
+
+def main(n_threads: int = 16, n_requests: int = 400) -> None:
+    app = bench_app()
+    from coyote.extensions import single_flight, store
+
+    store.db_name = BENCH_DB
+    store.setup()
+    db = store.coyote_db
+    db.client.drop_database(BENCH_DB)
+    names = seed(db, list(app.config["GROUP_CONFIGS"]))
+    group_filters = copy.deepcopy(app.config["GROUP_FILTERS"])
+
+    def fetch(name: str) -> tuple:
+        with app.test_client() as client:
+            start = time.perf_counter()
+            resp = client.get(f"/sample/{name}")
+            elapsed = time.perf_counter() - start
+        return resp.status_code, CSRF_RE.sub(r'\1"', resp.get_data(as_text=True)), elapsed
+
+    try:
+        expected = {}
+        serial = []
+        for name in names:
+            status, body, elapsed = fetch(name)
+            if status != 200:
+                sys.exit(f"{name}: serial request failed with {status}")
+            expected[name] = body
+            serial.append(elapsed)
+
+        plan = [random.choice(names) for _ in range(n_requests)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            responses = list(pool.map(fetch, plan))
+        wall = time.perf_counter() - start
+    finally:
+        db.client.drop_database(BENCH_DB)
+
+    mismatches = {}
+    for name, (status, body, _) in zip(plan, responses):
+        if status != 200 or body != expected[name]:
+            mismatches[name] = mismatches.get(name, 0) + 1
+    latencies = sorted(elapsed for _, _, elapsed in responses)
+    results = {
+        "threads": n_threads,
+        "requests": n_requests,
+        "samples": len(names),
+        "serial_mean_s": sum(serial) / len(serial),
+        "concurrent_wall_s": wall,
+        "requests_per_s": n_requests / wall,
+        "p50_s": latencies[len(latencies) // 2],
+        "p95_s": latencies[int(len(latencies) * 0.95)],
+        "mismatches": mismatches,
+        "group_filters_changed": app.config["GROUP_FILTERS"] != group_filters,
+        "single_flight": single_flight.metrics_lines()[2:],
+    }
+    print(
+        f"{n_requests} requests from {n_threads} threads in {wall:.2f}s, {results['requests_per_s']:.1f} req/s, "
+        f"p50 {results['p50_s'] * 1000:.0f} ms p95 {results['p95_s'] * 1000:.0f} ms "
+        f"(serial {results['serial_mean_s'] * 1000:.0f} ms/page)"
+    )
+    print(f"results written to {write_results('concurrency', results)}")
+    if mismatches or results["group_filters_changed"]:
+        sys.exit(
+            f"responses differ from the serial ones: {mismatches}, GROUP_FILTERS changed: {results['group_filters_changed']}"
+        )
+    print("all responses match the serial ones")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,103 @@
+"""
+Decode-time benchmark for the VARIANTS_LAZY_DECODE variant path.
+
+Encodes a synthetic sample to BSON, as it arrives from the driver, and
+compares decoding every full document before popfreq filtering with the
+two phase path: decode documents projected to VARIANT_FILTER_FIELDS,
+filter, then decode full documents for the survivors only. The server
+side projection is simulated, so this measures client decode and filter
+time, not the extra round trip for the survivors.
+
+    python -m benchmarks.decode_variants [n_variants]
+"""
+import sys
+
+import bson
+
+from benchmarks.common import bench_app, timed, write_results
+from benchmarks.synthetic import make_variants
+
+MAX_POPFREQ = 0.01
+
+
+def project(doc: dict, fields: list) -> dict:
+    """
+    Mimic a mongo projection of dotted fields, arrays of subdocuments included
+    """
+    out = {"_id": doc["_id"]}
+    for field in fields:
+        _project_path(doc, out, field.split("."))
+    return out
+
+
+def _project_path(src, dst, path):
+    key, rest = path[0], path[1:]
+    if key not in src:
+        return
+    if not rest:
+        dst[key] = src[key]
+    elif isinstance(src[key], list):
+        items = dst.setdefault(key, [{} for _ in src[key]])
+        for src_item, dst_item in zip(src[key], items):
+            _project_path(src_item, dst_item, rest)
+    else:
+        _project_path(src[key], dst.setdefault(key, {}), rest)
+
+
+def main(n_variants: int = 20_000) -> None:
+    app = bench_app()
+    from coyote.blueprints.variants import util
+
+    docs = make_variants(n_variants)
+    full_payload = {doc["_id"]: bson.encode(doc) for doc in docs}
+    all_full = b"".join(full_payload.values())
+    projected = b"".join(bson.encode(project(doc, util.VARIANT_FILTER_FIELDS)) for doc in docs)
+
+    def eager():
+        variants, genes = util.get_protein_coding_genes(bson.decode_all(all_full))
+        for var in variants:
+            var["INFO"]["selected_CSQ"], var["INFO"]["selected_CSQ_criteria"] = util.select_csq(
+                var["INFO"]["CSQ"], {}
+            )
+        return util.popfreq_filter(variants, MAX_POPFREQ)
+
+    def lazy():
+        variants, genes = util.get_protein_coding_genes(bson.decode_all(projected))
+        survivors = []
+        for var in variants:
+            var["INFO"]["selected_CSQ"], var["INFO"]["selected_CSQ_criteria"] = util.select_csq(
+                var["INFO"]["CSQ"], {}
+            )
+            if util.popfreq_pass(var["INFO"]["selected_CSQ"], var["ALT"], MAX_POPFREQ):
+                survivors.append(var)
+        # What get_variants_by_ids receives from the server for the survivors
+        survivor_payload = b"".join(full_payload[var["_id"]] for var in survivors)
+        full_variants = {var["_id"]: var for var in bson.decode_all(survivor_payload)}
+        return util.inflate_variants(survivors, full_variants)
+
+    with app.app_context():
+        results = {
+            "n_variants": n_variants,
+            "full_bytes": len(all_full),
+            "projected_bytes": len(projected),
+        }
+        for name, func in (("eager", eager), ("lazy", lazy)):
+            run = timed(func)
+            results[name] = {
+                "best_s": run["best"],
+                "mean_s": run["mean"],
+                "survivors": len(run["result"]),
+            }
+            print(
+                f"{name:6s} best {run['best']:.3f}s mean {run['mean']:.3f}s survivors {len(run['result'])}"
+            )
+
+    assert results["eager"]["survivors"] == results["lazy"]["survivors"]
+    results["speedup"] = results["eager"]["best_s"] / results["lazy"]["best_s"]
+    print(f"bytes full {results['full_bytes']} projected {results['projected_bytes']}")
+    print(f"speedup {results['speedup']:.2f}x")
+    print(f"results written to {write_results('decode_variants', results)}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,146 @@
+"""
+End-to-end benchmark of the variant page.
+
+For each query shape of varqueries.build_query (myeloid, solid, gmsonco,
+tumwgs) and each size, loads one synthetic case (benchmarks.synthetic.make_case)
+into a fresh database and requests /sample/<name> through the Flask test
+client. Every request starts with an empty cache. The Server-Timing header
+gives the time of each pipeline stage (snv_<stage>), of mongo (db), of
+assembling and rendering the page. Medians over the repeats are written
+to benchmarks/results/e2e-<timestamp>.json for comparing runs.
+
+Backends:
+
+    mongod  the mongod of TestConfig, in the scratch database BENCH_MONGO_DB
+            (default coyote_bench), dropped before each case and afterwards
+    memory  mongomock (pip install mongomock), no server needed. Queries run
+            in Python and every document is held in memory, use mongod for 100k
+
+    python -m benchmarks.e2e [--backend mongod|memory] [--sizes 1000,10000,100000]
+                             [--assays myeloid,solid,gmsonco,tumwgs] [--repeat 3]
+"""
+import argparse
+import itertools
+import statistics
+import sys
+import time
+
+from benchmarks.common import BENCH_DB, bench_app, write_results
+from benchmarks.synthetic import CASE_GROUPS, make_case
+
+DEFAULT_SIZES = {"mongod": "1000,10000,100000", "memory": "1000,10000"}
+LOAD_BATCH = 5000
+
+
+def load_case(db, case) -> dict:
+    """
+    Insert the (collection, documents) pairs of a case in batches, documents per collection
+    """
+    counts = {}
+    for collection, docs in case:
+        docs = iter(docs)
+        counts[collection] = 0
+        while True:
+            batch = list(itertools.islice(docs, LOAD_BATCH))
+            if not batch:
+                break
+            db[collection].insert_many(batch)
+            counts[collection] += len(batch)
+    return counts
+
+
+def parse_server_timing(header: str) -> dict:
+    """
+    name -> milliseconds from a Server-Timing header
+    """
+    timings = {}
+    for part in header.split(","):
+        name, *params = part.strip().split(";")
+        for param in params:
+            if param.startswith("dur="):
+                timings[name] = float(param[4:])
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--backend", choices=["mongod", "memory"], default="mongod")
+    parser.add_argument("--sizes", help="variants per case, comma separated")
+    parser.add_argument("--assays", default=",".join(CASE_GROUPS))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    sizes = [int(size) for size in (args.sizes or DEFAULT_SIZES[args.backend]).split(",")]
+    assays = args.assays.split(",")
+
+    if args.backend == "memory":
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("the memory backend needs mongomock: pip install mongomock")
+
+    app = bench_app()
+    from coyote.extensions import cache, store
+
+    def fresh_db():
+        if args.backend == "memory":
+            store._setup_dbs(mongomock.MongoClient())
+        else:
+            store.db_name = BENCH_DB
+            store.setup()
+            store.coyote_db.client.drop_database(BENCH_DB)
+        return store.coyote_db
+
+    results = {"backend": args.backend, "repeat": args.repeat, "cases": {}}
+    try:
+        for assay, size in itertools.product(assays, sizes):
+            name = f"e2e_{assay}_{size}"
+            db = fresh_db()
+            start = time.perf_counter()
+            counts = load_case(db, make_case(assay, size, name=name))
+            load_s = time.perf_counter() - start
+
+            walls, spans, status, body_bytes = [], {}, None, 0
+            with app.test_client() as client:
+                for _ in range(args.repeat):
+                    cache.clear()
+                    start = time.perf_counter()
+                    resp = client.get(f"/sample/{name}")
+                    walls.append(time.perf_counter() - start)
+                    status, body_bytes = resp.status_code, len(resp.get_data())
+                    for span, ms in parse_server_timing(
+                        resp.headers.get("Server-Timing", "")
+                    ).items():
+                        spans.setdefault(span, []).append(ms)
+
+            case = {
+                "assay": assay,
+                "group": CASE_GROUPS[assay],
+                "documents": counts,
+                "load_s": load_s,
+                "status": status,
+                "response_bytes": body_bytes,
+                "wall_s": {"median": statistics.median(walls), "min": min(walls)},
+                "spans_ms": {span: statistics.median(values) for span, values in spans.items()},
+            }
+            results["cases"][f"{assay}/{size}"] = case
+            stages = " ".join(
+                f"{span} {ms:.0f}"
+                for span, ms in case["spans_ms"].items()
+                if span.startswith("snv_")
+            )
+            print(
+                f"{assay:8s} {size:>7d} variants: {status} in {case['wall_s']['median'] * 1000:.0f} ms "
+                f"(db {case['spans_ms'].get('db', 0):.0f}, render {case['spans_ms'].get('render', 0):.0f}; {stages})"
+            )
+    finally:
+        if args.backend == "mongod":
+            store.coyote_db.client.drop_database(BENCH_DB)
+
+    print(f"results written to {write_results('e2e', results)}")
+    failed = [key for key, case in results["cases"].items() if case["status"] != 200]
+    if failed:
+        sys.exit(f"requests failed for {failed}")
+
+
+if __name__ == "__main__":
+    main()
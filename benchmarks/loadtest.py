@@ -0,0 +1,404 @@
+"""
+Load test of a running app with worklist traffic from many clinicians.
+
+Each virtual user logs in through /login and then, without pausing or
+after an exponential think time, requests a weighted random mix of:
+
+    main      the main screen, GET /
+    variants  a variant page, GET /sample/<case>
+    filter    new filter settings for a variant page, POST /sample/<case>
+    rna       the RNA worklist, GET /rna/fusion
+    plot      a coverage plot, GET /plot/<file>/<assay>/38. These are 404s
+              unless the plot directories under /access exist, and a 404
+              does not count as an error
+
+Each user runs on its own thread with its own keep-alive connection. The
+number of users goes up level by level (--concurrency). Every level runs
+--warmup seconds unmeasured and then --duration measured seconds. For
+each route it reports throughput, latency percentiles, status codes and
+error rate. Errors are failed connections and unexpected statuses. The
+ramp stops after a level whose error rate is over --stop-error-rate.
+Results go to benchmarks/results/loadtest-<timestamp>.json.
+
+Without --url a gunicorn serving benchmarks.loadtest_app is started on a
+free local port, seeded as set by --backend, --variants and --cases, and
+stopped afterwards. Its worker model and cache mode come from --workers,
+--worker-class, --threads and --cache, so runs can be compared by those.
+With --url the app there must be a loadtest_app seeded with the same
+--cases. The generator shares one GIL between its threads. It reports
+its own CPU use, and near 100% it is the bottleneck, not the server.
+
+    python -m benchmarks.loadtest [--url http://host:port] [--concurrency 1,4,16,32]
+                                  [--duration 30] [--warmup 5] [--think 0]
+                                  [--mix main=15,variants=45,filter=15,rna=10,plot=15]
+                                  [--backend mongod|memory] [--variants 2000] [--cases 2]
+                                  [--workers 2] [--worker-class gthread|gevent|sync]
+                                  [--threads 8] [--cache off|memory|shared]
+"""
+import argparse
+import http.client
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from benchmarks.common import BENCH_DIR, write_results
+from benchmarks.loadtest_app import PASSWORD, RNA_GROUP, case_name, user_mail
+from benchmarks.synthetic import CASE_GROUPS
+
+DEFAULT_MIX = "main=15,variants=45,filter=15,rna=10,plot=15"
+FILTER_BOXES = [
+    "missense",
+    "frameshift",
+    "stop_gained",
+    "stop_lost",
+    "start_lost",
+    "inframe_indel",
+    "splicing",
+    "other_coding",
+]
+PERCENTILES = (50, 90, 95, 99)
+
+
+class Session:
+    """
+    One logged in user: a keep-alive connection and the cookies the app set
+    """
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        self.cookies = {}
+
+    def request(self, method: str, path: str, form: dict = None) -> int:
+        headers = {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+            resp.read()
+        except (OSError, http.client.HTTPException):
+            # Reconnects on the next request
+            self.conn.close()
+            raise
+        for cookie in resp.headers.get_all("Set-Cookie") or []:
+            name, _, value = cookie.split(";", 1)[0].partition("=")
+            self.cookies[name.strip()] = value
+        return resp.status
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def make_actions(n_cases: int) -> dict:
+    """
+    route -> function(rnd) returning method, path, form and the expected statuses
+    """
+    cases = [
+        (assay, case_name(assay, number)) for assay in CASE_GROUPS for number in range(n_cases)
+    ]
+
+    def main_screen(rnd):
+        return "GET", "/", None, {200}
+
+    def variant_page(rnd):
+        return "GET", f"/sample/{rnd.choice(cases)[1]}", None, {200}
+
+    def filter_post(rnd):
+        form = {
+            "min_reads": rnd.choice([5, 10, 20]),
+            "min_depth": rnd.choice([50, 100, 200]),
+            "min_freq": rnd.choice([0.01, 0.02, 0.05]),
+            "max_freq": 1,
+            "max_popfreq": rnd.choice([0.01, 0.02, 0.05]),
+            "min_cnv_size": 100,
+            "max_cnv_size": 100000000,
+        }
+        form.update((box, "y") for box in FILTER_BOXES if rnd.random() < 0.8)
+        return "POST", f"/sample/{rnd.choice(cases)[1]}", form, {200}
+
+    def rna_page(rnd):
+        return "GET", f"/rna/{RNA_GROUP}", None, {200}
+
+    def plot(rnd):
+        assay, name = rnd.choice(cases)
+        return "GET", f"/plot/{name}.cov.png/{assay}/38", None, {200, 404}
+
+    return {
+        "main": main_screen,
+        "variants": variant_page,
+        "filter": filter_post,
+        "rna": rna_page,
+        "plot": plot,
+    }
+
+
+def parse_mix(mix: str, actions: dict) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        route, _, weight = part.partition("=")
+        if route not in actions:
+            sys.exit(f"unknown route {route} in --mix, choose from {', '.join(actions)}")
+        weights[route] = float(weight)
+    return weights
+
+
+def percentile(values: list, pct: float) -> float:
+    """
+    Nearest rank percentile of sorted values
+    """
+    return values[max(0, -(-len(values) * pct // 100) - 1)]
+
+
+def summarize(records: list, duration: float) -> dict:
+    """
+    Throughput, error rate, statuses and latency percentiles (ms) per route and over all routes
+    """
+    routes = {}
+    for route, elapsed, status, ok in records:
+        routes.setdefault(route, []).append((elapsed, status, ok))
+        routes.setdefault("all", []).append((elapsed, status, ok))
+    summary = {}
+    for route, rows in routes.items():
+        latencies = sorted(elapsed * 1000 for elapsed, _, _ in rows)
+        statuses = {}
+        for _, status, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        errors = sum(1 for _, _, ok in rows if not ok)
+        summary[route] = {
+            "requests": len(rows),
+            "requests_per_s": len(rows) / duration,
+            "errors": errors,
+            "error_rate": errors / len(rows),
+            "statuses": statuses,
+            "latency_ms": dict(
+                {f"p{pct}": percentile(latencies, pct) for pct in PERCENTILES}, max=latencies[-1]
+            ),
+        }
+    return summary
+
+
+def run_level(host: str, port: int, args, concurrency: int, actions: dict, weights: dict) -> dict:
+    routes, route_weights = list(weights), list(weights.values())
+    measure_from = time.monotonic() + args.warmup
+    end = measure_from + args.duration
+    records = [[] for _ in range(concurrency)]
+    login_failures = []
+
+    def user(number: int) -> None:
+        rnd = random.Random(number)
+        session = Session(host, port, args.timeout)
+        try:
+            status = session.request(
+                "POST", "/login", {"username": user_mail(number), "password": PASSWORD}
+            )
+        except (OSError, http.client.HTTPException) as ex:
+            status = repr(ex)
+        if status != 302:
+            login_failures.append(status)
+            session.close()
+            return
+        while True:
+            if args.think:
+                time.sleep(rnd.expovariate(1 / args.think))
+            start = time.monotonic()
+            if start >= end:
+                break
+            route = rnd.choices(routes, route_weights)[0]
+            method, path, form, expected = actions[route](rnd)
+            try:
+                status = session.request(method, path, form)
+                ok = status in expected
+            except (OSError, http.client.HTTPException) as ex:
+                status, ok = type(ex).__name__, False
+            finished = time.monotonic()
+            if start >= measure_from and finished <= end:
+                records[number].append((route, finished - start, status, ok))
+        session.close()
+
+    cpu_start = time.process_time()
+    threads = [
+        threading.Thread(target=user, args=(number,), daemon=True) for number in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client_cpu = (time.process_time() - cpu_start) / (args.warmup + args.duration)
+
+    level = {
+        "concurrency": concurrency,
+        "login_failures": len(login_failures),
+        "client_cpu": client_cpu,
+        "routes": summarize(
+            [record for user_records in records for record in user_records], args.duration
+        ),
+    }
+    if login_failures:
+        level["login_statuses"] = sorted({str(status) for status in login_failures})
+    return level
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, n_users: int):
+    """
+    gunicorn serving benchmarks.loadtest_app on a free port, once /healthz answers
+    """
+    port = free_port()
+    env = dict(
+        os.environ,
+        GUNICORN_BIND=f"127.0.0.1:{port}",
+        GUNICORN_WORKERS=str(args.workers),
+        GUNICORN_WORKER_CLASS=args.worker_class,
+        GUNICORN_THREADS=str(args.threads),
+        # Seeded once in the master
+        GUNICORN_PRELOAD="1",
+        LOADTEST_BACKEND=args.backend,
+        LOADTEST_CACHE=args.cache,
+        LOADTEST_VARIANTS=str(args.variants),
+        LOADTEST_CASES=str(args.cases),
+        LOADTEST_USERS=str(n_users),
+    )
+    log = tempfile.NamedTemporaryFile("w", prefix="coyote-loadtest-", suffix=".log", delete=False)
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-c",
+            "gunicorn.conf.py",
+            "benchmarks.loadtest_app:create_app()",
+        ],
+        cwd=BENCH_DIR.parent,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    print(f"starting gunicorn on port {port}, log in {log.name}")
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"gunicorn exited with {server.returncode}, see {log.name}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/healthz")
+            if conn.getresponse().status == 200:
+                return server, port
+        except OSError:
+            pass
+        time.sleep(1)
+    server.terminate()
+    sys.exit(f"gunicorn did not answer within {args.startup_timeout}s, see {log.name}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", help="app to drive, default start one")
+    parser.add_argument(
+        "--concurrency", default="1,4,16,32", help="users per level, comma separated"
+    )
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds per level")
+    parser.add_argument(
+        "--warmup", type=float, default=5, help="unmeasured seconds before each level"
+    )
+    parser.add_argument(
+        "--think", type=float, default=0, help="mean seconds between a user's requests"
+    )
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="route=weight, comma separated")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds before a request fails")
+    parser.add_argument("--stop-error-rate", type=float, default=0.1)
+    parser.add_argument(
+        "--cases", type=int, default=2, help="cases per assay the app was seeded with"
+    )
+    server_opts = parser.add_argument_group("started server, without --url")
+    server_opts.add_argument("--backend", choices=["mongod", "memory"], default="mongod")
+    server_opts.add_argument("--variants", type=int, default=2000, help="variants per case")
+    server_opts.add_argument("--workers", type=int, default=2)
+    server_opts.add_argument("--worker-class", default="gthread")
+    server_opts.add_argument("--threads", type=int, default=8)
+    server_opts.add_argument("--cache", choices=["off", "memory", "shared"], default="memory")
+    server_opts.add_argument("--startup-timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    actions = make_actions(args.cases)
+    weights = parse_mix(args.mix, actions)
+
+    server = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+        settings = {"url": args.url}
+    else:
+        server, port = start_server(args, n_users=max(levels))
+        host = "127.0.0.1"
+        settings = {
+            key: getattr(args, key)
+            for key in (
+                "backend",
+                "variants",
+                "cases",
+                "workers",
+                "worker_class",
+                "threads",
+                "cache",
+            )
+        }
+
+    results = {
+        "server": settings,
+        "mix": weights,
+        "duration": args.duration,
+        "think": args.think,
+        "levels": [],
+    }
+    try:
+        for concurrency in levels:
+            level = run_level(host, port, args, concurrency, actions, weights)
+            results["levels"].append(level)
+            overall = level["routes"].get("all")
+            if overall is None:
+                print(
+                    f"{concurrency:4d} users: no requests completed, {level['login_failures']} failed logins"
+                )
+                break
+            print(
+                f"{concurrency:4d} users: {overall['requests_per_s']:.1f} req/s, {100 * overall['error_rate']:.1f}% errors, "
+                f"client CPU {100 * level['client_cpu']:.0f}%"
+            )
+            print(
+                f"     {'route':10s} {'req/s':>8s} {'err%':>6s} {'p50':>8s} {'p90':>8s} {'p99':>8s} {'max':>8s} ms"
+            )
+            for route, stats in sorted(level["routes"].items()):
+                lat = stats["latency_ms"]
+                print(
+                    f"     {route:10s} {stats['requests_per_s']:8.1f} {100 * stats['error_rate']:6.1f} "
+                    f"{lat['p50']:8.0f} {lat['p90']:8.0f} {lat['p99']:8.0f} {lat['max']:8.0f}"
+                )
+            if overall["error_rate"] > args.stop_error_rate or level["login_failures"]:
+                print(f"stopping the ramp at {concurrency} users")
+                break
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(f"results written to {write_results('loadtest', results)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+The app benchmarks.loadtest drives, for gunicorn:
+
+    GUNICORN_PRELOAD=1 gunicorn -c gunicorn.conf.py "benchmarks.loadtest_app:create_app()"
+
+Built like bench_app, with logins required again. create_app seeds a
+worklist from benchmarks.synthetic. There are LOADTEST_CASES cases of
+LOADTEST_VARIANTS variants for each CASE_GROUPS assay. There are also
+LOADTEST_WORKLIST samples without variants for the main screen, about
+half of them reported, and RNA samples for /rna/fusion. Each user
+user<n>@bench.local (password bench) belongs to every group. LDAP runs as
+an ldap3 MOCK_SYNC in-memory directory holding the service account and
+the users, so logins go through LdapManager as in production.
+
+Seed once in the preloading master. Each worker then starts from the same
+database, and with LOADTEST_BACKEND=memory from a copy of the master's
+mongomock data.
+
+Settings come from the environment:
+
+    LOADTEST_BACKEND   mongod (the scratch database BENCH_MONGO_DB, dropped first) or memory
+    LOADTEST_CACHE     off, memory (per worker, the default) or shared (plus a sqlite tier in a temp dir)
+    LOADTEST_VARIANTS  variants per case, default 2000
+    LOADTEST_CASES     cases per assay, default 2
+    LOADTEST_WORKLIST  main screen samples, default 200
+    LOADTEST_USERS     users, default 64
+"""
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+from benchmarks.common import BENCH_DB, bench_app
+from benchmarks.e2e import load_case
+from benchmarks.synthetic import CASE_GROUPS, make_case, make_sample
+
+PASSWORD = "bench"
+RNA_GROUP = "fusion"
+BASE_DN = "dc=bench,dc=local"
+SERVICE_DN = f"cn=coyote,{BASE_DN}"
+SERVICE_SECRET = "bench-service"
+
+
+def user_mail(number: int) -> str:
+    return f"user{number}@bench.local"
+
+
+def case_name(assay: str, number: int) -> str:
+    return f"load_{assay}_{number}"
+
+
+def seed(db, n_variants: int, n_cases: int, n_worklist: int, n_users: int) -> dict:
+    """
+    Insert the cases, worklist, RNA samples and users, documents per collection
+    """
+    counts = {}
+    cases = [(assay, number) for assay in CASE_GROUPS for number in range(n_cases)]
+    for seed_no, (assay, number) in enumerate(cases, start=1):
+        case = make_case(assay, n_variants, seed=seed_no, name=case_name(assay, number))
+        # Every case yields the same panels, keep one set
+        if seed_no > 1:
+            case = ((collection, docs) for collection, docs in case if collection != "panels")
+        for collection, count in load_case(db, case).items():
+            counts[collection] = counts.get(collection, 0) + count
+
+    rnd = random.Random(1)
+    groups = list(CASE_GROUPS.values())
+    worklist = []
+    for number in range(n_worklist):
+        sample = make_sample(rnd, f"worklist_{number}", groups[number % len(groups)])
+        sample["time_added"] = datetime(2024, 1, 1) + timedelta(hours=number)
+        if rnd.random() < 0.5:
+            sample["report_num"] = 1
+            sample["reports"] = [{"time_created": sample["time_added"] + timedelta(days=2)}]
+        worklist.append(sample)
+    worklist += [
+        make_sample(rnd, f"rna_{number}", RNA_GROUP) for number in range(max(10, n_worklist // 10))
+    ]
+    db.samples.insert_many(worklist)
+    counts["samples"] += len(worklist)
+
+    db.users.insert_many(
+        [
+            {"_id": f"user{number}", "email": user_mail(number), "groups": groups + [RNA_GROUP]}
+            for number in range(n_users)
+        ]
+    )
+    counts["users"] = n_users
+    return counts
+
+
+def mock_directory(ldap_manager, n_users: int) -> None:
+    """
+    Service account and users in the in-memory directory of the manager's Server
+    """
+    from ldap3 import MOCK_SYNC, Connection
+
+    conn = Connection(
+        ldap_manager.ldap_server,
+        user=SERVICE_DN,
+        password=SERVICE_SECRET,
+        client_strategy=MOCK_SYNC,
+    )
+    conn.strategy.add_entry(SERVICE_DN, {"userPassword": SERVICE_SECRET, "sn": "coyote"})
+    for number in range(n_users):
+        conn.strategy.add_entry(
+            f"cn=user{number},ou=people,{BASE_DN}",
+            {"userPassword": PASSWORD, "mail": user_mail(number), "sn": f"user{number}"},
+        )
+
+
+def create_app():
+    backend = os.getenv("LOADTEST_BACKEND", "mongod")
+    cache_mode = os.getenv("LOADTEST_CACHE", "memory")
+    n_users = int(os.getenv("LOADTEST_USERS", "64"))
+
+    app = bench_app()
+    from coyote.extensions import cache, ldap_manager, store
+
+    app.config["LOGIN_DISABLED"] = False
+    # The settings the extensions read in init_app
+    app.config.update(
+        CACHE_ENABLED=cache_mode != "off",
+        CACHE_DIR=tempfile.mkdtemp(prefix="coyote-loadtest-cache-")
+        if cache_mode == "shared"
+        else None,
+        LDAP_CONNECTION_STRATEGY="MOCK_SYNC",
+        LDAP_USE_TLS=False,
+        LDAP_BASE_DN=BASE_DN,
+        LDAP_BINDDN=SERVICE_DN,
+        LDAP_SECRET=SERVICE_SECRET,
+        LDAP_USER_LOGIN_ATTR="mail",
+    )
+    cache.init_app(app)
+    ldap_manager.init_app(app)
+    mock_directory(ldap_manager, n_users)
+
+    if backend == "memory":
+        import mongomock
+
+        store._setup_dbs(mongomock.MongoClient())
+    else:
+        store.db_name = BENCH_DB
+        store.setup()
+        store.coyote_db.client.drop_database(BENCH_DB)
+    counts = seed(
+        store.coyote_db,
+        n_variants=int(os.getenv("LOADTEST_VARIANTS", "2000")),
+        n_cases=int(os.getenv("LOADTEST_CASES", "2")),
+        n_worklist=int(os.getenv("LOADTEST_WORKLIST", "200")),
+        n_users=n_users,
+    )
+    if backend == "mongod":
+        # Workers connect on their own after the fork
+        store.connection.close()
+    app.logger.info(f"Load test app seeded ({backend}, cache {cache_mode}): {counts}")
+    return app
@@ -0,0 +1,208 @@
+"""
+Micro-benchmarks of the util.py functions every variant page runs.
+
+Each function runs on a fixed fixture built from benchmarks.synthetic
+with fixed seeds, so runs on the same machine are comparable. Timing is
+per call on the whole fixture, with the garbage collector off, best and
+median of --rounds rounds of --number calls. Functions that modify their
+input get it reset between calls, outside the timing. One more call runs
+under tracemalloc for its peak traced bytes and the blocks it allocated
+that are still alive when it returns (its result).
+
+Results go to benchmarks/results/micro-<timestamp>.json. With --baseline
+an earlier results file is the reference: the run fails when a function's
+best time or peak memory exceeds the baseline's by more than --threshold.
+
+    python -m benchmarks.micro [--rounds 7] [--number 5] [--only select_csq,...]
+                               [--baseline benchmarks/results/micro-<timestamp>.json]
+                               [--threshold 0.2]
+"""
+import argparse
+import gc
+import json
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from benchmarks.common import bench_app, write_results
+from benchmarks.synthetic import make_cnv, make_transloc, make_variants
+
+N_VARIANTS = 1000
+N_CNVS = 500
+N_TRANSLOCS = 50
+
+
+class GroupsCollection:
+    """
+    app.config["GROUPS_COLL"] for generate_ai_text, one fixed group document
+    """
+
+    def find_one(self, query: dict) -> dict:
+        return {"_id": query["_id"], "panel_name": "GMS Myeloid", "accredited": True}
+
+
+def make_benches(util) -> dict:
+    """
+    name -> (rows, call, reset), call(fixture) timed, reset(fixture) before each call or None
+    """
+    variants = make_variants(N_VARIANTS, seed=7)
+    canonical = {}
+    for var in variants[::3]:
+        csq = var["INFO"]["CSQ"][-1]
+        canonical.setdefault(csq["SYMBOL"], csq["Feature"].split(".")[0])
+    # Variants as the later stages see them: selected CSQ and a classification
+    selected = make_variants(N_VARIANTS, seed=7)
+    rnd = random.Random(7)
+    for var in selected:
+        var["INFO"]["selected_CSQ"], var["INFO"]["selected_CSQ_criteria"] = util.select_csq(
+            var["INFO"]["CSQ"], canonical
+        )
+        var["classification"] = {"class": rnd.choice([1, 2, 3, 4, 999])}
+    rnd = random.Random(11)
+    cnvs = [make_cnv(rnd, "micro") for _ in range(N_CNVS)]
+    translocs = [make_transloc(rnd, "micro") for _ in range(N_TRANSLOCS)]
+    checked_conseq = list(util.app.config["GROUP_FILTERS"]["default_checked_conseq"])
+
+    def reset_hotspots(rows):
+        for var in rows:
+            var["INFO"].pop("HOTSPOT", None)
+
+    def reset_cnv_genes(rows):
+        for cnv in rows:
+            cnv.pop("panel_gene", None)
+            cnv.pop("other_genes", None)
+
+    return {
+        "select_csq": (
+            variants,
+            lambda rows: [util.select_csq(var["INFO"]["CSQ"], canonical) for var in rows],
+            None,
+        ),
+        "popfreq_filter": (selected, lambda rows: util.popfreq_filter(rows, 0.01), None),
+        "hotspot_variant": (selected, util.hotspot_variant, reset_hotspots),
+        "get_protein_coding_genes": (variants, util.get_protein_coding_genes, None),
+        "get_filter_conseq_terms": (checked_conseq, util.get_filter_conseq_terms, None),
+        "cnv_organizegenes": (cnvs, util.cnv_organizegenes, reset_cnv_genes),
+        "summerize_cnv": (cnvs, util.summerize_cnv, None),
+        "summerize_fusion": (translocs, util.summerize_fusion, None),
+        "generate_ai_text": (
+            selected,
+            lambda rows: util.generate_ai_text("myeloid", rows, [], [], "myeloid_GMSv1"),
+            None,
+        ),
+    }
+
+
+def measure(fixture, call, reset, rounds: int, number: int) -> dict:
+    per_call = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            total = 0
+            for _ in range(number):
+                if reset is not None:
+                    reset(fixture)
+                start = time.perf_counter_ns()
+                call(fixture)
+                total += time.perf_counter_ns() - start
+            per_call.append(total / number)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    if reset is not None:
+        reset(fixture)
+    tracemalloc.start()
+    try:
+        result = call(fixture)
+        _, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    finally:
+        tracemalloc.stop()
+    del result
+    return {
+        "rows": len(fixture),
+        "best_ns": min(per_call),
+        "median_ns": statistics.median(per_call),
+        "peak_bytes": peak,
+        "blocks": blocks,
+    }
+
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    (function, metric, baseline value, value) beyond threshold, for functions in both runs
+    """
+    found = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ("best_ns", "peak_bytes"):
+            if base[metric] and res[metric] > base[metric] * (1 + threshold):
+                found.append((name, metric, base[metric], res[metric]))
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--number", type=int, default=5)
+    parser.add_argument("--only", help="comma separated function names")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare with")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%"
+    )
+    args = parser.parse_args()
+
+    app = bench_app()
+    app.config["GROUPS_COLL"] = GroupsCollection()
+    from coyote.blueprints.variants import util
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)["results"]["functions"]
+
+    results = {}
+    with app.app_context():
+        benches = make_benches(util)
+        names = args.only.split(",") if args.only else list(benches)
+        print(
+            f"{'function':26s} {'rows':>6s} {'ns/op':>14s} {'ns/row':>10s} {'peak KiB':>10s} {'blocks':>8s}"
+            + ("  vs baseline" if baseline else "")
+        )
+        for name in names:
+            fixture, call, reset = benches[name]
+            res = measure(fixture, call, reset, args.rounds, args.number)
+            results[name] = res
+            line = (
+                f"{name:26s} {res['rows']:6d} {res['best_ns']:14,.0f} {res['best_ns'] / res['rows']:10,.0f} "
+                f"{res['peak_bytes'] / 1024:10,.1f} {res['blocks']:8d}"
+            )
+            if baseline and name in baseline:
+                line += f"  {100 * (res['best_ns'] / baseline[name]['best_ns'] - 1):+6.1f}%"
+            print(line)
+
+    path = write_results(
+        "micro", {"rounds": args.rounds, "number": args.number, "functions": results}
+    )
+    print(f"results written to {path}")
+    if baseline is not None:
+        found = regressions(results, baseline, args.threshold)
+        for name, metric, base, value in found:
+            print(
+                f"REGRESSION {name} {metric}: {base:,.0f} -> {value:,.0f} ({100 * (value / base - 1):+.1f}%)"
+            )
+        if found:
+            sys.exit(
+                f"{len(found)} regressions beyond {args.threshold:.0%} against {args.baseline}"
+            )
+        print(f"no regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
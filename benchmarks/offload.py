@@ -0,0 +1,125 @@
+"""
+Offload pool benchmark for the OFFLOAD_STAGES of the SNV pipeline.
+
+Runs select_csq, popfreq, genepanel and hotspot on a synthetic sample in
+process and in offload children, with plain documents and with the
+compact model, and checks that both paths return the same variants.
+Besides wall time it reports the CPU time of the worker process itself,
+children excluded, which is what the other request threads of a gthread
+worker cannot use while the stages hold the GIL. Finally the children are made to die, to check that the request
+still completes, in process, with the same result.
+
+    python -m benchmarks.offload [n_variants] [workers]
+"""
+import gc
+import os
+import sys
+import time
+
+import bson
+
+from benchmarks.common import bench_app, write_results
+from benchmarks.synthetic import make_variants
+
+MAX_POPFREQ = 0.01
+STAGE_NAMES = ["select_csq", "popfreq", "genepanel", "hotspot"]
+
+
+class CanonicalStore:
+    """
+    The one handler the offloaded stages call, no canonical transcripts known
+    """
+
+    def get_canonical(self, genes: list) -> dict:
+        return {}
+
+
+def main(n_variants: int = 20_000, workers: int = 0) -> None:
+    app = bench_app()
+    from coyote.blueprints.variants import pipeline
+    from coyote.blueprints.variants.models import Variant
+    from coyote.blueprints.variants.pipeline import STAGES, PipelineContext, offload_stage
+    from coyote.extensions.offload import Offload
+
+    offload = Offload()
+    offload.enabled = True
+    offload.workers = workers or os.cpu_count() or 1
+    offload.min_rows = 0
+    payload = b"".join(bson.encode(doc) for doc in make_variants(n_variants))
+    params = {"max_popfreq": MAX_POPFREQ, "assay": "myeloid", "subpanel": None}
+
+    def as_rows(compact: bool) -> list:
+        # Fresh documents for every run, as from the driver
+        docs = bson.decode_all(payload)
+        return [Variant.from_bson(doc) for doc in docs] if compact else docs
+
+    def in_process(rows: list, compact: bool) -> list:
+        ctx = PipelineContext(CanonicalStore(), compact_model=compact, **params)
+        for name in STAGE_NAMES:
+            rows = STAGES[name](rows, ctx)
+        return list(rows)
+
+    def offloaded(rows: list, compact: bool) -> list:
+        ctx = PipelineContext(CanonicalStore(), compact_model=compact, **params)
+        ctx.offload = offload
+        return list(offload_stage(rows, ctx, STAGE_NAMES))
+
+    def measure(func, compact: bool) -> tuple:
+        rows = as_rows(compact)
+        # A full collection of the previous run's garbage would land in this one
+        gc.collect()
+        start, start_cpu = time.perf_counter(), time.process_time()
+        result = func(rows, compact)
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+        return [var.to_bson() if compact else var for var in result], elapsed, cpu
+
+    results = {"n_variants": n_variants, "workers": offload.workers}
+    mismatches = []
+    expected = {}
+    with app.app_context():
+        for compact in (False, True):
+            mode = "compact" if compact else "dict"
+            expected[mode], local_s, local_cpu = measure(in_process, compact)
+            got, offload_s, offload_cpu = measure(offloaded, compact)
+            if got != expected[mode]:
+                mismatches.append(mode)
+            results[mode] = {
+                "survivors": len(got),
+                "in_process_s": local_s,
+                "offload_s": offload_s,
+                "in_process_worker_cpu_s": local_cpu,
+                "offload_worker_cpu_s": offload_cpu,
+            }
+            print(
+                f"{mode:8s} in process {local_s:.2f}s ({local_cpu:.2f}s worker CPU), "
+                f"offloaded {offload_s:.2f}s ({offload_cpu:.2f}s worker CPU), {len(got)} survivors"
+            )
+
+        # Children dying before they answer, their slices run in process
+        parent = os.getpid()
+        run_offloaded = pipeline.run_offloaded
+
+        def dying(rows, ctx, names):
+            if os.getpid() != parent:
+                os._exit(1)
+            return run_offloaded(rows, ctx, names)
+
+        pipeline.run_offloaded = dying
+        try:
+            got, _, _ = measure(offloaded, False)
+        finally:
+            pipeline.run_offloaded = run_offloaded
+        results["dead_children_fallbacks"] = offload.fallbacks
+        if got != expected["dict"]:
+            mismatches.append("dead_children")
+        print(f"dead children: {offload.fallbacks} slices ran in process")
+
+    results["mismatches"] = mismatches
+    print(f"results written to {write_results('offload', results)}")
+    if mismatches:
+        sys.exit(f"offloaded results differ from the in process ones: {mismatches}")
+    print("offloaded results match the in process ones")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
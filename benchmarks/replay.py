@@ -0,0 +1,304 @@
+"""
+Replay of captured production workloads (coyote/extensions/capture.py)
+against a restored dump, for judging index and query changes on real skew.
+
+    python -m benchmarks.replay run CAPTURE [CAPTURE ...] --db coyote_restored
+                                [--uri mongodb://localhost:27017] [--concurrency 1]
+                                [--repeat 1] [--endpoints list_variants,...] [--writes]
+                                [--compare benchmarks/results/replay-<timestamp>.json]
+    python -m benchmarks.replay pseudonymize --db coyote_restored --key KEY
+
+run re-executes the commands of every captured request, in their order,
+on the database --db of --uri. CAPTURE is a capture file or a directory
+of them. Requests run --concurrency at a time. Each command's cursor is
+exhausted with getMores as the app would. Writes are skipped unless
+--writes is given, and then they change the dump. The results, per query
+shape (as in querystats) and per endpoint, set the replayed times and
+document counts beside the captured ones. A differing count means the
+query or the data changed. They are written to
+benchmarks/results/replay-<timestamp>.json. --compare sets them beside
+an earlier replay, e.g. before adding an index.
+
+Captures made with CAPTURE_ANONYMIZE_KEY hold pseudonyms instead of
+sample names and user ids. pseudonymize rewrites the same fields
+(CAPTURE_ANONYMIZE_FIELDS) of the restored dump with the same key, so
+the captured commands find their documents. Only run it on a local copy.
+"""
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from bson import json_util
+from pymongo import DeleteOne, InsertOne, MongoClient, UpdateOne
+from pymongo.errors import PyMongoError
+
+import config
+from benchmarks.common import write_results
+from coyote.extensions.capture import pseudonymize
+from coyote.extensions.querystats import command_shape, shape_key
+
+WRITE_COMMANDS = frozenset(["update", "insert", "delete", "findAndModify"])
+BULK_BATCH = 1000
+
+
+def read_capture(paths: list) -> list:
+    """
+    Captured requests from capture files and directories of them, oldest first
+    """
+    files = []
+    for path in map(Path, paths):
+        files += sorted(path.glob("*.jsonl")) if path.is_dir() else [path]
+    requests = []
+    for path in files:
+        with path.open(encoding="utf-8") as fh:
+            requests += [json_util.loads(line) for line in fh if line.strip()]
+    return sorted(requests, key=lambda captured: captured["time"])
+
+
+def execute(db, captured: dict) -> tuple:
+    """
+    Run one captured command, exhausting its cursor. Milliseconds and documents returned.
+    """
+    start = time.perf_counter()
+    reply = db.command(captured["command"])
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        docs = len(cursor.get("firstBatch", []))
+        while cursor.get("id"):
+            cursor = db.command({"getMore": cursor["id"], "collection": captured["collection"]})[
+                "cursor"
+            ]
+            docs += len(cursor.get("nextBatch", []))
+    else:
+        docs = reply.get("n", 0)
+    return (time.perf_counter() - start) * 1000, docs
+
+
+class ShapeResult:
+    """
+    Captured and replayed totals of one query shape
+    """
+
+    def __init__(self, namespace: str, command: str, shape: str):
+        self.namespace = namespace
+        self.command = command
+        self.shape = shape
+        self.count = 0
+        self.captured_ms = 0.0
+        self.replayed_ms = []
+        self.doc_mismatches = 0
+        self.errors = 0
+
+    def as_dict(self) -> dict:
+        replayed = sum(self.replayed_ms)
+        return {
+            "namespace": self.namespace,
+            "command": self.command,
+            "shape": self.shape,
+            "count": self.count,
+            "captured_mean_ms": self.captured_ms / self.count if self.count else 0.0,
+            "replayed_mean_ms": replayed / len(self.replayed_ms) if self.replayed_ms else 0.0,
+            "replayed_median_ms": statistics.median(self.replayed_ms) if self.replayed_ms else 0.0,
+            "replayed_total_ms": replayed,
+            "doc_mismatches": self.doc_mismatches,
+            "errors": self.errors,
+        }
+
+
+def replay(db, requests: list, concurrency: int, writes: bool) -> tuple:
+    """
+    Per shape results and per endpoint (captured, replayed) mongo milliseconds of every request
+    """
+    shapes = {}
+    endpoints = {}
+    lock = threading.Lock()
+
+    def run_request(captured_request: dict) -> None:
+        captured_ms = replayed_ms = 0.0
+        for captured in captured_request["commands"]:
+            if captured["name"] in WRITE_COMMANDS and not writes:
+                continue
+            collection, shape = command_shape(captured["name"], captured["command"])
+            key = shape_key(captured["db"], collection, captured["name"], shape)
+            try:
+                ms, docs = execute(db, captured)
+                error = False
+            except PyMongoError:
+                ms, docs, error = 0.0, None, True
+            with lock:
+                result = shapes.get(key)
+                if result is None:
+                    result = shapes[key] = ShapeResult(
+                        f"{captured['db']}.{collection}",
+                        captured["name"],
+                        json.dumps(shape, sort_keys=True, default=str),
+                    )
+                result.count += 1
+                result.captured_ms += captured["ms"]
+                if error:
+                    result.errors += 1
+                else:
+                    result.replayed_ms.append(ms)
+                    result.doc_mismatches += docs != captured["docs"]
+            captured_ms += captured["ms"]
+            replayed_ms += ms
+        with lock:
+            endpoints.setdefault(captured_request["endpoint"], []).append(
+                (captured_ms, replayed_ms)
+            )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_request, requests))
+    return shapes, endpoints
+
+
+def run(args) -> None:
+    requests = read_capture(args.capture)
+    if args.endpoints:
+        wanted = set(args.endpoints.split(","))
+        requests = [captured for captured in requests if captured["endpoint"] in wanted]
+    if not requests:
+        sys.exit("no captured requests to replay")
+    db = MongoClient(args.uri)[args.db]
+
+    start = time.perf_counter()
+    shapes, endpoints = {}, {}
+    for _ in range(args.repeat):
+        run_shapes, run_endpoints = replay(db, requests, args.concurrency, args.writes)
+        for key, result in run_shapes.items():
+            merged = shapes.setdefault(
+                key, ShapeResult(result.namespace, result.command, result.shape)
+            )
+            merged.count += result.count
+            merged.captured_ms += result.captured_ms
+            merged.replayed_ms += result.replayed_ms
+            merged.doc_mismatches += result.doc_mismatches
+            merged.errors += result.errors
+        for endpoint, totals in run_endpoints.items():
+            endpoints.setdefault(endpoint, []).extend(totals)
+    wall = time.perf_counter() - start
+
+    results = {
+        "captured_requests": len(requests),
+        "repeat": args.repeat,
+        "concurrency": args.concurrency,
+        "writes": args.writes,
+        "wall_s": wall,
+        "shapes": {key: result.as_dict() for key, result in shapes.items()},
+        "endpoints": {
+            endpoint: {
+                "requests": len(totals),
+                "captured_median_ms": statistics.median(captured for captured, _ in totals),
+                "replayed_median_ms": statistics.median(replayed for _, replayed in totals),
+            }
+            for endpoint, totals in endpoints.items()
+        },
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)["results"]["shapes"]
+
+    print(f"{len(requests)} requests x {args.repeat} replayed in {wall:.1f}s")
+    print(f"{'endpoint':28s} {'requests':>8s} {'captured ms':>12s} {'replayed ms':>12s}")
+    for endpoint, row in sorted(results["endpoints"].items(), key=lambda item: str(item[0])):
+        print(
+            f"{str(endpoint):28s} {row['requests']:8d} {row['captured_median_ms']:12.1f} {row['replayed_median_ms']:12.1f}"
+        )
+    print(
+        f"\n{'count':>7s} {'captured':>9s} {'replayed':>9s} {'vs before':>9s} {'docs!=':>6s} {'errors':>6s}  shape (mean ms)"
+    )
+    ranked = sorted(
+        results["shapes"].items(), key=lambda item: item[1]["replayed_total_ms"], reverse=True
+    )
+    for key, row in ranked[: args.top]:
+        before = baseline.get(key) if baseline else None
+        change = (
+            f"{100 * (row['replayed_mean_ms'] / before['replayed_mean_ms'] - 1):+8.0f}%"
+            if before and before["replayed_mean_ms"]
+            else f"{'':9s}"
+        )
+        print(
+            f"{row['count']:7d} {row['captured_mean_ms']:9.1f} {row['replayed_mean_ms']:9.1f} {change} "
+            f"{row['doc_mismatches']:6d} {row['errors']:6d}  {row['namespace']} {row['command']} {row['shape']}"
+        )
+    print(f"results written to {write_results('replay', results)}")
+
+
+def pseudonymize_dump(args) -> None:
+    db = MongoClient(args.uri)[args.db]
+    key = args.key.encode()
+    fields = (
+        json.loads(args.fields) if args.fields else config.DefaultConfig.CAPTURE_ANONYMIZE_FIELDS
+    )
+    for collection, names in fields.items():
+        names = frozenset(names)
+        # A changed _id means a new document
+        replace = "_id" in names
+        docs = db[collection].find({}, None if replace else {name: 1 for name in names})
+        if replace:
+            # Not to meet the reinserted documents again
+            docs = list(docs)
+        ops, changed = [], 0
+        for doc in docs:
+            new = pseudonymize(doc, names, key)
+            if new == doc:
+                continue
+            if replace:
+                ops += [DeleteOne({"_id": doc["_id"]}), InsertOne(new)]
+            else:
+                ops.append(
+                    UpdateOne(
+                        {"_id": doc["_id"]},
+                        {"$set": {name: new[name] for name in names if name in new}},
+                    )
+                )
+            changed += 1
+            if len(ops) >= BULK_BATCH:
+                db[collection].bulk_write(ops)
+                ops = []
+        if ops:
+            db[collection].bulk_write(ops)
+        print(f"{collection}: {changed} documents pseudonymized ({', '.join(sorted(names))})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="action", required=True)
+
+    run_parser = commands.add_parser("run", help="replay captured requests")
+    run_parser.add_argument("capture", nargs="+", help="capture files or directories")
+    run_parser.add_argument("--uri", default="mongodb://localhost:27017")
+    run_parser.add_argument("--db", required=True, help="database holding the restored dump")
+    run_parser.add_argument("--concurrency", type=int, default=1)
+    run_parser.add_argument("--repeat", type=int, default=1)
+    run_parser.add_argument("--endpoints", help="only these endpoints, comma separated")
+    run_parser.add_argument(
+        "--writes", action="store_true", help="also replay writes, modifying the dump"
+    )
+    run_parser.add_argument("--compare", help="results file of an earlier replay")
+    run_parser.add_argument("--top", type=int, default=25, help="shapes to list")
+    run_parser.set_defaults(func=run)
+
+    anon_parser = commands.add_parser(
+        "pseudonymize", help="pseudonymize a restored dump like the capture"
+    )
+    anon_parser.add_argument("--uri", default="mongodb://localhost:27017")
+    anon_parser.add_argument("--db", required=True, help="database holding the restored dump")
+    anon_parser.add_argument("--key", required=True, help="CAPTURE_ANONYMIZE_KEY of the capture")
+    anon_parser.add_argument(
+        "--fields", help="JSON collection -> fields, default CAPTURE_ANONYMIZE_FIELDS"
+    )
+    anon_parser.set_defaults(func=pseudonymize_dump)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
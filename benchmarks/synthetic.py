@@ -0,0 +1,330 @@
+"""
+Synthetic variant documents shaped like variants_idref
+"""
+import random
+
+from bson import ObjectId
+
+GENES = ["FLT3", "NPM1", "TP53", "DNMT3A", "TET2", "ASXL1", "IDH1", "IDH2", "RUNX1", "KRAS"]
+IMPACTS = ["HIGH", "MODERATE", "LOW", "MODIFIER"]
+CONSEQUENCES = [
+    "missense_variant",
+    "frameshift_variant",
+    "stop_gained",
+    "splice_region_variant",
+    "synonymous_variant",
+    "intron_variant",
+    "3_prime_UTR_variant",
+]
+# Fields VEP writes per consequence that the views never look at, but still have to be decoded
+VEP_EXTRA_FIELDS = [
+    "Allele",
+    "Gene",
+    "Feature_type",
+    "EXON",
+    "INTRON",
+    "cDNA_position",
+    "CDS_position",
+    "Protein_position",
+    "Amino_acids",
+    "Codons",
+    "Existing_variation",
+    "DISTANCE",
+    "STRAND",
+    "FLAGS",
+    "SYMBOL_SOURCE",
+    "HGNC_ID",
+    "TSL",
+    "APPRIS",
+    "CCDS",
+    "ENSP",
+    "SWISSPROT",
+    "TREMBL",
+    "UNIPARC",
+    "SIFT",
+    "PolyPhen",
+    "DOMAINS",
+    "HGVS_OFFSET",
+    "AFR_AF",
+    "AMR_AF",
+    "EAS_AF",
+    "EUR_AF",
+    "SAS_AF",
+    "CLIN_SIG",
+    "SOMATIC",
+    "PHENO",
+    "PUBMED",
+    "MOTIF_NAME",
+]
+
+
+def gene_name(rnd: random.Random, n_genes: int = 500) -> str:
+    if rnd.random() < 0.3:
+        return rnd.choice(GENES)
+    return f"GENE{rnd.randrange(n_genes)}"
+
+
+def make_csq(rnd: random.Random, gene: str, idx: int, tx: int, common: bool) -> dict:
+    gnomad = rnd.uniform(0.02, 0.4) if common else rnd.uniform(0, 0.005)
+    csq = {
+        "SYMBOL": gene,
+        "Feature": f"NM_{idx * 10 + tx:06d}.{rnd.randint(1, 4)}",
+        "IMPACT": rnd.choice(IMPACTS),
+        "CANONICAL": "YES" if tx == 0 else "",
+        "BIOTYPE": "protein_coding" if rnd.random() < 0.8 else "nonsense_mediated_decay",
+        "Consequence": [rnd.choice(CONSEQUENCES)],
+        "HGVSc": f"NM_{idx * 10 + tx:06d}.1:c.{rnd.randint(1, 5000)}G>A",
+        "HGVSp": f"NP_{idx * 10 + tx:06d}.1:p.Arg{rnd.randint(1, 900)}His" if tx % 2 == 0 else "",
+        "ExAC_MAF": "",
+        "GMAF": "",
+        "gnomAD_AF": round(gnomad, 5),
+        "gnomADg_AF": "",
+        "COSMIC_hotspot_OID": f"COSV{idx}" if rnd.random() < 0.05 else "",
+    }
+    for field in VEP_EXTRA_FIELDS:
+        csq[field] = f"{field.lower()}_{rnd.randrange(1000)}"
+    return csq
+
+
+def make_variant(rnd: random.Random, sample_id: str, idx: int, common_frac: float = 0.6) -> dict:
+    """
+    One variants_idref document. common_frac of the variants carry population
+    frequencies above the default 0.01 popfreq filter.
+    """
+    gene = gene_name(rnd)
+    common = rnd.random() < common_frac
+    gt = [
+        {
+            "type": "case",
+            "sample": "case",
+            "AF": rnd.uniform(0.05, 0.6),
+            "DP": rnd.randint(100, 2000),
+            "VD": rnd.randint(10, 800),
+            "GT": "0/1",
+        }
+    ]
+    if rnd.random() < 0.5:
+        gt.append(
+            {
+                "type": "control",
+                "sample": "control",
+                "AF": rnd.uniform(0, 0.03),
+                "DP": rnd.randint(100, 2000),
+                "VD": rnd.randint(0, 30),
+                "GT": "0/0",
+            }
+        )
+    return {
+        "_id": ObjectId(),
+        "SAMPLE_ID": sample_id,
+        "CHROM": rnd.randint(1, 22),
+        "POS": rnd.randint(10_000, 200_000_000),
+        "REF": rnd.choice("ACGT"),
+        "ALT": rnd.choice("ACGT"),
+        "FILTER": rnd.choice(
+            [["PASS"], ["WARN_PON_freebayes"], ["FAIL_NVAF"], ["PASS", "GERMLINE"]]
+        ),
+        "QUAL": rnd.uniform(10, 1000),
+        "GT": gt,
+        "INFO": {
+            "CSQ": [make_csq(rnd, gene, idx, tx, common) for tx in range(rnd.randint(1, 8))],
+            "variant_callers": rnd.sample(["vardict", "freebayes", "tnscope", "pindel"], 2),
+        },
+    }
+
+
+def make_variants(n: int, sample_id: str = "bench_sample", seed: int = 1, **kwargs) -> list:
+    rnd = random.Random(seed)
+    return [make_variant(rnd, sample_id, idx, **kwargs) for idx in range(n)]
+
+
+# Group of benchmarks/config/groups.toml per query shape of varqueries.build_query
+CASE_GROUPS = {
+    "myeloid": "myeloid_GMSv1",
+    "solid": "solid_GMSv3",
+    "gmsonco": "gmsonco",
+    "tumwgs": "tumwgs",
+}
+SUBPANEL = "lung"
+CNV_CALLERS = [["gatk"], ["cnvkit"], ["manta"], ["gatk", "cnvkit"]]
+
+
+def make_sample(rnd: random.Random, name: str, group: str) -> dict:
+    sample = {
+        "_id": ObjectId(),
+        "name": name,
+        "groups": [group],
+        "purity": round(rnd.uniform(0.3, 0.9), 2),
+        "genome_build": 38,
+        "GT": [{"type": "case", "sample": "case"}, {"type": "control", "sample": "control"}],
+    }
+    if group == CASE_GROUPS["solid"]:
+        sample["subpanel"] = SUBPANEL
+    return sample
+
+
+def make_panels() -> list:
+    """
+    Gene lists of every benchmark assay, and the solid subpanel
+    """
+    return [
+        {
+            "name": "core",
+            "type": "genelist",
+            "assays": ["myeloid", "tumwgs", "gmsonco"],
+            "genes": GENES[:6],
+        },
+        {
+            "name": "extended",
+            "type": "genelist",
+            "assays": list(CASE_GROUPS),
+            "genes": GENES + [f"GENE{i}" for i in range(50)],
+        },
+        {
+            "name": SUBPANEL,
+            "type": "genelist",
+            "assays": ["solid"],
+            "genes": ["EGFR", "KRAS", "ALK", "TP53"],
+        },
+    ]
+
+
+def make_annotations(rnd: random.Random, var: dict, assay: str, subpanel: str) -> list:
+    """
+    A classification and a comment on the first consequence of var
+    """
+    csq = var["INFO"]["CSQ"][0]
+    if csq["HGVSp"]:
+        nomenclature, name = "p", csq["HGVSp"].split(":")[1]
+    else:
+        nomenclature, name = "c", csq["HGVSc"].split(":")[1]
+    common = {
+        "gene": csq["SYMBOL"],
+        "nomenclature": nomenclature,
+        "variant": name,
+        "assay": assay,
+        "subpanel": subpanel,
+    }
+    return [
+        dict(common, **{"class": rnd.randint(1, 4), "time_created": rnd.uniform(1.5e9, 1.7e9)}),
+        dict(
+            common,
+            text=f"Seen in {rnd.randint(1, 40)} cases",
+            time_created=rnd.uniform(1.5e9, 1.7e9),
+        ),
+    ]
+
+
+def make_cnv(rnd: random.Random, sample_id: str) -> dict:
+    start = rnd.randint(10_000, 150_000_000)
+    size = rnd.choice([rnd.randint(1_000, 100_000), rnd.randint(100_000, 20_000_000)])
+    genes = [{"gene": gene_name(rnd)} for _ in range(rnd.randint(1, 12))]
+    for gene in genes:
+        if gene["gene"] in GENES:
+            gene["class"] = 1
+    return {
+        "_id": ObjectId(),
+        "SAMPLE_ID": sample_id,
+        "chr": str(rnd.randint(1, 22)),
+        "start": start,
+        "end": start + size,
+        "size": size,
+        "ratio": round(
+            rnd.choice([rnd.uniform(-1.5, -0.3), rnd.uniform(0.3, 1.5), rnd.uniform(3, 5)]), 3
+        ),
+        "callers": rnd.choice(CNV_CALLERS),
+        # reference/alternative read pairs and split reads, as summerize_cnv reads them
+        "PR": f"{rnd.randint(1, 40)}/{rnd.randint(1, 20)}",
+        "SR": f"{rnd.randint(1, 40)}/{rnd.randint(1, 20)}",
+        "genes": genes,
+        "interesting": rnd.random() < 0.1,
+    }
+
+
+def make_transloc(rnd: random.Random, sample_id: str) -> dict:
+    genes = f"{gene_name(rnd)}&{gene_name(rnd)}"
+    return {
+        "_id": ObjectId(),
+        "SAMPLE_ID": sample_id,
+        "CHROM": str(rnd.randint(1, 22)),
+        "POS": rnd.randint(10_000, 200_000_000),
+        "ALT": f"N]{rnd.randint(1, 22)}:{rnd.randint(10_000, 200_000_000)}]",
+        "GT": [
+            {
+                "PR": f"{rnd.randint(1, 40)},{rnd.randint(1, 20)}",
+                "SR": f"{rnd.randint(1, 40)},{rnd.randint(1, 20)}",
+            }
+        ],
+        "interesting": rnd.random() < 0.3,
+        "INFO": {
+            "ANN": [
+                {
+                    "Gene_Name": genes,
+                    "Annotation": ["gene_fusion"],
+                    "HGVSp": "",
+                    "HGVSc": f"c.{rnd.randint(1, 3000)}%2B1",
+                }
+            ],
+            "PANEL": rnd.choice(["", "fusion_core"]),
+            "UR": rnd.randint(0, 30),
+        },
+    }
+
+
+def make_biomarkers(rnd: random.Random, sample_id: str) -> dict:
+    return {
+        "_id": ObjectId(),
+        "SAMPLE_ID": sample_id,
+        "MSIS": {
+            "tot": rnd.randint(100, 500),
+            "som": rnd.randint(0, 30),
+            "perc": round(rnd.uniform(0, 15), 2),
+        },
+        "MSIP": {
+            "tot": rnd.randint(100, 500),
+            "som": rnd.randint(0, 30),
+            "perc": round(rnd.uniform(0, 15), 2),
+        },
+        "HRD": {
+            "tai": rnd.randint(0, 30),
+            "hrd": rnd.randint(0, 30),
+            "lst": rnd.randint(0, 30),
+            "sum": rnd.randint(0, 90),
+        },
+    }
+
+
+def make_case(
+    assay: str, n_variants: int, seed: int = 1, name: str = None, annotated_frac: float = 0.05
+):
+    """
+    (collection, documents) pairs of one synthetic sample of a CASE_GROUPS assay:
+    samples, variants_idref, annotation, cnvs_wgs, transloc, biomarkers, panels and
+    refseq_canonical. Variants are generated while they are consumed, so consume the
+    pairs in order. Annotations and canonical transcripts come from the variants.
+    """
+    rnd = random.Random(seed)
+    group = CASE_GROUPS[assay]
+    sample = make_sample(rnd, name or f"bench_{assay}_{n_variants}", group)
+    sample_id = str(sample["_id"])
+    subpanel = sample.get("subpanel")
+    annotations = []
+    canonical = {}
+
+    def variants():
+        for idx in range(n_variants):
+            var = make_variant(rnd, sample_id, idx)
+            csq = var["INFO"]["CSQ"][rnd.randrange(len(var["INFO"]["CSQ"]))]
+            canonical.setdefault(csq["SYMBOL"], csq["Feature"].split(".")[0])
+            if rnd.random() < annotated_frac:
+                annotations.extend(make_annotations(rnd, var, assay, subpanel))
+            yield var
+
+    yield "samples", [sample]
+    yield "variants_idref", variants()
+    yield "annotation", annotations
+    yield "refseq_canonical", [{"gene": gene, "canonical": nm} for gene, nm in canonical.items()]
+    yield "cnvs_wgs", [make_cnv(rnd, sample_id) for _ in range(max(20, n_variants // 50))]
+    yield "transloc", [make_transloc(rnd, sample_id) for _ in range(max(5, n_variants // 1000))]
+    yield "biomarkers", [make_biomarkers(rnd, sample_id)]
+    yield "panels", make_panels()
@@ -0,0 +1,68 @@
+"""
+Memory benchmark for the compact variant model.
+
+Decodes a synthetic sample from BSON row by row, as the cursor hands it to
+list_variants, selects CSQs and filters on population frequency. Reports
+tracemalloc peak and retained memory for plain BSON dicts and for the
+__slots__ Variant model.
+
+    python -m benchmarks.variant_memory [n_variants]
+"""
+import gc
+import sys
+import tracemalloc
+
+import bson
+
+from benchmarks.common import bench_app, write_results
+from benchmarks.synthetic import make_variants
+
+MAX_POPFREQ = 1.0
+
+
+def main(n_variants: int = 20_000) -> None:
+    app = bench_app()
+    from coyote.blueprints.variants import util
+    from coyote.blueprints.variants.models import Variant
+
+    payload = b"".join(bson.encode(var) for var in make_variants(n_variants))
+
+    def pipeline(convert):
+        rows = bson.decode_iter(payload)
+        if convert:
+            rows = map(Variant.from_bson, rows)
+        variants, genes = util.get_protein_coding_genes(rows)
+        for var in variants:
+            var["INFO"]["selected_CSQ"], var["INFO"]["selected_CSQ_criteria"] = util.select_csq(
+                var["INFO"]["CSQ"], {}
+            )
+        return util.popfreq_filter(variants, MAX_POPFREQ)
+
+    results = {"n_variants": n_variants}
+    with app.app_context():
+        for name, convert in (("dict", False), ("compact", True)):
+            gc.collect()
+            tracemalloc.start()
+            variants = pipeline(convert)
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name] = {
+                "retained_bytes": retained,
+                "peak_bytes": peak,
+                "bytes_per_variant": retained // len(variants),
+            }
+            print(
+                f"{name:8s} retained {retained / 2**20:7.1f} MiB peak {peak / 2**20:7.1f} MiB "
+                f"{retained // len(variants)} B/variant"
+            )
+            del variants
+
+    results["retained_reduction"] = (
+        1 - results["compact"]["retained_bytes"] / results["dict"]["retained_bytes"]
+    )
+    print(f"retained memory reduced by {results['retained_reduction']:.0%}")
+    print(f"results written to {write_results('variant_memory', results)}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
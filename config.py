@@ -28,6 +28,144 @@ class DefaultConfig:
     MONGO_HOST = os.getenv("FLASK_MONGO_HOST") or "localhost"
     MONGO_PORT = os.getenv("FLASK_MONGO_PORT") or 27017
     MONGO_DB_NAME = "coyote"
+    # Keyword arguments for the MongoClient, created lazily in each worker
+    MONGO_CLIENT_OPTIONS = {
+        "maxPoolSize": 20,
+        "minPoolSize": 0,
+        "maxIdleTimeMS": 300000,
+        "waitQueueTimeoutMS": 10000,
+        "compressors": "zlib",
+        "appname": "coyote",
+    }
+
+    # Fetch only filter fields for variants and full documents for rows surviving popfreq filtering
+    VARIANTS_LAZY_DECODE = False
+    VARIANTS_BATCH_SIZE = 1000
+    # Hold variants in the __slots__ model from variants/models.py instead of BSON dicts
+    VARIANTS_COMPACT_MODEL = False
+    # Default SNV pipeline stages, override per group with snv_pipeline in the group config
+    SNV_PIPELINE_STAGES = ["select_csq", "popfreq", "genepanel", "annotate", "hotspot"]
+    SNV_PIPELINE_CHUNK_SIZE = 500
+    # Query the sections of the variant page concurrently with the motor adapter
+    # (coyote/db/aio.py, needs motor)
+    VARIANTS_ASYNC = False
+
+    # Handler result cache, see extensions/cache.py. CACHE_DIR holds the sqlite tier shared by
+    # the workers of a node, None keeps each worker to its own memory tier of CACHE_SIZE entries.
+    # It must belong to the app's user with mode 700, it is not used otherwise.
+    CACHE_ENABLED = True
+    CACHE_SIZE = 4096
+    CACHE_DEFAULT_TTL = 300
+    # Seconds per namespace, 0 disables one. users: load_user, reference: canonical transcripts,
+    # panels and groups, samples: get_sample, invalidated on settings changes, single_flight:
+    # variant pages shared between workers
+    CACHE_TTLS = {"users": 60, "reference": 3600, "samples": 60, "single_flight": 5}
+    CACHE_DIR = os.getenv("FLASK_CACHE_DIR") or "/tmp/coyote-cache"
+    CACHE_DISK_MAX_ENTRIES = 100000
+    # Seconds before a worker sees invalidations made by the other workers of the node
+    CACHE_SYNC_SECONDS = 1.0
+    # Invalidations sent to every node through a capped collection, see extensions/invalidation.py
+    INVALIDATION_BUS_ENABLED = True
+    INVALIDATION_COLLECTION = "cache_events"
+    INVALIDATION_COLLECTION_SIZE = 1024 * 1024
+    INVALIDATION_RETRY_SECONDS = 5.0
+    # Concurrent loads of the same variant page compute it once, see extensions/singleflight.py.
+    # SHARED extends this to the workers of a node through the cache's disk tier.
+    SINGLE_FLIGHT_ENABLED = True
+    SINGLE_FLIGHT_SHARED = False
+    # Seconds to wait for another request's result before computing anyway
+    SINGLE_FLIGHT_TIMEOUT = 60.0
+    # Run the CPU bound pipeline stages of requests with at least OFFLOAD_MIN_ROWS rows in forked
+    # children, see extensions/offload.py. OFFLOAD_WORKERS children per worker, 0 is one per core.
+    OFFLOAD_ENABLED = False
+    OFFLOAD_WORKERS = 0
+    OFFLOAD_MIN_ROWS = 5000
+
+    # Rows and MB of BSON (estimated from collStats) list_variants may materialize before switching
+    # to pages, override with row_budget per group
+    ROW_BUDGET = {"variants": 20000, "cnvs": 5000, "memory_mb": 256, "page_size": 5000}
+
+    # maxTimeMS per collection, or per collection and operation (find, find_one, count, aggregate),
+    # 0 is no limit
+    MONGO_TIME_BUDGETS = {
+        "default": 30000,
+        "variants_idref": {"find": 20000, "count": 5000},
+        "annotation": 10000,
+        "cnvs_wgs": 10000,
+        "transloc": 5000,
+        "biomarkers": 5000,
+        "samples": 5000,
+        "users": 2000,
+    }
+
+    # Warm-up at the end of init_app: mongo ping, index check and reference data kept in memory,
+    # see extensions/warmup.py
+    WARMUP_ON_START = True
+    # Seconds between warm-up attempts from /readyz after a failed one
+    WARMUP_RETRY_SECONDS = 30
+    # Key field lists each collection should have an index starting with, missing ones are logged
+    # and shown on /readyz
+    WARMUP_EXPECTED_INDEXES = {
+        "variants_idref": [["SAMPLE_ID"]],
+        "cnvs_wgs": [["SAMPLE_ID"]],
+        "transloc": [["SAMPLE_ID"]],
+        "biomarkers": [["SAMPLE_ID"]],
+        "samples": [["name"], ["SAMPLE_ID"]],
+        "annotation": [["variant"]],
+        "users": [["email"]],
+        "refseq_canonical": [["gene"]],
+    }
+
+    # Compiled Jinja templates kept on disk between restarts, None to disable. Like CACHE_DIR,
+    # it must belong to the app's user with mode 700.
+    JINJA_BYTECODE_CACHE_DIR = os.getenv("FLASK_JINJA_CACHE_DIR") or "/tmp/coyote-jinja-cache"
+    # Compile every template in init_app, shared copy-on-write with gunicorn --preload
+    PRECOMPILE_TEMPLATES = True
+
+    # Request timing, Server-Timing headers and /metrics, see extensions/instrumentation.py
+    INSTRUMENTATION_ENABLED = True
+    SERVER_TIMING_HEADER = True
+    METRICS_WINDOW = 1024
+
+    # Logging, see extensions/applog.py. LOG_LEVELS sets levels per logger name. Debug
+    # payloads (queries, configs) are sampled and limited per minute and key.
+    LOG_FORMAT = os.getenv("FLASK_LOG_FORMAT") or "json"
+    LOG_LEVEL = os.getenv("FLASK_LOG_LEVEL") or "INFO"
+    LOG_LEVELS = {"pymongo": "WARNING", "ldap3": "WARNING"}
+    LOG_REQUEST_ID_HEADER = "X-Request-ID"
+    LOG_REQUESTS = True
+    LOG_PAYLOAD_SAMPLE_RATE = 1.0
+    LOG_PAYLOAD_PER_MINUTE = 60
+
+    # Query shape statistics and slow query log, see extensions/querystats.py.
+    # Set the collections to share statistics between workers, per process otherwise.
+    QUERY_STATS_ENABLED = True
+    QUERY_SLOW_MS = 100
+    QUERY_SLOW_EXAMPLES = 50
+    QUERY_STATS_BYTES = False
+    QUERY_STATS_COLLECTION = None
+    QUERY_SLOWLOG_COLLECTION = None
+    QUERY_SLOWLOG_SIZE = 16 * 1024 * 1024
+    QUERY_STATS_FLUSH_SECONDS = 60
+
+    # Opt-in capture of the mongo commands of a sample of requests, for benchmarks/replay.py, see
+    # extensions/capture.py. With a key, the listed fields per collection are pseudonymized.
+    CAPTURE_ENABLED = False
+    CAPTURE_DIR = os.getenv("FLASK_CAPTURE_DIR") or "/tmp/coyote-capture"
+    CAPTURE_SAMPLE_RATE = 1.0
+    CAPTURE_BYTES = True
+    CAPTURE_MAX_BYTES = 512 * 1024 * 1024
+    CAPTURE_ANONYMIZE_KEY = os.getenv("FLASK_CAPTURE_ANONYMIZE_KEY")
+    CAPTURE_ANONYMIZE_FIELDS = {"samples": ["name"], "users": ["_id", "email"]}
+
+    # Sampling profiler, ?_profile=1 on any url or /admin/profile for admins
+    PROFILER_ENABLED = True
+    PROFILER_INTERVAL = 0.005
+    PROFILER_MAX_SECONDS = 300
+    PROFILER_OUTPUT_DIR = os.getenv("FLASK_PROFILER_DIR") or "/tmp/coyote-profiles"
+
+    # Groups allowed on /admin pages
+    ADMIN_GROUPS = ["admin"]
 
     LDAP_HOST = "ldap://mtlucmds1.lund.skane.se"
     LDAP_BASE_DN = "dc=skane,dc=se"
@@ -37,8 +175,15 @@ class DefaultConfig:
     LDAP_BINDDN = "cn=admin,dc=skane,dc=se"
     LDAP_SECRET = "secret"
     LDAP_USER_DN = "ou=people"
+    # ALL, DSA, SCHEMA or NONE. Only searches and binds are done, so the schema is not needed
+    LDAP_GET_INFO = "NONE"
+    # Seconds a successful login is remembered (as an HMAC) to skip the bind, 0 disables
+    LDAP_AUTH_CACHE_TTL = 300
+    LDAP_AUTH_CACHE_SIZE = 256
+    # Idle service and bind connections kept open per worker, each
+    LDAP_POOL_SIZE = 4
 
-    _PATH_GROUPS_CONFIG = "config/groups.toml"
+    _PATH_GROUPS_CONFIG = os.getenv("FLASK_GROUPS_CONFIG") or "config/groups.toml"
     GROUP_FILTERS = {
         "warn_cov": 500,
         "error_cov": 100,
@@ -94,6 +239,7 @@ class DefaultConfig:
 class DevelopmentConfig(DefaultConfig):
     SECRET_KEY = "traskbatfluga"
     APP_VERSION = f"{app_version}-DEV (git: {get_active_branch_name()})"
+    LOG_FORMAT = os.getenv("FLASK_LOG_FORMAT") or "text"
 
 
 class TestConfig(DefaultConfig):
@@ -112,3 +258,8 @@ class TestConfig(DefaultConfig):
     SECRET_KEY = "traskbatfluga"
     TESTING = True
     LOGIN_DISABLED = True
+    # No mongo to warm up against, /readyz still runs it on first use
+    WARMUP_ON_START = False
+    # Runs do not see each other's cached data
+    CACHE_DIR = None
+    INVALIDATION_BUS_ENABLED = False
@@ -1,4 +1,6 @@
 """Initialize Flask app."""
+import time
+
 from flask import Flask
 from flask_cors import CORS
 
@@ -32,26 +34,92 @@ def init_app(testing: bool = False) -> Flask:
 
     app.logger.info("Initializing app extensions + blueprints:")
     with app.app_context():
+        init_instrumentation(app)
+        init_logging(app)
+        init_query_stats(app)
+        init_capture(app)
+        init_profiler(app)
         init_login_manager(app)
-        init_db(app)
+        init_cache(app)
         init_store(app)
+        init_invalidation(app)
+        init_single_flight(app)
+        init_offload(app)
         register_blueprints(app)
+        init_templates(app)
         init_ldap(app)
+        init_warmup(app)
 
     app.logger.info("App initialization finished. Returning app.")
     return app
 
 
-def init_db(app) -> None:
-    app.logger.info("Initializing MongoDB")
-    # TODO: Add connection checks
-    app.logger.info("Initializing mongodb at: " f"{app.config['MONGO_URI']}")
-    extensions.mongo.init_app(app)
+def init_instrumentation(app) -> None:
+    # Before the db client is created, the mongo command listener registers process wide
+    app.logger.debug("Initializing request instrumentation")
+    extensions.instrumentation.init_app(app)
+
+
+def init_logging(app) -> None:
+    # After the instrumentation, its after_request runs first and still sees the request timings
+    app.logger.debug("Initializing logging")
+    extensions.app_log.init_app(app)
+
+
+def init_query_stats(app) -> None:
+    app.logger.debug("Initializing query shape statistics")
+    extensions.query_stats.init_app(app)
+    extensions.instrumentation.register_collector(extensions.query_stats.metrics_lines)
+
+
+def init_capture(app) -> None:
+    app.logger.debug("Initializing workload capture")
+    extensions.capture.init_app(app)
+    extensions.instrumentation.register_collector(extensions.capture.metrics_lines)
+
+
+def init_profiler(app) -> None:
+    app.logger.debug("Initializing sampling profiler")
+    extensions.profiler.init_app(app)
+
+
+def init_cache(app) -> None:
+    app.logger.debug("Initializing cache")
+    extensions.cache.init_app(app)
+    extensions.store.cache = extensions.cache
+    extensions.async_store.cache = extensions.cache
+    extensions.instrumentation.register_collector(extensions.cache.metrics_lines)
 
 
 def init_store(app) -> None:
+    # The client itself is created on first use in each worker process
     app.logger.info("Initializing MongoAdapter at: " f"{app.config['MONGO_URI']}")
     extensions.store.init_from_app(app)
+    extensions.instrumentation.register_collector(
+        extensions.store.connection.pool_stats.metrics_lines
+    )
+    # Motor client and event loop for VARIANTS_ASYNC, also created on first use
+    extensions.async_store.init_from_app(app)
+
+
+def init_invalidation(app) -> None:
+    app.logger.debug("Initializing cache invalidation bus")
+    extensions.invalidation.init_app(app, extensions.cache, extensions.store)
+    extensions.store.bus = extensions.invalidation
+    extensions.async_store.bus = extensions.invalidation
+    extensions.instrumentation.register_collector(extensions.invalidation.metrics_lines)
+
+
+def init_single_flight(app) -> None:
+    app.logger.debug("Initializing request coalescing")
+    extensions.single_flight.init_app(app, extensions.cache)
+    extensions.instrumentation.register_collector(extensions.single_flight.metrics_lines)
+
+
+def init_offload(app) -> None:
+    app.logger.debug("Initializing offload children")
+    extensions.offload.init_app(app)
+    extensions.instrumentation.register_collector(extensions.offload.metrics_lines)
 
 
 def register_blueprints(app) -> None:
@@ -75,6 +143,41 @@ def register_blueprints(app) -> None:
     from coyote.blueprints.variants import variants_bp
     app.register_blueprint(variants_bp)
 
+    # Admin pages
+    bp_debug_msg("admin_bp")
+    from coyote.blueprints.admin import admin_bp
+    app.register_blueprint(admin_bp)
+
+
+def init_templates(app) -> None:
+    """
+    Persist compiled templates on disk and optionally compile all of them now,
+    in the gunicorn master when preloading, instead of on first use per worker
+    """
+    cache_dir = app.config.get("JINJA_BYTECODE_CACHE_DIR")
+    if cache_dir:
+        from jinja2 import FileSystemBytecodeCache
+
+        from coyote.util import private_directory
+
+        # The cached templates are unmarshalled code, nobody else may be able to plant them
+        try:
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(private_directory(cache_dir))
+        except OSError as ex:
+            app.logger.warning(f"No template bytecode cache in {cache_dir}: {ex}")
+    if app.config.get("PRECOMPILE_TEMPLATES"):
+        start = time.perf_counter()
+        from jinja2 import TemplateError
+
+        names = app.jinja_env.list_templates(extensions=["html"])
+        for name in names:
+            try:
+                app.jinja_env.get_template(name)
+            except TemplateError as ex:
+                # Left to fail on use, as without precompiling
+                app.logger.warning(f"Could not compile template {name}: {ex}")
+        app.logger.info(f"Compiled {len(names)} templates in {time.perf_counter() - start:.2f}s")
+
 
 def init_login_manager(app) -> None:
     app.logger.debug("Initializing login_manager")
@@ -83,4 +186,14 @@ def init_login_manager(app) -> None:
 
 def init_ldap(app):
     app.logger.debug("Initializing ldap login_manager")
-    extensions.ldap_manager.init_app(app)
\ No newline at end of file
+    extensions.ldap_manager.init_app(app)
+    extensions.instrumentation.register_collector(extensions.ldap_manager.metrics_lines)
+
+def init_warmup(app) -> None:
+    app.logger.debug("Initializing warm-up and health endpoints")
+    extensions.warmup.init_app(app, extensions.store)
+    extensions.instrumentation.register_collector(extensions.warmup.metrics_lines)
+    if app.config["WARMUP_ON_START"]:
+        extensions.warmup.run()
+        # Workers forked from a preloading master connect on their own
+        extensions.store.connection.close()
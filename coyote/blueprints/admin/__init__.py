@@ -0,0 +1,6 @@
+from flask import Blueprint
+
+# Blueprint configuration
+admin_bp = Blueprint("admin_bp", __name__, template_folder="templates", url_prefix="/admin")
+
+from coyote.blueprints.admin import views  # noqa: F401, E402
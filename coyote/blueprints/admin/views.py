@@ -0,0 +1,80 @@
+"""
+Admin pages, restricted to members of ADMIN_GROUPS
+"""
+import functools
+import json
+import math
+
+from flask import abort
+from flask import current_app as app
+from flask import render_template, request, send_from_directory
+from flask_login import current_user, login_required
+
+from coyote.blueprints.admin import admin_bp
+
+
+def admin_required(func):
+    @functools.wraps(func)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if not app.config.get("LOGIN_DISABLED") and not current_user.is_admin():
+            abort(403)
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+@admin_bp.route("/queries")
+@admin_required
+def queries():
+    monitor = app.extensions["query_stats"]
+    sort = request.args.get("sort", "total_ms")
+    top = request.args.get("top", 50, type=int)
+    shapes = monitor.worst_shapes(top=top, sort=sort)
+    slow = monitor.slow_examples(top=top)
+
+    explained = request.args.get("explain", type=int)
+    plan = None
+    if explained is not None and 0 <= explained < len(slow):
+        plan = json.dumps(monitor.explain(slow[explained]), indent=2, default=str)
+
+    return render_template(
+        "admin_queries.html",
+        shapes=shapes,
+        slow=slow,
+        sort=sort,
+        explained=explained,
+        plan=plan,
+        shared=bool(monitor.stats_collection),
+    )
+
+
+@admin_bp.route("/profile")
+@admin_required
+def profile():
+    """
+    Start a profile of this worker with ?seconds=N, list finished profiles
+    """
+    profiler = app.extensions["profiler"]
+    seconds = request.args.get("seconds", type=float)
+    started = None
+    if seconds is not None:
+        if not (math.isfinite(seconds) and seconds > 0):
+            return "seconds must be a positive number", 400
+        started = profiler.profile_window(seconds)
+        if started is None:
+            return "A profile is already running in this worker", 409
+    return render_template(
+        "admin_profile.html",
+        started=started,
+        seconds=seconds,
+        profiles=profiler.profiles(),
+        max_seconds=profiler.max_seconds,
+    )
+
+
+@admin_bp.route("/profile/<string:name>")
+@admin_required
+def profile_download(name):
+    profiler = app.extensions["profiler"]
+    return send_from_directory(profiler.output_dir, name, mimetype="text/plain", as_attachment=True)
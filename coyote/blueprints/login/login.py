@@ -4,6 +4,7 @@
 from flask_wtf import FlaskForm
 
 # User-class dependencies:
+from flask import current_app
 from werkzeug.security import check_password_hash
 from wtforms import PasswordField, StringField
 from wtforms.validators import DataRequired
@@ -30,6 +31,9 @@ class User:
     def get_groups(self):
         return self.groups
 
+    def is_admin(self):
+        return bool(set(self.groups) & set(current_app.config.get("ADMIN_GROUPS", [])))
+
     @staticmethod
     def validate_login(password_hash, password):
         return check_password_hash(password_hash, password)
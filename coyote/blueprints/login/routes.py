@@ -6,10 +6,7 @@ from flask_login import login_user, logout_user
 
 from coyote.blueprints.login import login_bp
 from coyote.blueprints.login.login import LoginForm, User
-from coyote.extensions import login_manager, mongo, ldap_manager, store
-
-
-users_collection = mongo.cx["coyote"]["users"]
+from coyote.extensions import login_manager, ldap_manager, store
 
 # Login routes:
 
@@ -23,6 +20,8 @@ def login():
         if ldap_authenticate(username, password):
             app.logger.info("anything?")
             user_obj = store.user(username)
+            # Pick up group changes at login rather than after the cache expires
+            store.invalidate_user(user_obj["_id"])
             user_obj = User(user_obj["_id"], user_obj["groups"])
             login_user(user_obj)
             return redirect(url_for("main_bp.main_screen"))
@@ -41,7 +40,7 @@ def logout():
 
 @login_manager.user_loader
 def load_user(username):
-    user = users_collection.find_one({"_id": username})
+    user = store.get_user_by_id(username)
     if not user:
         return None
     return User(user["_id"], user["groups"])
@@ -1,6 +1,10 @@
 from flask import current_app as app
+from datetime import datetime
+from urllib.parse import unquote
 import os
 
+from coyote.db import queries
+
 @app.template_filter()
 def format_panel_flag_snv(panel_str):
     if not panel_str:
@@ -94,9 +98,34 @@ def intersect(l1, l2):
 @app.template_filter()
 def unesc(st):
     if( len(st) > 0 ):
-        return urllib.unquote(st)
+        return unquote(st)
     else:
         return ""
+
+
+@app.template_filter()
+def no_transid(nom):
+    return queries.no_transid(nom)
+
+
+@app.template_filter()
+def format_pop_freq(st, alt):
+    """
+    Frequency of alt in a VEP allele:freq&allele:freq string, in percent
+    """
+    for allele_freq in st.split('&'):
+        a = allele_freq.split(':')
+        if len(a) == 2 and a[0] == alt:
+            return '%.3f%%' % (100*float(a[1]))
+    return ""
+
+
+@app.template_filter()
+def format_hotspot(hotspots):
+    html = ""
+    for hotspot in hotspots:
+        html = html + "<span class='filterwarn fusion-bad'>"+hotspot+"</span>"
+    return html
     
 
 @app.template_filter()
@@ -155,4 +184,15 @@ def format_comment(st):
 
 @app.template_filter()
 def basename(path):
-    return os.path.basename(path)
\ No newline at end of file
+    return os.path.basename(path)
+
+@app.template_filter()
+def human_date(value):
+    """
+    datetime or unix time as YYYY-MM-DD HH:MM
+    """
+    if not value:
+        return ""
+    if not isinstance(value, datetime):
+        value = datetime.fromtimestamp(float(value))
+    return value.strftime("%Y-%m-%d %H:%M")
\ No newline at end of file
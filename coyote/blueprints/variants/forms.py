@@ -1,3 +1,5 @@
+import threading
+
 from flask_wtf import FlaskForm
 from wtforms import StringField, BooleanField, IntegerField, FloatField
 from wtforms.validators import InputRequired, NumberRange, Optional
@@ -66,4 +68,24 @@ class FilterForm(FlaskForm):
     tumwgs = BooleanField()
     lymphoid = BooleanField()
     parp = BooleanField()
-    historic = BooleanField()
\ No newline at end of file
+    historic = BooleanField()
+
+
+# GeneForm classes by gene list names, created once and shared by all requests
+_gene_forms = {}
+_gene_forms_lock = threading.Lock()
+
+
+def gene_form(genelist_names) -> type:
+    """
+    FilterForm with a genelist_<name> BooleanField per gene list, in the given order
+    """
+    key = tuple(genelist_names)
+    form_class = _gene_forms.get(key)
+    if form_class is None:
+        with _gene_forms_lock:
+            form_class = _gene_forms.get(key)
+            if form_class is None:
+                fields = { "genelist_"+name: BooleanField() for name in key }
+                form_class = _gene_forms[key] = type("GeneForm", (FilterForm,), fields)
+    return form_class
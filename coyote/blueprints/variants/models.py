@@ -0,0 +1,230 @@
+"""
+Compact variant model for the SNV pipeline.
+
+Variant, Genotype and Consequence replace the nested BSON dicts from
+variants_idref. They keep dict style access (var["INFO"]["selected_CSQ"],
+csq.get("gnomAD_AF")) so util functions and templates work unchanged, but
+store known fields in __slots__ and consequences as a value list against a
+key schema shared by all consequences with the same VEP fields.
+"""
+import sys
+
+# Categorical values repeated on every row, interned so all rows share one string object
+INTERNED_FIELDS = frozenset(
+    [
+        "SYMBOL",
+        "IMPACT",
+        "BIOTYPE",
+        "CANONICAL",
+        "Feature_type",
+        "SYMBOL_SOURCE",
+        "STRAND",
+        "type",
+        "sample",
+        "GT",
+    ]
+)
+
+# key tuple -> {key: index}, shared by every Consequence with the same VEP fields
+_schemas = {}
+
+
+def _schema(keys: tuple) -> dict:
+    schema = _schemas.get(keys)
+    if schema is None:
+        schema = _schemas.setdefault(keys, {key: idx for idx, key in enumerate(keys)})
+    return schema
+
+
+def _intern(key, value):
+    if key in INTERNED_FIELDS and type(value) is str:
+        return sys.intern(value)
+    if key == "Consequence" and type(value) is list:
+        return [sys.intern(term) if type(term) is str else term for term in value]
+    return value
+
+
+class SlotRecord:
+    """
+    Dict style access to __slots__ fields. A slot that was never set behaves
+    like a missing key. Keys that are not slots go to an extra dict, created
+    on first use.
+    """
+
+    __slots__ = ("extra",)
+    FIELDS: tuple = ()
+    FIELD_SET: frozenset = frozenset()
+
+    def __init__(self, **fields):
+        self.extra = None
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_bson(cls, doc: dict):
+        rec = cls.__new__(cls)
+        extra = None
+        for key, value in doc.items():
+            if key in cls.FIELD_SET:
+                setattr(rec, key, _intern(key, value))
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        rec.extra = extra
+        return rec
+
+    def __getitem__(self, key):
+        if key in self.FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.FIELD_SET:
+            setattr(self, key, value)
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __contains__(self, key):
+        if key in self.FIELD_SET:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra is not None:
+            yield from self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def to_bson(self) -> dict:
+        return {key: _to_bson(value) for key, value in self.items()}
+
+
+class Genotype(SlotRecord):
+    """
+    One GT entry, case or control
+    """
+
+    __slots__ = ("type", "sample", "AF", "DP", "VD", "GT")
+    FIELDS = __slots__
+    FIELD_SET = frozenset(FIELDS)
+
+
+class Consequence:
+    """
+    One VEP consequence, values stored in a list indexed by a shared key schema
+    """
+
+    __slots__ = ("_schema", "_values")
+
+    def __init__(self, schema: dict, values: list):
+        self._schema = schema
+        self._values = values
+
+    @classmethod
+    def from_bson(cls, doc: dict) -> "Consequence":
+        return cls(_schema(tuple(doc)), [_intern(key, value) for key, value in doc.items()])
+
+    def __getitem__(self, key):
+        return self._values[self._schema[key]]
+
+    def __setitem__(self, key, value):
+        idx = self._schema.get(key)
+        if idx is not None:
+            self._values[idx] = value
+            return
+        self._schema = _schema(tuple(self._schema) + (key,))
+        self._values.append(value)
+
+    def __contains__(self, key):
+        return key in self._schema
+
+    def __iter__(self):
+        return iter(self._schema)
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default=None):
+        idx = self._schema.get(key)
+        if idx is None:
+            return default
+        return self._values[idx]
+
+    def keys(self):
+        return list(self._schema)
+
+    def items(self):
+        return list(zip(self._schema, self._values))
+
+    def to_bson(self) -> dict:
+        return {key: _to_bson(value) for key, value in self.items()}
+
+    def __getstate__(self):
+        return tuple(self._schema), self._values
+
+    def __setstate__(self, state):
+        keys, values = state
+        self._schema = _schema(keys)
+        self._values = values
+
+
+class Variant(SlotRecord):
+    """
+    One variants_idref document. INFO stays a dict since pipeline stages add
+    keys to it (selected_CSQ, HOTSPOT), but its CSQ list holds Consequences.
+    """
+
+    __slots__ = ("_id", "SAMPLE_ID", "CHROM", "POS", "REF", "ALT", "FILTER", "QUAL", "GT", "INFO")
+    FIELDS = __slots__
+    FIELD_SET = frozenset(FIELDS)
+
+    @classmethod
+    def from_bson(cls, doc: dict) -> "Variant":
+        var = super().from_bson(doc)
+        if "GT" in var:
+            var.GT = [Genotype.from_bson(gt) for gt in var.GT]
+        info = var.get("INFO")
+        if info is not None and "CSQ" in info:
+            csq_arr = info["CSQ"]
+            info["CSQ"] = [Consequence.from_bson(csq) for csq in csq_arr]
+            selected = info.get("selected_CSQ")
+            if selected is not None and not isinstance(selected, Consequence):
+                # Keep selected_CSQ the same object as its CSQ entry, as select_csq leaves it
+                for csq, converted in zip(csq_arr, info["CSQ"]):
+                    if csq is selected:
+                        info["selected_CSQ"] = converted
+                        break
+                else:
+                    info["selected_CSQ"] = Consequence.from_bson(selected)
+        return var
+
+
+def _to_bson(value):
+    if isinstance(value, (SlotRecord, Consequence)):
+        return value.to_bson()
+    if isinstance(value, dict):
+        return {key: _to_bson(val) for key, val in value.items()}
+    if isinstance(value, list):
+        return [_to_bson(val) for val in value]
+    return value
@@ -0,0 +1,404 @@
+"""
+Streaming SNV pipeline for list_variants.
+
+Variants flow from the variants cursor through a chain of generator stages,
+so rows rejected by cheap stages (popfreq, gene panels) never reach the
+expensive ones (annotation lookups). Stages needing the database work on
+chunks of rows, which batches canonical and annotation lookups.
+
+The stage order is set per group with `snv_pipeline` in the group config,
+falling back to SNV_PIPELINE_STAGES. Register new stages in STAGES.
+
+arun() runs the same stages on the async adapter (coyote.db.aio). Rows
+are fetched in one go and each stage gets the whole list, the lookups of
+select_csq, annotate and inflate are prefetched concurrently (PREFETCH)
+so the stages themselves never wait on the store.
+
+With an Offload extension (coyote/extensions/offload.py) consecutive
+OFFLOAD_STAGES run in forked children on slices of the rows, which send
+back the survivors and the INFO fields the stages set on them.
+"""
+import asyncio
+import functools
+import time
+
+from coyote.blueprints.variants import util
+from coyote.blueprints.variants.models import Variant
+
+# Stages that only need the fields in util.VARIANT_FILTER_FIELDS
+PARTIAL_STAGES = ("select_csq", "popfreq")
+# Stages without lookups of their own, run by offload children for large requests,
+# and the INFO fields they set
+OFFLOAD_STAGES = ("select_csq", "popfreq", "genepanel", "hotspot")
+OFFLOAD_FIELDS = ("selected_CSQ", "selected_CSQ_criteria", "HOTSPOT")
+
+
+class PipelineContext:
+    """
+    Per-request state shared by the stages
+    """
+
+    def __init__(self, store, chunk_size: int = 500, compact_model: bool = False, **params):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.compact_model = compact_model
+        self.offload = None
+        self.max_popfreq = float(params.get("max_popfreq", 1.0))
+        self.filter_genes = set(params.get("filter_genes") or [])
+        self.disp_pos = set(params.get("disp_pos") or [])
+        self.assay = params.get("assay")
+        self.subpanel = params.get("subpanel")
+        # gene -> canonical transcript, and all genes looked up so far
+        self.canonical = {}
+        self.canonical_checked = set()
+        # Prefetched by arun: id(variant) -> annotation tuple, _id -> full variant document
+        self.annotations = None
+        self.full_variants = None
+
+
+class StageStats:
+    """
+    Rows out of a stage and the time spent in it, upstream stages excluded
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = 0
+        self.cumulative = 0.0
+        self.seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {"stage": self.name, "rows": self.rows, "seconds": round(self.seconds, 6)}
+
+
+def chunks(rows, size: int):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def select_csq_stage(rows, ctx: PipelineContext):
+    """
+    Select a VEP consequence per variant, looking up canonical transcripts for new genes per chunk
+    """
+    for chunk in chunks(rows, ctx.chunk_size):
+        genes = protein_coding_genes(chunk) - ctx.canonical_checked
+        if genes:
+            ctx.canonical.update(ctx.store.get_canonical(list(genes)))
+            ctx.canonical_checked |= genes
+        for var in chunk:
+            var["INFO"]["selected_CSQ"], var["INFO"]["selected_CSQ_criteria"] = util.select_csq(
+                var["INFO"]["CSQ"], ctx.canonical
+            )
+            yield var
+
+
+def protein_coding_genes(variants) -> set:
+    return {
+        csq["SYMBOL"]
+        for var in variants
+        for csq in var["INFO"]["CSQ"]
+        if csq["BIOTYPE"] == "protein_coding"
+    }
+
+
+def popfreq_stage(rows, ctx: PipelineContext):
+    for var in rows:
+        if util.popfreq_pass(var["INFO"]["selected_CSQ"], var["ALT"], ctx.max_popfreq):
+            yield var
+
+
+def genepanel_stage(rows, ctx: PipelineContext):
+    """
+    Drop variants the template would not show for the checked gene lists and verification positions
+    """
+    if not ctx.filter_genes and not ctx.disp_pos:
+        yield from rows
+        return
+    for var in rows:
+        if ctx.filter_genes and var["INFO"]["selected_CSQ"]["SYMBOL"] not in ctx.filter_genes:
+            continue
+        if ctx.disp_pos and var["POS"] not in ctx.disp_pos:
+            continue
+        yield var
+
+
+def annotate_stage(rows, ctx: PipelineContext):
+    for chunk in chunks(rows, ctx.chunk_size):
+        if ctx.annotations is not None:
+            annotations = [ctx.annotations[id(var)] for var in chunk]
+        else:
+            annotations = ctx.store.get_global_annotations_batch(chunk, ctx.assay, ctx.subpanel)
+        for var, (global_annotations, classification, other_classification, interesting) in zip(
+            chunk, annotations
+        ):
+            var["global_annotations"] = global_annotations
+            var["classification"] = classification
+            var["other_classification"] = other_classification
+            var["annotations_interesting"] = interesting
+            yield var
+
+
+def hotspot_stage(rows, ctx: PipelineContext):
+    for var in rows:
+        yield util.hotspot_tag(var)
+
+
+def inflate_stage(rows, ctx: PipelineContext):
+    """
+    Replace partial variants with full documents, inserted after the PARTIAL_STAGES with lazy decode
+    """
+    for chunk in chunks(rows, ctx.chunk_size):
+        if ctx.full_variants is not None:
+            full_variants = ctx.full_variants
+        else:
+            full_variants = ctx.store.get_variants_by_ids([var["_id"] for var in chunk])
+        for var in util.inflate_variants(chunk, full_variants):
+            yield Variant.from_bson(var) if ctx.compact_model else var
+
+
+STAGES = {
+    "select_csq": select_csq_stage,
+    "popfreq": popfreq_stage,
+    "genepanel": genepanel_stage,
+    "annotate": annotate_stage,
+    "hotspot": hotspot_stage,
+    "inflate": inflate_stage,
+}
+
+DEFAULT_STAGES = ["select_csq", "popfreq", "genepanel", "annotate", "hotspot"]
+
+
+async def prefetch_canonical(rows: list, ctx: PipelineContext) -> None:
+    genes = protein_coding_genes(rows) - ctx.canonical_checked
+    if genes:
+        ctx.canonical.update(await ctx.store.get_canonical(list(genes)))
+        ctx.canonical_checked |= genes
+
+
+async def prefetch_annotations(rows: list, ctx: PipelineContext) -> None:
+    batches = list(chunks(rows, ctx.chunk_size))
+    results = await asyncio.gather(
+        *(
+            ctx.store.get_global_annotations_batch(batch, ctx.assay, ctx.subpanel)
+            for batch in batches
+        )
+    )
+    ctx.annotations = {
+        id(var): annotations
+        for batch, result in zip(batches, results)
+        for var, annotations in zip(batch, result)
+    }
+
+
+async def prefetch_full_variants(rows: list, ctx: PipelineContext) -> None:
+    ctx.full_variants = await ctx.store.get_variants_by_ids([var["_id"] for var in rows])
+
+
+# Async lookups run by arun before the stage, filling the PipelineContext
+PREFETCH = {
+    "select_csq": prefetch_canonical,
+    "annotate": prefetch_annotations,
+    "inflate": prefetch_full_variants,
+}
+
+
+def run_offloaded(rows: list, ctx: PipelineContext, names: list) -> list:
+    """
+    Child side of offload_stage: the stages on rows, then (index, OFFLOAD_FIELDS) of each
+    survivor, selected_CSQ as its index in INFO.CSQ
+    """
+    index = {id(var): idx for idx, var in enumerate(rows)}
+    survivors = rows
+    for name in names:
+        survivors = STAGES[name](survivors, ctx)
+    decisions = []
+    for var in survivors:
+        info = var["INFO"]
+        fields = {key: info[key] for key in OFFLOAD_FIELDS if key in info}
+        if "selected_CSQ" in fields:
+            fields["selected_CSQ"] = next(
+                idx for idx, csq in enumerate(info["CSQ"]) if csq is info["selected_CSQ"]
+            )
+        decisions.append((index[id(var)], fields))
+    return decisions
+
+
+def offload_stage(rows, ctx: PipelineContext, names: list):
+    """
+    OFFLOAD_STAGES names run by offload children on slices of rows, their decisions applied here
+    """
+    rows = list(rows)
+    if "select_csq" in names:
+        # Looked up for all rows before forking, as prefetch_canonical does, the children cannot query
+        genes = protein_coding_genes(rows) - ctx.canonical_checked
+        if genes:
+            ctx.canonical.update(ctx.store.get_canonical(list(genes)))
+            ctx.canonical_checked |= genes
+    task = functools.partial(run_offloaded, ctx=ctx, names=names)
+    for part, decisions in ctx.offload.map_slices(task, rows):
+        for idx, fields in decisions:
+            var = part[idx]
+            info = var["INFO"]
+            if "selected_CSQ" in fields:
+                fields["selected_CSQ"] = info["CSQ"][fields["selected_CSQ"]]
+            info.update(fields)
+            yield var
+
+
+class SNVPipeline:
+    """
+    Fetch variants for a query and run them through the configured stages
+    """
+
+    def __init__(
+        self,
+        store,
+        stages: list = None,
+        chunk_size: int = 500,
+        lazy_decode: bool = False,
+        compact_model: bool = False,
+        offload=None,
+    ):
+        stages = list(stages or DEFAULT_STAGES)
+        unknown = [name for name in stages if name not in STAGES]
+        if unknown:
+            raise ValueError(f"Unknown SNV pipeline stages: {unknown}")
+        if "select_csq" not in stages or stages.index("select_csq") != 0:
+            raise ValueError("SNV pipeline must start with select_csq")
+        if lazy_decode:
+            partial = 0
+            while partial < len(stages) and stages[partial] in PARTIAL_STAGES:
+                partial += 1
+            stages.insert(partial, "inflate")
+
+        self.store = store
+        self.stages = stages
+        self.chunk_size = chunk_size
+        self.lazy_decode = lazy_decode
+        self.compact_model = compact_model
+        # Offload extension when this request is large enough to offload, else None
+        self.offload = offload
+        self.stats = []
+
+    @classmethod
+    def from_config(cls, store, config, group: dict = None, offload=None) -> "SNVPipeline":
+        stages = (group or {}).get("snv_pipeline") or config.get("SNV_PIPELINE_STAGES")
+        return cls(
+            store,
+            stages=stages,
+            chunk_size=config.get("SNV_PIPELINE_CHUNK_SIZE", 500),
+            lazy_decode=config.get("VARIANTS_LAZY_DECODE", False),
+            compact_model=config.get("VARIANTS_COMPACT_MODEL", False),
+            offload=offload,
+        )
+
+    def plan(self) -> list:
+        """
+        Stage names in order, consecutive OFFLOAD_STAGES grouped in a tuple when offloading
+        """
+        if self.offload is None:
+            return list(self.stages)
+        steps = []
+        for name in self.stages:
+            if name not in OFFLOAD_STAGES:
+                steps.append(name)
+            elif steps and isinstance(steps[-1], tuple):
+                steps[-1] += (name,)
+            else:
+                steps.append((name,))
+        return steps
+
+    def run(self, query: dict, skip: int = 0, limit: int = 0, **params) -> list:
+        """
+        Variants passing all stages. params: max_popfreq, filter_genes, disp_pos, assay, subpanel.
+        skip and limit select a page of the fetched variants, before filtering.
+        """
+        ctx = PipelineContext(
+            self.store, chunk_size=self.chunk_size, compact_model=self.compact_model, **params
+        )
+        fields = util.VARIANT_FILTER_FIELDS if self.lazy_decode else None
+        rows = self.store.get_case_variants(query, fields=fields, skip=skip, limit=limit)
+        if self.compact_model and not self.lazy_decode:
+            rows = map(Variant.from_bson, rows)
+
+        ctx.offload = self.offload
+        self.stats = [StageStats("fetch")]
+        rows = self._metered(rows, self.stats[0])
+        for step in self.plan():
+            if isinstance(step, tuple):
+                stat = StageStats("+".join(step))
+                stage = offload_stage(rows, ctx, list(step))
+            else:
+                stat = StageStats(step)
+                stage = STAGES[step](rows, ctx)
+            self.stats.append(stat)
+            rows = self._metered(stage, stat)
+
+        variants = list(rows)
+        upstream = 0.0
+        for stat in self.stats:
+            stat.seconds = stat.cumulative - upstream
+            upstream = stat.cumulative
+        return variants
+
+    async def arun(self, query: dict, skip: int = 0, limit: int = 0, **params) -> list:
+        """
+        run() with a store from coyote.db.aio. Stage stats are per stage, prefetching included.
+        """
+        ctx = PipelineContext(
+            self.store, chunk_size=self.chunk_size, compact_model=self.compact_model, **params
+        )
+        fields = util.VARIANT_FILTER_FIELDS if self.lazy_decode else None
+        start = time.perf_counter()
+        rows = await self.store.get_case_variants(query, fields=fields, skip=skip, limit=limit)
+        if self.compact_model and not self.lazy_decode:
+            rows = [Variant.from_bson(row) for row in rows]
+        self.stats = [StageStats("fetch")]
+        self.stats[0].rows = len(rows)
+        self.stats[0].seconds = time.perf_counter() - start
+
+        ctx.offload = self.offload
+        for step in self.plan():
+            names = step if isinstance(step, tuple) else (step,)
+            stat = StageStats("+".join(names))
+            self.stats.append(stat)
+            start = time.perf_counter()
+            for name in names:
+                if name in PREFETCH:
+                    await PREFETCH[name](rows, ctx)
+            if isinstance(step, tuple):
+                # Waits for the children in a thread, the loop serves other requests meanwhile
+                rows = await asyncio.get_running_loop().run_in_executor(
+                    None, list, offload_stage(rows, ctx, list(step))
+                )
+            else:
+                rows = list(STAGES[step](rows, ctx))
+            stat.rows = len(rows)
+            stat.seconds = time.perf_counter() - start
+        return rows
+
+    def stats_summary(self) -> list:
+        return [stat.as_dict() for stat in self.stats]
+
+    @staticmethod
+    def _metered(rows, stat: StageStats):
+        """
+        Count rows out of a stage and time spent producing them, upstream included
+        """
+        rows = iter(rows)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                stat.cumulative += time.perf_counter() - start
+                return
+            stat.cumulative += time.perf_counter() - start
+            stat.rows += 1
+            yield row
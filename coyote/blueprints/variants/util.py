@@ -1,12 +1,16 @@
 from flask import current_app as app
 from collections import defaultdict
+import copy
+import hashlib
+import json
 import re
 
 def get_group_defaults(group):
     """
-    Return Default dict (either group defaults or coyote defaults) and setting per sample
+    Return Default dict (either group defaults or coyote defaults) and setting per sample.
+    A copy, callers change it per request.
     """
-    settings = app.config["GROUP_FILTERS"]
+    settings = copy.deepcopy(app.config["GROUP_FILTERS"])
     # Get group specific settings
     if group is not None:
         settings['error_cov']              = int(group.get('error_cov', settings["error_cov"]))
@@ -40,6 +44,52 @@ def get_sample_settings(sample,settings):
     sample_settings["max_cnv_size"]        = int(float(sample.get("max_cnv_size", settings["default_max_cnv_size"])))
     return sample_settings
 
+def get_row_budget(group):
+    """
+    Rows and estimated megabytes a request may materialize, ROW_BUDGET overridden by
+    row_budget in the group config
+    """
+    budget = dict(app.config["ROW_BUDGET"])
+    if group is not None:
+        budget.update(group.get("row_budget", {}))
+    return budget
+
+def plan_paging(total, est_bytes, limit, memory_mb, page_size, page):
+    """
+    Paging for a result of total rows, None if it fits the budget
+    """
+    if total <= limit and est_bytes <= memory_mb * 1024 * 1024:
+        return None
+    pages = max(1, -(-total // page_size))
+    page = min(max(page, 0), pages - 1)
+    return {
+        "page": page,
+        "pages": pages,
+        "page_size": page_size,
+        "skip": page * page_size,
+        "total": total,
+        "reason": "rows" if total > limit else "memory",
+    }
+
+def variant_page_key( sample, group_name, sample_settings, filter_genes, filter_cnveffects, page ):
+    """
+    Single-flight key of a variant page: sample and its data version, filter state and page
+    """
+    state = {
+        "sample": sample["name"],
+        # A reloaded sample gets a new _id
+        "version": [
+            str(sample["_id"]),
+            str(sample.get("time_modified", sample.get("time_added"))),
+        ],
+        "group": group_name,
+        "settings": sample_settings,
+        "genes": sorted(filter_genes),
+        "cnveffects": filter_cnveffects,
+        "page": page,
+    }
+    return hashlib.sha256( json.dumps( state, sort_keys=True, default=str ).encode() ).hexdigest()
+
 def get_assay_from_sample( smp ):
     if "exome_trio" in smp["groups"]:
         return "exome"
@@ -232,38 +282,96 @@ def popfreq_filter(variants, max_freq):
     filtered_variants = []
 
     for v in variants:
-        allele = v["ALT"]
-        exac       = parse_allele_freq( v["INFO"]["selected_CSQ"].get("ExAC_MAF"), v["ALT"] )
-        thousand_g = parse_allele_freq( v["INFO"]["selected_CSQ"].get("GMAF"),     v["ALT"] )
-        gnomad     = v["INFO"]["selected_CSQ"].get("gnomAD_AF", 0)
-        gnomad_genome     = v["INFO"]["selected_CSQ"].get("gnomADg_AF", 0)
-        if gnomad == "." or gnomad == "":
-            gnomad = -1
-        if gnomad_genome == "." or gnomad_genome == "":
-            gnomad_genome = -1
-
-        if max_freq < 1 and ( exac > max_freq or thousand_g > max_freq or float(gnomad) > max_freq or float(gnomad_genome) > max_freq ):
-            pass
-        else:
+        if popfreq_pass(v["INFO"]["selected_CSQ"], v["ALT"], max_freq):
             filtered_variants.append(v)
 
     return filtered_variants
 
+def popfreq_pass(csq, allele, max_freq):
+    """
+    True if the selected consequence of a variant is below max population frequency
+    """
+    if max_freq >= 1:
+        return True
+    exac       = parse_allele_freq( csq.get("ExAC_MAF"), allele )
+    thousand_g = parse_allele_freq( csq.get("GMAF"),     allele )
+    gnomad     = csq.get("gnomAD_AF", 0)
+    gnomad_genome     = csq.get("gnomADg_AF", 0)
+    if gnomad == "." or gnomad == "":
+        gnomad = -1
+    if gnomad_genome == "." or gnomad_genome == "":
+        gnomad_genome = -1
+
+    return not (
+        exac > max_freq
+        or thousand_g > max_freq
+        or float(gnomad) > max_freq
+        or float(gnomad_genome) > max_freq
+    )
+
+def parse_allele_freq(freq, allele):
+    """
+    Get frequency for allele from VEP style allele:freq&allele:freq strings
+    """
+    if not freq:
+        return 0
+    for allele_freq in freq.split('&'):
+        a = allele_freq.split(':')
+        if len(a) == 2 and a[0] == allele:
+            return float(a[1])
+    return 0
+
+# Fields needed to select a consequence and filter on population frequency
+VARIANT_FILTER_FIELDS = [
+    "ALT",
+    "INFO.CSQ.SYMBOL",
+    "INFO.CSQ.Feature",
+    "INFO.CSQ.IMPACT",
+    "INFO.CSQ.CANONICAL",
+    "INFO.CSQ.BIOTYPE",
+    "INFO.CSQ.ExAC_MAF",
+    "INFO.CSQ.GMAF",
+    "INFO.CSQ.gnomAD_AF",
+    "INFO.CSQ.gnomADg_AF",
+]
+
+def inflate_variants(variants, full_variants):
+    """
+    Swap variants fetched with VARIANT_FILTER_FIELDS for their full documents,
+    keeping the selected CSQ and its criteria
+    """
+    inflated = []
+    for var in variants:
+        full = full_variants[var["_id"]]
+        selected = var["INFO"]["selected_CSQ"]
+        csq_idx = next( idx for idx, csq in enumerate(var["INFO"]["CSQ"]) if csq is selected )
+        full["INFO"]["selected_CSQ"] = full["INFO"]["CSQ"][csq_idx]
+        full["INFO"]["selected_CSQ_criteria"] = var["INFO"]["selected_CSQ_criteria"]
+        inflated.append(full)
+    return inflated
+
 def hotspot_variant( variants):
     hotspots = []
     for variant in variants:
-            for csq in variant['INFO']['selected_CSQ']:
-                if "hotspot_OID" in csq:
-                    if "COS" in variant['INFO']['selected_CSQ'][csq]:
-                        csq1 = csq.split('_')
-                        csq2 = re.sub(r"hotspot", r"", csq1[0])
-                        hotspot = variant['INFO'].get('HOTSPOT', [])
-                        hotspot.append(csq2)
-                        variant['INFO']['HOTSPOT'] = hotspot
+            hotspot_tag(variant)
             hotspots.append(variant)
 
     return hotspots
 
+def hotspot_tag( variant ):
+    """
+    Add COSMIC hotspot names from the selected CSQ to INFO.HOTSPOT
+    """
+    for csq in variant['INFO']['selected_CSQ']:
+        if "hotspot_OID" in csq:
+            if "COS" in variant['INFO']['selected_CSQ'][csq]:
+                csq1 = csq.split('_')
+                csq2 = re.sub(r"hotspot", r"", csq1[0])
+                hotspot = variant['INFO'].get('HOTSPOT', [])
+                hotspot.append(csq2)
+                variant['INFO']['HOTSPOT'] = hotspot
+    return variant
+
 def select_csq(csq_arr, canonical):
 
     db_canonical = -1
@@ -6,17 +6,21 @@ from flask import abort
 from flask import current_app as app
 from flask import redirect, render_template, request, url_for, send_from_directory
 from flask_login import current_user, login_required
-from pprint import pformat
+import asyncio
+import logging
+from pymongo.errors import ExecutionTimeout
 
-from coyote.blueprints.variants.forms import FilterForm
-from wtforms import BooleanField
+from coyote.blueprints.variants.forms import gene_form
 from wtforms.validators import Optional
-from coyote.extensions import store
+from coyote.extensions import store, async_store, instrumentation, single_flight, offload, app_log
 from coyote.blueprints.variants import variants_bp
 from coyote.blueprints.variants.varqueries import build_query
 from coyote.blueprints.variants import varqueries_notbad
 from coyote.blueprints.variants import util
 from coyote.blueprints.variants import filters
+from coyote.blueprints.variants.pipeline import SNVPipeline
+
+LOG = logging.getLogger(__name__)
 
 @variants_bp.route('/sample/<string:id>', methods=['GET', 'POST'])
 @login_required
@@ -31,9 +35,8 @@ def list_variants(id):
     assay      = util.get_assay_from_sample( sample )
     subpanel   = sample.get('subpanel')
 
-    app.logger.info(app.config["GROUP_CONFIGS"]) # get group config from app config instead
-    app.logger.info(f"the sample has these groups {smp_grp}")
-    app.logger.info(f"this is the group from collection {group}")
+    LOG.debug("Sample %s of group %s", sample["name"], smp_grp)
+    app_log.payload(LOG, "group_config", "Config of group %s: %s", smp_grp, group)
     #group = store.get_sample_groups( sample["groups"][0] ) # this is the old way of getting group config from mongodb
 
     ## GENEPANELS ##
@@ -48,11 +51,10 @@ def list_variants(id):
                 settings["default_checked_genelists"] = { "genelist_"+sample['subpanel']:1 }
     # Save new filter settings if submitted
     # Inherit FilterForm, pass all genepanels from mongodb, set as boolean, NOW IT IS DYNAMIC!
-    class GeneForm(FilterForm):
-        pass
-    for panel in genelists_assay:
-        if panel['type'] == 'genelist':
-            setattr(GeneForm, "genelist_"+panel['name'], BooleanField())
+    # One class per set of gene lists, built once rather than per request
+    GeneForm = gene_form(
+        [ panel['name'] for panel in genelists_assay if panel['type'] == 'genelist' ]
+    )
     form = GeneForm()
     ###########################################################################
 
@@ -94,8 +96,59 @@ def list_variants(id):
     form.min_cnv_size.data  = sample_settings["min_cnv_size"]
     form.max_cnv_size.data  = sample_settings["max_cnv_size"]
    
-    ## SNV FILTRATION STARTS HERE ! ##
-    ################################## 
+    ## SNVs, CNVs, fusions and biomarkers ##
+    # Concurrent requests for the same sample, filters and page share one computation
+    page = request.args.get( "page", 0, type=int )
+    flight_key = util.variant_page_key(
+        sample, smp_grp, sample_settings, filter_genes, filter_cnveffects, page
+    )
+    # With VARIANTS_ASYNC the sections are queried concurrently on the motor adapter's event loop
+    context_args = (
+        sample,
+        group,
+        assay,
+        subpanel,
+        sample_settings,
+        filter_conseq,
+        filter_genes,
+        filter_cnveffects,
+        page,
+    )
+    if app.config["VARIANTS_ASYNC"]:
+        compute = lambda: async_store.run( assemble_variants_context_async( *context_args ) )
+    else:
+        compute = lambda: assemble_variants_context( *context_args )
+    with instrumentation.span("assemble"):
+        data = single_flight.do( flight_key, compute )
+
+    # this is to allow old samples to view plots, cnv + cnvprofile clash. Old assays used cnv as the entry for the plot, newer assays use cnv for path to cnv-file that was loaded.
+    if "cnv" in sample:
+        if sample["cnv"].lower().endswith(('.png', '.jpg', '.jpeg')):
+            # A copy, the sample document is shared through the cache
+            sample = dict( sample, cnvprofile=sample["cnv"] )                                      
+
+    with instrumentation.span("render"):
+        return render_template(
+            "list_variants_vep.html",
+            checked_genelists=genelist_filter,
+            genelists_assay=genelists_assay,
+            sample=sample,
+            sample_ids=sample_ids,
+            assay=assay,
+            hidden_comments=has_hidden_comments,
+            form=form,
+            dispgenes=filter_genes,
+            settings=settings,
+            sizefilter=sample_settings["max_cnv_size"],
+            sizefilter_min=sample_settings["min_cnv_size"],
+            **data,
+        )
+
+
+def build_variant_query( sample, group, assay, sample_settings, filter_conseq ):
+    """
+    SNV query for the sample's filters, and the positions to show for verification samples
+    """
     ## The query should really be constructed according to some configed rules for a specific assay
     query = build_query(
         assay,
@@ -109,34 +162,92 @@ def list_variants(id):
             "filter_conseq": filter_conseq,
         },
     )
-    query2 = varqueries_notbad.build_query(
-        {
-            "id": str(sample["_id"]),
-            "max_freq": sample_settings["max_freq"],
-            "min_freq": sample_settings["min_freq"],
-            "min_depth": sample_settings["min_depth"],
-            "min_reads": sample_settings["min_reads"],
-            "max_popfreq": sample_settings["max_popfreq"],
-            "filter_conseq": filter_conseq,
-        },
-        group
-    )
-    app.logger.info("this is the old varquery: %s", pformat(query))
-    app.logger.info("this is the new varquery: %s", pformat(query2))
-    variants_iter = store.get_case_variants( query )
-    # Find all genes matching the query
-    variants, genes = util.get_protein_coding_genes( variants_iter )
-    # Add blacklist data, ADD ALL variants_iter via the store please...
-    #util.add_blacklist_data( variants, assay )
-    # Get canonical transcripts for the genes from database
-    canonical_dict = store.get_canonical( list(genes.keys()) )
-    # Select a VEP consequence for each variant
-    for var_idx, var in enumerate(variants):
-        variants[var_idx]["INFO"]["selected_CSQ"], variants[var_idx]["INFO"]["selected_CSQ_criteria"] = util.select_csq( var["INFO"]["CSQ"], canonical_dict )
-        variants[var_idx]["global_annotations"], variants[var_idx]["classification"], variants[var_idx]["other_classification"], variants[var_idx]["annotations_interesting"] = store.get_global_annotations( variants[var_idx], assay, subpanel ) 
-    # Filter by population frequency
-    variants = util.popfreq_filter( variants, float(sample_settings["max_popfreq"]) )
-    variants = util.hotspot_variant(variants)
+    def query2():
+        return varqueries_notbad.build_query(
+            {
+                "id": str(sample["_id"]),
+                "max_freq": sample_settings["max_freq"],
+                "min_freq": sample_settings["min_freq"],
+                "min_depth": sample_settings["min_depth"],
+                "min_reads": sample_settings["min_reads"],
+                "max_popfreq": sample_settings["max_popfreq"],
+                "filter_conseq": filter_conseq,
+            },
+            group
+        )
+    # The comparison query is only built when the payload is logged
+    app_log.payload(LOG, "varquery", "Variant query: %s, with varqueries_notbad: %s", query, query2)
+    # this is in config, but needs to be tested (2024-05-14) with a HD-sample of relevant name
+    disp_pos = []
+    if "verif_samples" in group:
+        if sample["name"] in group["verif_samples"]:
+            disp_pos = group["verif_samples"][sample["name"]]
+    return query, disp_pos
+
+
+def assemble_variants_context(
+    sample,
+    group,
+    assay,
+    subpanel,
+    sample_settings,
+    filter_conseq,
+    filter_genes,
+    filter_cnveffects,
+    page,
+):
+    """
+    Everything list_variants shows that comes from the variant, CNV, fusion and biomarker
+    collections. The result is shared between concurrent requests and must not be modified.
+    """
+    ## SNV FILTRATION STARTS HERE ! ##
+    ################################## 
+    query, disp_pos = build_variant_query( sample, group, assay, sample_settings, filter_conseq )
+    # Sections whose queries run past MONGO_TIME_BUDGETS are left out and listed in a banner
+    timed_out = []
+    # Samples matching more variants than the group's row budget, or its estimated memory,
+    # are shown a page at a time
+    row_budget = util.get_row_budget( group )
+    paging = None
+    variants = []
+    try:
+        n_variants = store.count_case_variants( query )
+        instrumentation.rows( "variants_matched", n_variants )
+        paging = util.plan_paging(
+            n_variants,
+            n_variants * store.variant_size_estimate(),
+            row_budget["variants"],
+            row_budget["memory_mb"],
+            row_budget["page_size"],
+            page,
+        )
+        if paging:
+            app.logger.warning(
+                f"{sample['name']}: {n_variants} variants exceed the row budget {row_budget}, "
+                "paging"
+            )
+        # Select CSQ, filter on popfreq and gene panels, then annotate and tag hotspots for the
+        # survivors. Large requests run the CPU bound stages in offload children
+        rows = paging["page_size"] if paging else n_variants
+        snv_pipeline = SNVPipeline.from_config(
+            store, app.config, group, offload=offload if offload.wanted( rows ) else None
+        )
+        variants = snv_pipeline.run(
+            query,
+            skip=paging["skip"] if paging else 0,
+            limit=paging["page_size"] if paging else 0,
+            max_popfreq=sample_settings["max_popfreq"],
+            filter_genes=filter_genes,
+            disp_pos=disp_pos,
+            assay=assay,
+            subpanel=subpanel,
+        )
+        app.logger.info("SNV pipeline stages: %s", snv_pipeline.stats_summary())
+        for stage in snv_pipeline.stats:
+            instrumentation.record( f"snv_{stage.name}", stage.seconds )
+        instrumentation.rows( "variants", len(variants) )
+    except ExecutionTimeout:
+        section_timed_out( "SNVs", sample, timed_out )
     ### SNV FILTRATION ENDS HERE ###
 
     # LOWCOV data, very computationally intense for samples with many regions
@@ -153,17 +264,45 @@ def list_variants(id):
     cnvwgs_iter_n = False
     biomarkers_iter = False
     transloc_iter = False
-    if group != None and "DNA" in group:
-        if group["DNA"]["CNV"]:
-            cnvwgs_iter = list(store.get_sample_cnvs(sample_id=str(sample["_id"])))
-            if filter_cnveffects:
-                cnvwgs_iter = util.cnvtype_variant(cnvwgs_iter, filter_cnveffects )
-            cnvwgs_iter = util.cnv_organizegenes( cnvwgs_iter )
-            cnvwgs_iter_n = list(store.get_sample_cnvs(sample_id=str(sample["_id"]),normal=True))
-        if group["DNA"]["OTHER"]:
-            biomarkers_iter = store.get_sample_other( sample_id=str(sample["_id"] ))
-        if group["DNA"]["FUSIONS"]:
-            transloc_iter = store.get_sample_translocations( sample_id=str(sample["_id"] ))
+    cnv_total = 0
+    with instrumentation.span("cnv"):
+        if group != None and "DNA" in group:
+            if group["DNA"]["CNV"]:
+                try:
+                    # Beyond the budget only the first CNVs are shown, with a banner
+                    cnv_total = store.count_sample_cnvs( sample_id=str(sample["_id"]) )
+                    cnvwgs_iter = list(
+                        store.get_sample_cnvs(
+                            sample_id=str(sample["_id"]), limit=row_budget["cnvs"]
+                        )
+                    )
+                    instrumentation.rows( "cnvs", len(cnvwgs_iter) )
+                    if filter_cnveffects:
+                        cnvwgs_iter = util.cnvtype_variant(cnvwgs_iter, filter_cnveffects )
+                    cnvwgs_iter = util.cnv_organizegenes( cnvwgs_iter )
+                    cnvwgs_iter_n = list(
+                        store.get_sample_cnvs(
+                            sample_id=str(sample["_id"]), normal=True, limit=row_budget["cnvs"]
+                        )
+                    )
+                except ExecutionTimeout:
+                    cnvwgs_iter = cnvwgs_iter_n = False
+                    section_timed_out( "CNVs", sample, timed_out )
+            # Fetched here rather than while rendering, so a timeout only loses its own section
+            if group["DNA"]["OTHER"]:
+                try:
+                    biomarkers_iter = list(store.get_sample_other( sample_id=str(sample["_id"] )))
+                except ExecutionTimeout:
+                    biomarkers_iter = False
+                    section_timed_out( "biomarkers", sample, timed_out )
+            if group["DNA"]["FUSIONS"]:
+                try:
+                    transloc_iter = list(
+                        store.get_sample_translocations( sample_id=str(sample["_id"] ) )
+                    )
+                except ExecutionTimeout:
+                    transloc_iter = False
+                    section_timed_out( "fusions", sample, timed_out )
     #################################################
 
     ## "AI"-text depending on what analysis has been done. Add translocs and cnvs if marked as interesting (HRD and MSI?)
@@ -173,8 +312,154 @@ def list_variants(id):
     #ai_text, conclusion = util.generate_ai_text( assay, variants, filter_genes, genelist_filter, sample["groups"][0] )
     ## translocations (DNA fusions) and copy number variation. Works for solid so far, should work for myeloid, lymphoid
     if (assay == "solid" ):
-        transloc_iter_ai   = store.get_sample_translocations( sample_id=str(sample["_id"] ))
-        biomarkers_iter_ai = store.get_sample_other( sample_id=str(sample["_id"] ))
+        with instrumentation.span("ai_text"):
+            try:
+                transloc_iter_ai   = store.get_sample_translocations( sample_id=str(sample["_id"] ))
+                biomarkers_iter_ai = store.get_sample_other( sample_id=str(sample["_id"] ))
+                smp_group          = sample["groups"][0]
+                ai_text_transloc   = util.generate_ai_text_nonsnv(
+                    assay, transloc_iter_ai, smp_group, "transloc"
+                )
+                ai_text_cnv        = util.generate_ai_text_nonsnv(
+                    assay, cnvwgs_iter, smp_group, "cnv"
+                )
+                ai_text_bio        = util.generate_ai_text_nonsnv(
+                    assay, biomarkers_iter_ai, smp_group, "bio"
+                )
+                ai_text            = ai_text+ai_text_transloc+ai_text_cnv+ai_text_bio+conclusion
+            except ExecutionTimeout:
+                section_timed_out( "suggested text", sample, timed_out )
+    else:
+        ai_text = ai_text + conclusion
+
+    return dict(
+        variants=variants,
+        disp_pos=disp_pos,
+        low_cov=low_cov,
+        ai_text=ai_text,
+        cnvwgs=cnvwgs_iter,
+        cnvwgs_n=cnvwgs_iter_n,
+        transloc=transloc_iter,
+        biomarker=biomarkers_iter,
+        paging=paging,
+        timed_out=timed_out,
+        cnv_total=cnv_total,
+        cnv_limit=row_budget["cnvs"],
+    )
+
+
+async def assemble_variants_context_async(
+    sample,
+    group,
+    assay,
+    subpanel,
+    sample_settings,
+    filter_conseq,
+    filter_genes,
+    filter_cnveffects,
+    page,
+):
+    """
+    assemble_variants_context on the motor adapter, run with async_store.run. The SNV,
+    CNV, biomarker and fusion sections, and the documents for the suggested text, are
+    queried concurrently.
+    """
+    query, disp_pos = build_variant_query( sample, group, assay, sample_settings, filter_conseq )
+    timed_out = []
+    row_budget = util.get_row_budget( group )
+    sample_id = str(sample["_id"])
+    dna = group["DNA"] if group != None and "DNA" in group else {}
+
+    async def section( name, coro, default ):
+        try:
+            return await coro
+        except ExecutionTimeout:
+            section_timed_out( name, sample, timed_out )
+            return default
+
+    async def snvs():
+        n_variants, size_estimate = await asyncio.gather(
+            async_store.count_case_variants( query ), async_store.variant_size_estimate()
+        )
+        instrumentation.rows( "variants_matched", n_variants )
+        paging = util.plan_paging(
+            n_variants,
+            n_variants * size_estimate,
+            row_budget["variants"],
+            row_budget["memory_mb"],
+            row_budget["page_size"],
+            page,
+        )
+        if paging:
+            app.logger.warning(
+                f"{sample['name']}: {n_variants} variants exceed the row budget {row_budget}, "
+                "paging"
+            )
+        rows = paging["page_size"] if paging else n_variants
+        snv_pipeline = SNVPipeline.from_config(
+            async_store, app.config, group, offload=offload if offload.wanted( rows ) else None
+        )
+        variants = await snv_pipeline.arun(
+            query,
+            skip=paging["skip"] if paging else 0,
+            limit=paging["page_size"] if paging else 0,
+            max_popfreq=sample_settings["max_popfreq"],
+            filter_genes=filter_genes,
+            disp_pos=disp_pos,
+            assay=assay,
+            subpanel=subpanel,
+        )
+        app.logger.info("SNV pipeline stages: %s", snv_pipeline.stats_summary())
+        for stage in snv_pipeline.stats:
+            instrumentation.record( f"snv_{stage.name}", stage.seconds )
+        instrumentation.rows( "variants", len(variants) )
+        return variants, paging
+
+    async def cnvs():
+        if not dna.get("CNV"):
+            return 0, False, False
+        # Beyond the budget only the first CNVs are shown, with a banner
+        cnv_total, cnvwgs, cnvwgs_n = await asyncio.gather(
+            async_store.count_sample_cnvs( sample_id=sample_id ),
+            async_store.get_sample_cnvs( sample_id=sample_id, limit=row_budget["cnvs"] ),
+            async_store.get_sample_cnvs(
+                sample_id=sample_id, normal=True, limit=row_budget["cnvs"]
+            ),
+        )
+        instrumentation.rows( "cnvs", len(cnvwgs) )
+        if filter_cnveffects:
+            cnvwgs = util.cnvtype_variant( cnvwgs, filter_cnveffects )
+        return cnv_total, util.cnv_organizegenes( cnvwgs ), cnvwgs_n
+
+    async def optional( enabled, query ):
+        # Sections the group does not show are False, as in assemble_variants_context
+        return await query() if enabled else False
+
+    async def ai_documents():
+        if assay != "solid":
+            return None
+        return await asyncio.gather(
+            async_store.get_sample_translocations( sample_id=sample_id ),
+            async_store.get_sample_other( sample_id=sample_id ),
+        )
+
+    biomarkers = lambda: async_store.get_sample_other( sample_id=sample_id )
+    fusions = lambda: async_store.get_sample_translocations( sample_id=sample_id )
+    snv_section, cnv_section, biomarkers_iter, transloc_iter, ai_docs = await asyncio.gather(
+        section( "SNVs", snvs(), ( [], None ) ),
+        section( "CNVs", cnvs(), ( 0, False, False ) ),
+        section( "biomarkers", optional( dna.get("OTHER"), biomarkers ), False ),
+        section( "fusions", optional( dna.get("FUSIONS"), fusions ), False ),
+        section( "suggested text", ai_documents(), None ),
+    )
+    variants, paging = snv_section
+    cnv_total, cnvwgs_iter, cnvwgs_iter_n = cnv_section
+
+    ## "AI"-text for solid, as in assemble_variants_context
+    ai_text = ""
+    conclusion = ""
+    if ai_docs is not None:
+        transloc_iter_ai, biomarkers_iter_ai = ai_docs
         ai_text_transloc   = util.generate_ai_text_nonsnv( assay, transloc_iter_ai, sample["groups"][0], "transloc" )
         ai_text_cnv        = util.generate_ai_text_nonsnv( assay, cnvwgs_iter, sample["groups"][0], "cnv" )
         ai_text_bio        = util.generate_ai_text_nonsnv( assay, biomarkers_iter_ai, sample["groups"][0], "bio" )
@@ -182,40 +467,31 @@ def list_variants(id):
     else:
         ai_text = ai_text + conclusion
 
-    # this is in config, but needs to be tested (2024-05-14) with a HD-sample of relevant name
-    disp_pos = []
-    if "verif_samples" in group:
-        if sample["name"] in group["verif_samples"]:
-            disp_pos = group["verif_samples"][sample["name"]]
-    # this is to allow old samples to view plots, cnv + cnvprofile clash. Old assays used cnv as the entry for the plot, newer assays use cnv for path to cnv-file that was loaded.
-    if "cnv" in sample:
-        if sample["cnv"].lower().endswith(('.png', '.jpg', '.jpeg')):
-            sample["cnvprofile"] = sample["cnv"]                                      
-
-    return render_template(
-        "list_variants_vep.html",
-        checked_genelists=genelist_filter,
-        genelists_assay=genelists_assay,
+    return dict(
         variants=variants,
         disp_pos=disp_pos,
-        sample=sample,
-        sample_ids=sample_ids,
-        assay=assay,
-        hidden_comments=has_hidden_comments,
-        form=form,
-        dispgenes=filter_genes,
-        low_cov=low_cov,
+        low_cov={},
         ai_text=ai_text,
-        settings=settings,
         cnvwgs=cnvwgs_iter,
         cnvwgs_n=cnvwgs_iter_n,
-        sizefilter=sample_settings["max_cnv_size"],
-        sizefilter_min=sample_settings["min_cnv_size"],
         transloc=transloc_iter,
         biomarker=biomarkers_iter,
+        paging=paging,
+        timed_out=timed_out,
+        cnv_total=cnv_total,
+        cnv_limit=row_budget["cnvs"],
     )
 
 
+def section_timed_out(section, sample, timed_out):
+    """
+    Log and count a page section dropped after a query timeout
+    """
+    app.logger.warning(f"{sample['name']}: {section} query exceeded its time budget")
+    instrumentation.inc( "coyote_section_timeouts_total", section=section )
+    timed_out.append( section )
+
+
 @app.route('/plot/<string:fn>/<string:assay>/<string:build>')
 def show_any_plot(fn,assay,build):
     if assay == "myeloid":
@@ -0,0 +1,317 @@
+"""
+Motor (asyncio) adapter for the variant page.
+
+AsyncMongoAdapter has the handler surface list_variants needs, samples,
+variants, canonical transcripts, annotations, CNVs, translocations,
+biomarkers, panels and groups, as coroutines. Filters, projections and
+result shaping come from coyote.db.queries, shared with the pymongo
+handlers, so both adapters return the same documents. The cache, time
+budgets (MONGO_TIME_BUDGETS) and invalidation work as on MongoAdapter.
+
+Each worker process runs one event loop in a daemon thread and the motor
+client lives on it, created on first use like MongoConnection's client.
+Request threads hand a coroutine to that loop with run() and wait for it,
+so the queries of one request run concurrently while the pool is shared
+by all requests of the worker. Code running on the loop keeps the
+request's Flask context.
+
+motor is imported when the first client is created, only installs using
+VARIANTS_ASYNC need it.
+"""
+import asyncio
+import os
+import threading
+
+from coyote.db import queries
+from coyote.db.mongo import CollectionAttr
+from coyote.db.timeouts import TimedCollection
+from coyote.extensions.cache import MISSING, cached
+
+
+class AsyncMongoConnection:
+    """
+    Per process motor client and the event loop it runs on
+    """
+
+    def __init__(self, uri: str = None, client=None, **options):
+        self.uri = uri
+        self.options = options
+        self._lock = threading.Lock()
+        self._client = client
+        self._loop = None
+        self._pid = None
+        # A client passed in (e.g. a mock) is used as is, only the loop is per process
+        self._fixed = client is not None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._start()
+        return self._loop
+
+    @property
+    def client(self):
+        self.loop
+        return self._client
+
+    def _start(self) -> None:
+        # The parent's loop thread did not survive the fork, its client is dropped like MongoConnection's
+        if not self._fixed:
+            from motor.motor_asyncio import AsyncIOMotorClient
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name="coyote-motor", daemon=True).start()
+        if not self._fixed:
+            self._client = AsyncIOMotorClient(self.uri, io_loop=loop, **self.options)
+        self._loop = loop
+        self._pid = os.getpid()
+
+    def run(self, coro, timeout: float = None):
+        """
+        Run coro on the loop and wait for its result, from any thread but the loop's own
+        """
+        loop = self.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            raise RuntimeError(
+                "AsyncMongoConnection.run called from its own event loop, await the coroutine instead"
+            )
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            if not self._fixed:
+                self._client.close()
+                self._client = None
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+            self._pid = None
+
+
+class AsyncMongoAdapter:
+    """
+    Coroutine counterparts of the MongoAdapter handlers used by the variant page
+    """
+
+    samples_collection = CollectionAttr("samples")
+    groups_collection = CollectionAttr("groups")
+    panels_collection = CollectionAttr("panels")
+    variants_collection = CollectionAttr("variants_idref")
+    canonical_collection = CollectionAttr("refseq_canonical")
+    annotations_collection = CollectionAttr("annotation")
+    cnvs_collection = CollectionAttr("cnvs_wgs")
+    transloc_collection = CollectionAttr("transloc")
+    biomarkers_collection = CollectionAttr("biomarkers")
+
+    def __init__(self, client=None):
+        self.time_budgets = {}
+        self.db_name = "coyote"
+        self.variants_batch_size = 1000
+        self.connection = None
+        self._collections = {}
+        self._collections_client = None
+        # Shared with MongoAdapter, see coyote.init_store
+        self.cache = None
+        self.bus = None
+        if client:
+            self._setup_dbs(client)
+
+    def init_from_app(self, app) -> None:
+        self.time_budgets = app.config.get("MONGO_TIME_BUDGETS", {})
+        self.db_name = app.config.get("MONGO_DB_NAME", self.db_name)
+        self.variants_batch_size = app.config.get("VARIANTS_BATCH_SIZE", self.variants_batch_size)
+        self.connection = AsyncMongoConnection(
+            app.config["MONGO_URI"], **app.config.get("MONGO_CLIENT_OPTIONS", {})
+        )
+        self._collections = {}
+
+    def _setup_dbs(self, client) -> None:
+        """
+        Use an existing motor compatible client instead of connecting from config
+        """
+        self.connection = AsyncMongoConnection(client=client)
+        self._collections = {}
+
+    def run(self, coro, timeout: float = None):
+        return self.connection.run(coro, timeout)
+
+    @property
+    def client(self):
+        return self.connection.client
+
+    def _collection(self, name: str):
+        client = self.connection.client
+        if client is not self._collections_client:
+            self._collections = {}
+            self._collections_client = client
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = client[self.db_name][name]
+            if self.time_budgets:
+                collection = TimedCollection(collection, self.time_budgets)
+            self._collections[name] = collection
+        return collection
+
+    async def reference(self, name: str):
+        """
+        MongoAdapter.reference, reading expired reference data with the _read_<name> coroutine
+        """
+        if self.cache is None or not self.cache.enabled("reference"):
+            return None
+        value = self.cache.get("reference", name)
+        if value is MISSING:
+            value = await getattr(self, f"_read_{name}")()
+            self.cache.set("reference", name, value)
+        return value
+
+    def invalidate(self, namespace: str, key: str = None) -> None:
+        if self.bus is not None:
+            self.bus.publish(namespace, key)
+        elif self.cache is not None:
+            self.cache.invalidate(namespace, key)
+
+    # Samples
+
+    @cached("samples", key=str)
+    async def get_sample(self, name: str):
+        return await self.samples_collection.find_one(queries.sample_by_name(name))
+
+    async def get_sample_ids(self, sample_id: str) -> dict:
+        doc = await self.samples_collection.find_one(
+            queries.sample_gt(sample_id), queries.SAMPLE_GT_PROJECTION
+        )
+        return queries.sample_ids(doc)
+
+    async def reset_sample_settings(self, sample_id: str, settings: dict) -> None:
+        await self.samples_collection.update_one(
+            queries.sample_by_name(sample_id), queries.reset_sample_settings(settings)
+        )
+        self.invalidate("samples", sample_id)
+
+    async def update_sample_settings(self, sample_str: str, form) -> None:
+        await self.samples_collection.update_one(
+            queries.sample_by_name(sample_str), queries.update_sample_settings(form)
+        )
+        self.invalidate("samples", sample_str)
+
+    # Variants
+
+    async def get_case_variants(
+        self, query: dict, fields: list = None, skip: int = 0, limit: int = 0
+    ) -> list:
+        """
+        All variants of a query as a list, a page of them with skip and limit
+        """
+        cursor = self.variants_collection.find(
+            query, projection=fields, batch_size=self.variants_batch_size
+        )
+        if skip or limit:
+            cursor = cursor.sort(queries.VARIANT_PAGE_SORT).skip(skip).limit(limit)
+        return await cursor.to_list(None)
+
+    async def count_case_variants(self, query: dict) -> int:
+        return await self.variants_collection.count_documents(query)
+
+    async def variant_size_estimate(self) -> int:
+        try:
+            cached = await self.reference("variant_size")
+            return cached if cached is not None else await self._read_variant_size()
+        except Exception:
+            return 0
+
+    async def _read_variant_size(self) -> int:
+        stats = await self.client[self.db_name].command(
+            "collStats", self.variants_collection.name, maxTimeMS=queries.COLL_STATS_MAX_TIME_MS
+        )
+        return int(stats.get("avgObjSize", 0))
+
+    async def get_variants_by_ids(self, ids: list) -> dict:
+        """
+        Full variant documents keyed on _id, the batch sized chunks fetched concurrently
+        """
+        chunks = await asyncio.gather(
+            *(
+                self.variants_collection.find(
+                    queries.variants_by_ids(chunk), batch_size=self.variants_batch_size
+                ).to_list(None)
+                for chunk in queries.id_chunks(ids, self.variants_batch_size)
+            )
+        )
+        return {var["_id"]: var for chunk in chunks for var in chunk}
+
+    async def _read_canonical(self) -> dict:
+        docs = await self.canonical_collection.find({}, queries.CANONICAL_PROJECTION).to_list(None)
+        return queries.canonical_dict(docs)
+
+    async def get_canonical(self, genes_arr: list) -> dict:
+        cached_canonical = await self.reference("canonical")
+        if cached_canonical is not None:
+            return {gene: cached_canonical[gene] for gene in genes_arr if gene in cached_canonical}
+        docs = await self.canonical_collection.find(
+            queries.canonical(genes_arr), queries.CANONICAL_PROJECTION
+        ).to_list(None)
+        return queries.canonical_dict(docs)
+
+    # Annotations
+
+    async def get_global_annotations_batch(self, variants: list, assay, subpanel) -> list:
+        batch = queries.AnnotationBatch(variants)
+        query = batch.filter()
+        if query is not None:
+            async for anno in self.annotations_collection.find(query).sort(queries.ANNOTATION_SORT):
+                batch.add(anno)
+        return batch.summaries(assay, subpanel)
+
+    # CNVs, translocations, biomarkers
+
+    async def get_sample_cnvs(self, sample_id: str, normal: bool = False, limit: int = 0) -> list:
+        return (
+            await self.cnvs_collection.find(queries.sample_docs(sample_id))
+            .limit(limit)
+            .to_list(None)
+        )
+
+    async def count_sample_cnvs(self, sample_id: str) -> int:
+        return await self.cnvs_collection.count_documents(queries.sample_docs(sample_id))
+
+    async def get_sample_other(self, sample_id: str, normal: bool = False) -> list:
+        return await self.biomarkers_collection.find(queries.sample_docs(sample_id)).to_list(None)
+
+    async def get_sample_translocations(self, sample_id: str) -> list:
+        return await self.transloc_collection.find(queries.sample_docs(sample_id)).to_list(None)
+
+    # Panels and groups
+
+    async def _read_panels(self) -> list:
+        return await self.panels_collection.find({}).to_list(None)
+
+    async def get_assay_panels(self, assay: str) -> tuple:
+        cached_panels = await self.reference("panels")
+        if cached_panels is not None:
+            panels = [panel for panel in cached_panels if queries.has_assay(panel, assay)]
+        else:
+            panels = await self.panels_collection.find(queries.assay_panels(assay)).to_list(None)
+        return queries.panel_gene_lists(panels), panels
+
+    async def get_panel(self, type: str, subpanel: str):
+        cached_panels = await self.reference("panels")
+        if cached_panels is not None:
+            return queries.find_panel(cached_panels, type, subpanel)
+        return await self.panels_collection.find_one(queries.panel(type, subpanel))
+
+    async def _read_groups(self) -> dict:
+        return {
+            group["_id"]: group for group in await self.groups_collection.find({}).to_list(None)
+        }
+
+    async def get_sample_groups(self, group: str):
+        cached_groups = await self.reference("groups")
+        if cached_groups is not None:
+            return cached_groups.get(group)
+        return await self.groups_collection.find_one(queries.group(group))
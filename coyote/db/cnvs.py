@@ -1,5 +1,11 @@
+from coyote.db import queries
+
+
 class CNVsHandler:
     
-    def get_sample_cnvs(self, sample_id: str, normal: bool = False):
-        cnv_iter = self.cnvs_collection.find( { "SAMPLE_ID" : sample_id } )
-        return cnv_iter
\ No newline at end of file
+    def get_sample_cnvs(self, sample_id: str, normal: bool = False, limit: int = 0):
+        cnv_iter = self.cnvs_collection.find( queries.sample_docs( sample_id ) ).limit( limit )
+        return cnv_iter
+
+    def count_sample_cnvs(self, sample_id: str) -> int:
+        return self.cnvs_collection.count_documents( queries.sample_docs( sample_id ) )
\ No newline at end of file
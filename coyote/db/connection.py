@@ -0,0 +1,131 @@
+"""
+The one MongoClient of a worker process.
+
+MongoConnection creates its client on first use and again whenever it is
+used from a new process id, so an app preloaded by the gunicorn master
+never hands a client (and its pool and monitor threads) across fork().
+Pool settings come from MONGO_CLIENT_OPTIONS, any MongoClient keyword
+argument. PoolStats follows the connection pool for /metrics.
+"""
+import os
+import threading
+
+import pymongo
+from pymongo import monitoring
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Connection pool counters of the current process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checked_in = 0
+        self.checkout_failed = 0
+        self.pools_cleared = 0
+
+    def _inc(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._inc("pools_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._inc("created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._inc("closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._inc("checkout_failed")
+
+    def connection_checked_out(self, event):
+        self._inc("checked_out")
+
+    def connection_checked_in(self, event):
+        self._inc("checked_in")
+
+    def metrics_lines(self) -> list:
+        return [
+            "# HELP coyote_mongo_pool_connections Open connections in the mongo pool of this worker",
+            "# TYPE coyote_mongo_pool_connections gauge",
+            f"coyote_mongo_pool_connections {self.created - self.closed}",
+            "# HELP coyote_mongo_pool_in_use Connections checked out of the mongo pool",
+            "# TYPE coyote_mongo_pool_in_use gauge",
+            f"coyote_mongo_pool_in_use {self.checked_out - self.checked_in}",
+            "# HELP coyote_mongo_pool_checkouts_total Connection checkouts from the mongo pool",
+            "# TYPE coyote_mongo_pool_checkouts_total counter",
+            f"coyote_mongo_pool_checkouts_total {self.checked_out}",
+            "# HELP coyote_mongo_pool_checkout_failures_total Failed checkouts, e.g. waitQueueTimeoutMS exceeded",
+            "# TYPE coyote_mongo_pool_checkout_failures_total counter",
+            f"coyote_mongo_pool_checkout_failures_total {self.checkout_failed}",
+            "# HELP coyote_mongo_pool_cleared_total Pools cleared after network errors",
+            "# TYPE coyote_mongo_pool_cleared_total counter",
+            f"coyote_mongo_pool_cleared_total {self.pools_cleared}",
+        ]
+
+
+class MongoConnection:
+    """
+    Lazily created, per process MongoClient
+    """
+
+    def __init__(self, uri: str = None, client: pymongo.MongoClient = None, **options):
+        self.uri = uri
+        self.options = options
+        self.pool_stats = PoolStats()
+        self._lock = threading.Lock()
+        self._client = client
+        self._pid = os.getpid() if client is not None else None
+        # A client passed in is used as is, whatever the process
+        self._fixed = client is not None
+
+    @property
+    def client(self) -> pymongo.MongoClient:
+        if self._pid != os.getpid() and not self._fixed:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._connect()
+        return self._client
+
+    def _connect(self) -> None:
+        # The parent's client is dropped, not closed, closing it would touch sockets shared with the parent
+        self.pool_stats.reset()
+        self._client = pymongo.MongoClient(
+            self.uri, event_listeners=[self.pool_stats], **self.options
+        )
+        self._pid = os.getpid()
+
+    @property
+    def connected(self) -> bool:
+        return self._client is not None and self._pid == os.getpid()
+
+    def close(self) -> None:
+        # A client passed in belongs to the caller
+        if self._fixed:
+            return
+        with self._lock:
+            if self.connected:
+                self._client.close()
+            self._client = None
+            self._pid = None
@@ -1,8 +1,24 @@
 import pymongo
 from flask import current_app as app
 
+from coyote.db import queries
+
 class GroupsHandler:
 
+    def load_groups(self) -> int:
+        """
+        Read all group documents into the reference cache for get_sample_groups
+        """
+        groups = self._read_groups()
+        self._set_reference("groups", groups)
+        return len(groups)
+
+    def _read_groups(self) -> dict:
+        return { group['_id']: group for group in self.groups_collection.find( {} ) }
+
     def get_sample_groups(self, group: str):
-        group = self.groups_collection.find_one( { '_id':group } )
+        cached = self.reference("groups")
+        if cached is not None:
+            return cached.get( group )
+        group = self.groups_collection.find_one( queries.group( group ) )
         return group
\ No newline at end of file
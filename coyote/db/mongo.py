@@ -8,35 +8,125 @@ from coyote.db.variants import VariantsHandler
 from coyote.db.cnvs import CNVsHandler
 from coyote.db.translocs import TranslocsHandler
 from coyote.db.other import OtherHandler
+from coyote.db.annotations import AnnotationsHandler
+from coyote.db.timeouts import TimedCollection
+from coyote.db.connection import MongoConnection
 
 
-class MongoAdapter(SampleHandler,UsersHandler,GroupsHandler,PanelsHandler,VariantsHandler,CNVsHandler,TranslocsHandler,OtherHandler):
+class CollectionAttr:
+    """
+    Adapter attribute resolving to a collection of the current process' client
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __get__(self, adapter, owner):
+        if adapter is None:
+            return self
+        return adapter._collection(self.name)
+
+
+class MongoAdapter(
+    SampleHandler,
+    UsersHandler,
+    GroupsHandler,
+    PanelsHandler,
+    VariantsHandler,
+    CNVsHandler,
+    TranslocsHandler,
+    OtherHandler,
+    AnnotationsHandler,
+):
+    # coyote
+    samples_collection = CollectionAttr("samples")
+    users_collection = CollectionAttr("users")
+    groups_collection = CollectionAttr("groups")
+    panels_collection = CollectionAttr("panels")
+    variants_collection = CollectionAttr("variants_idref")
+    canonical_collection = CollectionAttr("refseq_canonical")
+    annotations_collection = CollectionAttr("annotation")
+    cnvs_collection = CollectionAttr("cnvs_wgs")
+    transloc_collection = CollectionAttr("transloc")
+    biomarkers_collection = CollectionAttr("biomarkers")
+
     def __init__(self, client: pymongo.MongoClient = None):
+        self.time_budgets = {}
+        self.db_name = "coyote"
+        self.connection = None
+        self._collections = {}
+        self._collections_client = None
+        # extensions.cache.Cache for the @cached handler methods and reference data,
+        # None to always query
+        self.cache = None
+        # extensions.invalidation.InvalidationBus telling the other nodes about writes
+        self.bus = None
         if client:
             self._setup_dbs(client)
 
     def init_from_app(self, app) -> None:
-        client = self._get_mongoclient(app.config["MONGO_URI"])
-        self._setup_dbs(client)
+        self.time_budgets = app.config.get("MONGO_TIME_BUDGETS", {})
+        self.db_name = app.config.get("MONGO_DB_NAME", self.db_name)
+        self.connection = MongoConnection(
+            app.config["MONGO_URI"], **app.config.get("MONGO_CLIENT_OPTIONS", {})
+        )
         self.setup()
-
-    def _get_mongoclient(self, mongo_uri: str) -> pymongo.MongoClient:
-        return pymongo.MongoClient(mongo_uri)
+        self.variants_batch_size = app.config.get("VARIANTS_BATCH_SIZE", self.variants_batch_size)
 
     def _setup_dbs(self, client: pymongo.MongoClient) -> None:
-        # No, set the db names from config:
-        self.coyote_db = client["coyote"]
+        """
+        Use an existing client, e.g. mongomock in benchmarks, instead of connecting from config
+        """
+        self.connection = MongoConnection(client=client)
+        self.setup()
 
     def setup(self) -> None:
-        # coyote
-        self.samples_collection = self.coyote_db["samples"]
-        self.users_collection = self.coyote_db["users"]
-        self.groups_collection = self.coyote_db["groups"]
-        self.panels_collection = self.coyote_db["panels"]
-        self.variants_collection = self.coyote_db["variants_idref"]
-        self.canonical_collection = self.coyote_db["refseq_canonical"]
-        self.annotations_collection = self.coyote_db["annotation"]
-        self.cnvs_collection = self.coyote_db["cnvs_wgs"]
-        self.transloc_collection = self.coyote_db["transloc"]
-        self.biomarkers_collection = self.coyote_db["biomarkers"]
-        
\ No newline at end of file
+        # Collections are resolved again on first use
+        self._collections = {}
+        self._collections_client = None
+
+    def reference(self, name: str):
+        """
+        Reference data (canonical, panels, groups) from the "reference" cache namespace,
+        read again with _read_<name> once expired. None without a cache, handlers then query.
+        """
+        if self.cache is None or not self.cache.enabled("reference"):
+            return None
+        return self.cache.get_or_set("reference", name, getattr(self, f"_read_{name}"))
+
+    def invalidate(self, namespace: str, key: str = None) -> None:
+        """
+        Drop cached entries after a write, on every node when the invalidation bus runs
+        """
+        if self.bus is not None:
+            self.bus.publish(namespace, key)
+        elif self.cache is not None:
+            self.cache.invalidate(namespace, key)
+
+    def _set_reference(self, name: str, data) -> None:
+        if self.cache is not None:
+            self.cache.set("reference", name, data)
+
+    @property
+    def client(self) -> pymongo.MongoClient:
+        return self.connection.client
+
+    @property
+    def coyote_db(self):
+        return self.connection.client[self.db_name]
+
+    def _collection(self, name: str):
+        """
+        Collection with the maxTimeMS budgets from MONGO_TIME_BUDGETS, cached per client
+        """
+        client = self.connection.client
+        if client is not self._collections_client:
+            self._collections = {}
+            self._collections_client = client
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = client[self.db_name][name]
+            if self.time_budgets:
+                collection = TimedCollection(collection, self.time_budgets)
+            self._collections[name] = collection
+        return collection
@@ -1,16 +1,33 @@
 """
 Coyote gene panels db actions
 """
+from coyote.db import queries
+
 
 class PanelsHandler:
 
+    def load_panels(self) -> int:
+        """
+        Read all panels into the reference cache for get_assay_panels and get_panel
+        """
+        panels = self._read_panels()
+        self._set_reference("panels", panels)
+        return len(panels)
+
+    def _read_panels(self) -> list:
+        return list(self.panels_collection.find( {} ))
+
     def get_assay_panels(self, assay: str)->list:
-        panels = list(self.panels_collection.find( { 'assays': { '$in': [assay] } }  ))
-        gene_lists = {}
-        for panel in panels:
-            if panel['type'] == 'genelist':
-                gene_lists[panel['name']] = panel['genes']
-        return gene_lists, panels
+        cached = self.reference("panels")
+        if cached is not None:
+            panels = [ panel for panel in cached if queries.has_assay( panel, assay ) ]
+        else:
+            panels = list(self.panels_collection.find( queries.assay_panels( assay ) ))
+        return queries.panel_gene_lists( panels ), panels
     def get_panel(self, type: str, subpanel: str):
-        panel = self.panels_collection.find_one( { 'name':subpanel, 'type': type } )
-        return panel
\ No newline at end of file
+        cached = self.reference("panels")
+        if cached is not None:
+            return queries.find_panel( cached, type, subpanel )
+        panel = self.panels_collection.find_one( queries.panel( type, subpanel ) )
+        return panel
+
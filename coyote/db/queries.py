@@ -0,0 +1,337 @@
+"""
+Query construction shared by the pymongo handlers and the motor adapter.
+
+The handler mixins on MongoAdapter and their async counterparts in
+coyote.db.aio build their filters, projections and updates here and
+shape the documents they get back with the same functions, so both
+adapters return the same data for the same call.
+"""
+
+CANONICAL_PROJECTION = {"_id": 0, "gene": 1, "canonical": 1}
+SAMPLE_GT_PROJECTION = {"GT": 1}
+# collStats for the variant size estimate, cached as reference data
+COLL_STATS_MAX_TIME_MS = 2000
+# Pages of variants are taken in _id order
+VARIANT_PAGE_SORT = [("_id", 1)]
+# Annotations apply oldest first, later classifications win
+ANNOTATION_SORT = [("time_created", 1)]
+
+
+# Samples
+
+
+def samples(user_groups: list, report: bool = False, search_str: str = "") -> dict:
+    query = {"groups": {"$in": user_groups}}
+    if report:
+        query["report_num"] = {"$gt": 0}
+    else:
+        query["$or"] = [{"report_num": {"$exists": False}}, {"report_num": 0}]
+    if len(search_str) > 0:
+        query["name"] = {"$regex": search_str}
+    return query
+
+
+def sample_by_name(name: str) -> dict:
+    return {"name": name}
+
+
+def sample_gt(sample_id: str) -> dict:
+    return {"SAMPLE_ID": sample_id}
+
+
+def sample_ids(doc: dict) -> dict:
+    """
+    GT type (case, control) -> sample name
+    """
+    ids = {}
+    if doc:
+        for gt in doc["GT"]:
+            ids[gt.get("type")] = gt.get("sample")
+    return ids
+
+
+def reset_sample_settings(settings: dict) -> dict:
+    return {
+        "$set": {
+            "filter_max_freq": settings["default_max_freq"],
+            "filter_min_freq": settings["default_min_freq"],
+            "filter_min_depth": settings["default_mindepth"],
+            "filter_min_reads": settings["default_min_reads"],
+            "filter_min_spanreads": settings["default_spanreads"],
+            "filter_min_spanpairs": settings["default_spanpairs"],
+            "checked_csq": settings["default_checked_conseq"],
+            "checked_genelists": settings["default_checked_genelists"],
+            "filter_max_popfreq": settings["default_popfreq"],
+            "checked_fusionlists": settings["default_checked_fusionlists"],
+            "min_cnv_size": settings["default_min_cnv_size"],
+            "max_cnv_size": settings["default_max_cnv_size"],
+            "checked_cnveffects": settings["default_checked_cnveffects"],
+        }
+    }
+
+
+def update_sample_settings(form) -> dict:
+    """
+    $set of the submitted filter form, checked boxes sorted by field name prefix
+    """
+    checked_conseq = {}
+    checked_genelists = {}
+    checked_fusionlists = {}
+    checked_fusioneffects = {}
+    checked_fusioncallers = {}
+    checked_cnveffects = {}
+    for fieldname, value in form.data.items():
+        if value == True:
+            if fieldname.startswith("genelist"):
+                checked_genelists[fieldname] = 1
+            elif fieldname.startswith("fusionlist"):
+                checked_fusionlists[fieldname] = 1
+            elif fieldname.startswith(
+                "fusioncaller"
+            ):  # donot change to fusioncallers, make it singular
+                checked_fusioncallers[fieldname] = 1
+            elif fieldname.startswith("fusioneffect"):
+                checked_fusioneffects[fieldname] = 1
+            elif fieldname.startswith("cnveffect"):
+                checked_cnveffects[fieldname] = 1
+            else:
+                checked_conseq[fieldname] = 1
+
+    settings = {
+        "filter_max_freq": form.max_freq.data,
+        "filter_min_freq": form.min_freq.data,
+        "filter_min_depth": form.min_depth.data,
+        "filter_min_reads": form.min_reads.data,
+        "checked_csq": checked_conseq,
+        "checked_genelists": checked_genelists,
+        "filter_max_popfreq": form.max_popfreq.data,
+        "checked_fusionlists": checked_fusionlists,
+        "checked_fusioneffects": checked_fusioneffects,
+        "checked_fusioncallers": checked_fusioncallers,
+        "min_cnv_size": form.min_cnv_size.data,
+        "max_cnv_size": form.max_cnv_size.data,
+        "checked_cnveffects": checked_cnveffects,
+    }
+    # Optional and not on the DNA page's form, left empty they keep the sample's setting
+    # rather than storing None, which get_sample_settings cannot read
+    for name in ("min_spanreads", "min_spanpairs"):
+        if form[name].data is not None:
+            settings[f"filter_{name}"] = form[name].data
+    return {"$set": settings}
+
+
+# Variants
+
+
+def variants_by_ids(ids: list) -> dict:
+    return {"_id": {"$in": ids}}
+
+
+def id_chunks(ids: list, size: int):
+    for start in range(0, len(ids), size):
+        yield ids[start : start + size]
+
+
+def canonical(genes: list) -> dict:
+    return {"gene": {"$in": genes}}
+
+
+def canonical_dict(docs) -> dict:
+    return {doc["gene"]: doc["canonical"] for doc in docs}
+
+
+# Annotations
+
+
+def no_transid(nom: str) -> str:
+    a = nom.split(":")
+    if 1 < len(a):
+        return a[1]
+    return nom
+
+
+def annotation_keys(variant) -> list:
+    """
+    (gene, nomenclature, variant) combinations an annotation can match a variant on.
+    gene None matches annotations for any gene
+    """
+    genomic_location = (
+        str(variant["CHROM"])
+        + ":"
+        + str(variant["POS"])
+        + ":"
+        + variant["REF"]
+        + "/"
+        + variant["ALT"]
+    )
+    csq = variant["INFO"]["selected_CSQ"]
+    if len(csq["HGVSp"]) > 0:
+        return [
+            (csq["SYMBOL"], "p", no_transid(csq["HGVSp"])),
+            (csq["SYMBOL"], "c", no_transid(csq["HGVSc"])),
+            (csq["SYMBOL"], "g", genomic_location),
+        ]
+    elif len(csq["HGVSc"]) > 0:
+        return [
+            (csq["SYMBOL"], "c", no_transid(csq["HGVSc"])),
+            (csq["SYMBOL"], "g", genomic_location),
+        ]
+    return [(None, "g", genomic_location)]
+
+
+def annotations_for_variant(variant) -> dict:
+    keys = annotation_keys(variant)
+    if keys[0][0] is None:
+        return {"nomenclature": "g", "variant": keys[0][2]}
+    return {
+        "gene": keys[0][0],
+        "$or": [{"nomenclature": nom, "variant": var} for gene, nom, var in keys],
+    }
+
+
+class AnnotationBatch:
+    """
+    One annotation query for many variants. filter() selects every annotation
+    any of the variants can match, add() sorts them back to their variants.
+    """
+
+    def __init__(self, variants: list):
+        self.wanted = {}
+        for var_idx, var in enumerate(variants):
+            for key in annotation_keys(var):
+                self.wanted.setdefault(key, []).append(var_idx)
+        self.per_var = [[] for _ in variants]
+
+    def filter(self) -> dict:
+        """
+        None when no variant can have annotations. Keys with a gene and gene-less
+        keys are one clause each, add() drops cross combinations no variant wants.
+        """
+        clauses = []
+        for with_gene in (True, False):
+            keys = [key for key in self.wanted if (key[0] is not None) == with_gene]
+            if not keys:
+                continue
+            clause = {
+                "nomenclature": {"$in": sorted({key[1] for key in keys})},
+                "variant": {"$in": list({key[2] for key in keys})},
+            }
+            if with_gene:
+                clause["gene"] = {"$in": sorted({key[0] for key in keys})}
+            clauses.append(clause)
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+    def add(self, anno: dict) -> None:
+        matched = set()
+        for key in (
+            (anno.get("gene"), anno.get("nomenclature"), anno.get("variant")),
+            (None, anno.get("nomenclature"), anno.get("variant")),
+        ):
+            matched.update(self.wanted.get(key, []))
+        for var_idx in sorted(matched):
+            self.per_var[var_idx].append(anno)
+
+    def summaries(self, assay, subpanel) -> list:
+        return [summarize_annotations(annos, assay, subpanel) for annos in self.per_var]
+
+
+def summarize_annotations(annotations, assay, subpanel):
+    latest_classification = {"class": 999}
+    latest_classification_other = {}
+    annotations_arr = []
+    annotations_interesting = {}
+
+    for anno in annotations:
+        if "class" in anno:
+            ## collect latest for current assay (if latest not assigned pick that)
+            ## also collect latest anno for all other assigned assays (including non-assays)
+            ## special rule for assays with subpanels, solid, tumwgs maybe lymph?
+            try:
+                if assay == "solid":
+                    if anno["assay"] == assay and anno["subpanel"] == subpanel:
+                        latest_classification = anno
+                    else:
+                        ass_sub = anno["assay"] + ":" + anno["subpanel"]
+                        latest_classification_other[ass_sub] = anno["class"]
+                else:
+                    if anno["assay"] == assay:
+                        latest_classification = anno
+                    else:
+                        ass_sub = anno["assay"] + ":" + anno["subpanel"]
+                        latest_classification_other[ass_sub] = anno["class"]
+            except:
+                latest_classification = anno
+                latest_classification_other["N/A"] = anno["class"]
+        elif "text" in anno:
+            try:
+                if assay == "solid":
+                    if anno["assay"] == assay and anno["subpanel"] == subpanel:
+                        ass_sub = anno["assay"] + ":" + anno["subpanel"]
+                        annotations_interesting[ass_sub] = anno
+                        annotations_arr.append(anno)
+                    else:
+                        annotations_arr.append(anno)
+                else:
+                    if anno["assay"] == assay:
+                        annotations_interesting[anno["assay"]] = anno
+                        annotations_arr.append(anno)
+                    else:
+                        annotations_arr.append(anno)
+            except:
+                annotations_arr.append(anno)
+
+    latest_other_arr = []
+    for latest_assay in latest_classification_other:
+        assay_sub = latest_assay.split(":")
+        if len(assay_sub) < 2:
+            assay_sub.append(None)
+        latest_other_arr.append(
+            {
+                "assay": assay_sub[0],
+                "class": latest_classification_other[latest_assay],
+                "subpanel": assay_sub[1],
+            }
+        )
+
+    return annotations_arr, latest_classification, latest_other_arr, annotations_interesting
+
+
+# CNVs, translocations, biomarkers
+
+
+def sample_docs(sample_id: str) -> dict:
+    """
+    Documents of a sample in the cnvs_wgs, transloc and biomarkers collections
+    """
+    return {"SAMPLE_ID": sample_id}
+
+
+# Panels and groups
+
+
+def assay_panels(assay: str) -> dict:
+    return {"assays": {"$in": [assay]}}
+
+
+def has_assay(panel: dict, assay: str) -> bool:
+    # Same match as assay_panels(), assays may be a list or a single value
+    assays = panel.get("assays")
+    return assay in assays if isinstance(assays, list) else assays == assay
+
+
+def panel_gene_lists(panels: list) -> dict:
+    return {panel["name"]: panel["genes"] for panel in panels if panel["type"] == "genelist"}
+
+
+def panel(type: str, subpanel: str) -> dict:
+    return {"name": subpanel, "type": type}
+
+
+def find_panel(panels: list, type: str, subpanel: str):
+    return next((p for p in panels if p.get("name") == subpanel and p.get("type") == type), None)
+
+
+def group(group_id: str) -> dict:
+    return {"_id": group_id}
@@ -0,0 +1,60 @@
+"""
+Server side time budgets (maxTimeMS) for the collections used by the handlers.
+
+MONGO_TIME_BUDGETS maps a collection name to milliseconds, or to a dict of
+operation (find, find_one, count, aggregate) -> milliseconds. "default"
+is the fallback in both, 0 means no limit. A query over its budget is
+killed by mongod and raises pymongo.errors.ExecutionTimeout in the view,
+which can then render without that section. Writes are not bounded, pymongo has no maxTimeMS for them.
+"""
+import pymongo
+
+OPERATIONS = ("find", "find_one", "count", "aggregate")
+
+
+def resolve_budget(budgets: dict, collection: str, operation: str) -> int:
+    """
+    Milliseconds for an operation on a collection, 0 for no limit
+    """
+    default = budgets.get("default", 0)
+    budget = budgets.get(collection, default)
+    if isinstance(budget, dict):
+        budget = budget.get(operation, budget.get("default", default))
+    return int(budget or 0)
+
+
+class TimedCollection:
+    """
+    Collection wrapper setting maxTimeMS on reads, anything else goes to the collection
+    """
+
+    def __init__(self, collection: pymongo.collection.Collection, budgets: dict):
+        self.collection = collection
+        self.budgets = {op: resolve_budget(budgets, collection.name, op) for op in OPERATIONS}
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def __getitem__(self, name):
+        return self.collection[name]
+
+    def find(self, *args, **kwargs):
+        cursor = self.collection.find(*args, **kwargs)
+        if self.budgets["find"] and "max_time_ms" not in kwargs:
+            cursor = cursor.max_time_ms(self.budgets["find"])
+        return cursor
+
+    def find_one(self, *args, **kwargs):
+        if self.budgets["find_one"]:
+            kwargs.setdefault("max_time_ms", self.budgets["find_one"])
+        return self.collection.find_one(*args, **kwargs)
+
+    def count_documents(self, *args, **kwargs):
+        if self.budgets["count"]:
+            kwargs.setdefault("maxTimeMS", self.budgets["count"])
+        return self.collection.count_documents(*args, **kwargs)
+
+    def aggregate(self, *args, **kwargs):
+        if self.budgets["aggregate"]:
+            kwargs.setdefault("maxTimeMS", self.budgets["aggregate"])
+        return self.collection.aggregate(*args, **kwargs)
@@ -1,5 +1,8 @@
+from coyote.db import queries
+
+
 class TranslocsHandler:
     
     def get_sample_translocations(self, sample_id: str):
-        transloc_iter = self.transloc_collection.find( { "SAMPLE_ID" : sample_id } )
+        transloc_iter = self.transloc_collection.find( queries.sample_docs( sample_id ) )
         return transloc_iter
\ No newline at end of file
@@ -1,5 +1,7 @@
 import pymongo
 
+from coyote.extensions.cache import cached
+
 
 class UsersHandler:
     """
@@ -14,4 +16,18 @@ class UsersHandler:
         """
         return dict(self.users_collection.find_one( { "email": user_mail } ))
 
+    @cached("users", key=str)
+    def get_user_by_id(self, user_id: str) -> dict:
+        """
+        user document by _id, None if missing. Used by the login manager on every
+        request, so documents are cached in the "users" namespace.
+        """
+        return self.users_collection.find_one( { "_id": user_id } )
+
+    def invalidate_user(self, user_id: str = None) -> None:
+        """
+        Drop a cached user, or all cached users, e.g. after changing groups
+        """
+        self.invalidate( "users", None if user_id is None else str(user_id) )
+
 
@@ -1,5 +1,11 @@
+import logging
+
 import pymongo
-from flask import current_app as app
+
+from coyote.db import queries
+from coyote.extensions.applog import payload
+
+LOG = logging.getLogger(__name__)
 
 class VariantsHandler:
     """
@@ -7,23 +13,77 @@ class VariantsHandler:
     """
 
     coyote_users_collection: pymongo.collection.Collection
+    variants_batch_size: int = 1000
     
-    def get_case_variants(self, query: dict):
+    def get_case_variants(self, query: dict, fields: list = None, skip: int = 0, limit: int = 0):
         """
         Return variants with according to a constructed varquery
+
+        fields projects the documents to a subset, used to filter on cheap
+        partial documents before fetching survivors with get_variants_by_ids.
+        skip and limit page through the variants in _id order.
         """
-        return self.variants_collection.find( query )
+        variants = self.variants_collection.find(
+            query, projection=fields, batch_size=self.variants_batch_size
+        )
+        if skip or limit:
+            variants = variants.sort( queries.VARIANT_PAGE_SORT ).skip( skip ).limit( limit )
+        return variants
 
+    def count_case_variants(self, query: dict) -> int:
+        return self.variants_collection.count_documents( query )
+
+    def variant_size_estimate(self) -> int:
+        """
+        Average variant document size in bytes from collStats, 0 if unavailable.
+        Kept in the reference cache, it barely changes between page loads.
+        """
+        try:
+            cached = self.reference("variant_size")
+            return cached if cached is not None else self._read_variant_size()
+        except Exception:
+            # Not cached, the next page load asks again
+            return 0
+
+    def _read_variant_size(self) -> int:
+        stats = self.coyote_db.command(
+            'collStats', self.variants_collection.name, maxTimeMS=queries.COLL_STATS_MAX_TIME_MS
+        )
+        return int(stats.get('avgObjSize', 0))
+
+    def get_variants_by_ids(self, ids: list) -> dict:
+        """
+        Return full variant documents keyed on _id, fetched in batch sized chunks
+        """
+        variants = {}
+        for chunk in queries.id_chunks( ids, self.variants_batch_size ):
+            query = queries.variants_by_ids( chunk )
+            for var in self.variants_collection.find( query, batch_size=self.variants_batch_size ):
+                variants[var["_id"]] = var
+        return variants
+
+
+    def load_canonical(self) -> int:
+        """
+        Read the canonical transcripts of all genes into the reference cache for get_canonical
+        """
+        canonical_dict = self._read_canonical()
+        self._set_reference("canonical", canonical_dict)
+        return len(canonical_dict)
+
+    def _read_canonical(self) -> dict:
+        canonical = self.canonical_collection.find( {}, queries.CANONICAL_PROJECTION )
+        return queries.canonical_dict( canonical )
 
     def get_canonical(self, genes_arr)->dict:
         """
         find canonical transcript for genes
         """
-        app.logger.info(f"this is my search string: {genes_arr}")
-        canonical_dict = {}
-        canonical = self.canonical_collection.find( { 'gene': { '$in': genes_arr } } )
-        
-        for c in canonical:
-            canonical_dict[c["gene"]] = c["canonical"]
-
-        return canonical_dict
\ No newline at end of file
+        payload(LOG, "canonical_genes", "Canonical transcripts of %s", genes_arr)
+        cached = self.reference("canonical")
+        if cached is not None:
+            return { gene: cached[gene] for gene in genes_arr if gene in cached }
+        canonical = self.canonical_collection.find(
+            queries.canonical( genes_arr ), queries.CANONICAL_PROJECTION
+        )
+        return queries.canonical_dict( canonical )
\ No newline at end of file
@@ -1,14 +1,34 @@
 """
 This module stores variables/objects that need to be accessed all over
-the app. e.g. mongo : MongoClient.
+the app. e.g. store : MongoAdapter, owner of the MongoClient.
 """
 
 from flask_login import LoginManager
-from flask_pymongo import PyMongo
 from coyote.db.mongo import MongoAdapter
+from coyote.db.aio import AsyncMongoAdapter
 from .ldap_extension import LdapManager
+from .instrumentation import Instrumentation
+from .querystats import QueryStatsMonitor
+from .capture import WorkloadCapture
+from .applog import AppLog
+from .profiler import Profiler
+from .warmup import WarmUp
+from .cache import Cache
+from .invalidation import InvalidationBus
+from .singleflight import SingleFlight
+from .offload import Offload
 
 login_manager = LoginManager()
-mongo = PyMongo()
 store = MongoAdapter()
-ldap_manager = LdapManager()
\ No newline at end of file
+async_store = AsyncMongoAdapter()
+ldap_manager = LdapManager()
+instrumentation = Instrumentation()
+query_stats = QueryStatsMonitor()
+capture = WorkloadCapture()
+app_log = AppLog()
+profiler = Profiler()
+warmup = WarmUp()
+cache = Cache()
+invalidation = InvalidationBus()
+single_flight = SingleFlight()
+offload = Offload()
\ No newline at end of file
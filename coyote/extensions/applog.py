@@ -0,0 +1,223 @@
+"""
+Application logging: one handler, structured records and request ids.
+
+init_app puts a single stderr handler on the root logger, in place of
+Flask's default handler on app.logger. With LOG_FORMAT json each record is
+one JSON object, with LOG_FORMAT text one line. LOG_LEVEL is the root
+level and LOG_LEVELS sets levels per logger name, e.g. a module's
+__name__ or "pymongo".
+
+Every request gets an id, from the LOG_REQUEST_ID_HEADER of the request
+(set by the proxy) or a new one. It is returned in that header and added
+to every record logged while the request is handled. With LOG_REQUESTS
+each request ends with one "coyote.requests" record holding its status,
+duration and the database time, command count and spans recorded by the
+timing instrumentation, under the same id.
+
+Large debug payloads (queries, configs, gene lists) go through payload().
+Its arguments are formatted, and callables among them called, only when
+the record is written. Per key it
+keeps LOG_PAYLOAD_SAMPLE_RATE of the records and at most
+LOG_PAYLOAD_PER_MINUTE records a minute, per process.
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+import traceback
+import uuid
+
+from flask import current_app, g, has_request_context, request
+from flask.logging import default_handler
+
+REQUEST_LOGGER = "coyote.requests"
+TEXT_FORMAT = "%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"
+# Ids taken from the proxy's header, anything else is replaced
+VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+# LogRecord attributes, everything else on a record came from extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+    "request_id",
+}
+
+
+def current_request_id() -> str:
+    if has_request_context():
+        return g.get("request_id", "-")
+    return "-"
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Adds the id of the request being handled, "-" outside requests
+    """
+
+    def filter(self, record) -> bool:
+        record.request_id = current_request_id()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record, extra= fields included
+    """
+
+    def format(self, record) -> str:
+        doc = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "pid": record.process,
+            "message": record.getMessage(),
+        }
+        doc.update((key, val) for key, val in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            doc["exception"] = "".join(traceback.format_exception(*record.exc_info))
+        return json.dumps(doc, default=str)
+
+
+class Lazy:
+    """
+    A payload formatted as JSON when the record is, not when it is logged.
+    A callable is called then, for payloads that are costly to build.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self) -> str:
+        value = self.value() if callable(self.value) else self.value
+        return json.dumps(value, default=str, sort_keys=True)
+
+
+class AppLog:
+    """
+    Flask extension setting up logging, request ids and payload sampling
+    """
+
+    def __init__(self):
+        self._handler = None
+        self._lock = threading.Lock()
+        self._windows = {}
+        self.request_id_header = "X-Request-ID"
+        self.log_requests = True
+        self.skip_endpoints = frozenset()
+        self.payload_sample_rate = 1.0
+        self.payload_per_minute = 60
+
+    def init_app(self, app) -> None:
+        app.config.setdefault("LOG_FORMAT", "text")
+        app.config.setdefault("LOG_LEVEL", "INFO")
+        app.config.setdefault("LOG_LEVELS", {})
+        app.config.setdefault("LOG_REQUEST_ID_HEADER", "X-Request-ID")
+        app.config.setdefault("LOG_REQUESTS", True)
+        app.config.setdefault("LOG_REQUESTS_SKIP", ["metrics", "healthz", "readyz", "static"])
+        app.config.setdefault("LOG_PAYLOAD_SAMPLE_RATE", 1.0)
+        app.config.setdefault("LOG_PAYLOAD_PER_MINUTE", 60)
+
+        self.request_id_header = app.config["LOG_REQUEST_ID_HEADER"]
+        self.log_requests = app.config["LOG_REQUESTS"]
+        self.skip_endpoints = frozenset(app.config["LOG_REQUESTS_SKIP"])
+        self.payload_sample_rate = app.config["LOG_PAYLOAD_SAMPLE_RATE"]
+        self.payload_per_minute = app.config["LOG_PAYLOAD_PER_MINUTE"]
+        app.extensions["app_log"] = self
+
+        handler = logging.StreamHandler()
+        if app.config["LOG_FORMAT"] == "json":
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        handler.addFilter(RequestIdFilter())
+        root = logging.getLogger()
+        # Replaces the handler of an earlier app, e.g. in benchmarks creating several
+        if self._handler is not None:
+            root.removeHandler(self._handler)
+        root.addHandler(handler)
+        root.setLevel(app.config["LOG_LEVEL"].upper())
+        self._handler = handler
+        app.logger.removeHandler(default_handler)
+        for name, level in app.config["LOG_LEVELS"].items():
+            logging.getLogger(name).setLevel(level.upper())
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        incoming = request.headers.get(self.request_id_header, "")
+        g.request_id = incoming if VALID_REQUEST_ID.match(incoming) else uuid.uuid4().hex[:16]
+
+    def _after_request(self, response):
+        # Missing when an earlier before_request function raised
+        request_id = g.get("request_id")
+        if request_id is None:
+            request_id = g.request_id = uuid.uuid4().hex[:16]
+        response.headers[self.request_id_header] = request_id
+        if not self.log_requests or (request.endpoint or "").split(".")[-1] in self.skip_endpoints:
+            return response
+        fields = {
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "status": response.status_code,
+        }
+        # Registered after the instrumentation, so this runs before its after_request has used them
+        timings = g.get("coyote_timings")
+        if timings is not None:
+            fields["ms"] = round((time.perf_counter() - timings.start) * 1000, 1)
+            fields["db_ms"] = round(timings.db_seconds * 1000, 1)
+            fields["db_commands"] = timings.db_commands
+            fields["spans_ms"] = {
+                name: round(seconds * 1000, 1) for name, seconds in timings.spans.items()
+            }
+        logging.getLogger(REQUEST_LOGGER).info(
+            "%s %s %s %s ms",
+            request.method,
+            request.path,
+            response.status_code,
+            fields.get("ms", "-"),
+            extra=fields,
+        )
+        return response
+
+    def _admit(self, key: str) -> tuple:
+        """
+        (admitted, records suppressed since the last admitted one) for a payload key
+        """
+        if self.payload_sample_rate < 1 and random.random() >= self.payload_sample_rate:
+            return False, 0
+        now = time.monotonic()
+        with self._lock:
+            window_start, count, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - window_start >= 60:
+                window_start, count = now, 0
+            if count >= self.payload_per_minute:
+                self._windows[key] = (window_start, count, suppressed + 1)
+                return False, 0
+            self._windows[key] = (window_start, count + 1, 0)
+            return True, suppressed
+
+    def payload(self, logger: logging.Logger, key: str, msg: str, *args) -> None:
+        """
+        Log msg % args at DEBUG, sampled and rate limited per key, the args JSON formatted only if written
+        """
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        admitted, suppressed = self._admit(key)
+        if admitted:
+            logger.debug(
+                msg, *(Lazy(arg) for arg in args), extra={"payload": key, "suppressed": suppressed}
+            )
+
+
+def payload(logger: logging.Logger, key: str, msg: str, *args) -> None:
+    """
+    AppLog.payload of the current app, for modules imported before the extensions
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        current_app.extensions["app_log"].payload(logger, key, msg, *args)
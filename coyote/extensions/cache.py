@@ -0,0 +1,482 @@
+"""
+Two tier cache for db handler results.
+
+The memory tier is an LRU of at most CACHE_SIZE entries per process. The
+optional disk tier is a sqlite file in CACHE_DIR, shared by every worker
+on the node: a worker missing in memory reads what another worker stored
+instead of asking mongo, and a freshly forked worker starts warm.
+
+Entries live in namespaces, each with its own TTL from CACHE_TTLS (0
+turns the namespace off). Handler methods are cached with the decorator:
+
+    @cached("users")
+    def get_user_by_id(self, user_id): ...
+
+which keys on the arguments and uses the handler's `cache` attribute,
+calling the method directly when there is none. Coroutine methods of the
+async adapter are cached the same way. Cached values are shared
+between callers and must not be modified.
+
+invalidate(namespace, key=None) drops one key or a whole namespace. With
+the disk tier it is also written to its event table, which the other
+workers read at most every CACHE_SYNC_SECONDS to evict their memory tier.
+"""
+import functools
+import inspect
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from coyote.util import check_private_file, private_directory
+
+LOG = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+def make_key(args: tuple, kwargs: dict) -> str:
+    if kwargs:
+        args = args + tuple(sorted(kwargs.items()))
+    return repr(args)
+
+
+def cached(namespace: str, key=None):
+    """
+    Cache a handler method in namespace, key(*args, **kwargs) overrides the key built from the arguments
+    """
+
+    def decorator(method):
+        if inspect.iscoroutinefunction(method):
+            return _cached_coroutine(namespace, key, method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cache = getattr(self, "cache", None)
+            if cache is None or not cache.enabled(namespace):
+                return method(self, *args, **kwargs)
+            cache_key = key(*args, **kwargs) if key else make_key(args, kwargs)
+            return cache.get_or_set(namespace, cache_key, lambda: method(self, *args, **kwargs))
+
+        wrapper.uncached = method
+        return wrapper
+
+    return decorator
+
+
+def _cached_coroutine(namespace: str, key, method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        cache = getattr(self, "cache", None)
+        if cache is None or not cache.enabled(namespace):
+            return await method(self, *args, **kwargs)
+        cache_key = key(*args, **kwargs) if key else make_key(args, kwargs)
+        value = cache.get(namespace, cache_key)
+        if value is MISSING:
+            value = await method(self, *args, **kwargs)
+            cache.set(namespace, cache_key, value)
+        return value
+
+    wrapper.uncached = method
+    return wrapper
+
+
+class MemoryTier:
+    """
+    LRU with per entry expiry time
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return MISSING
+            if entry[0] <= now:
+                del self._entries[(namespace, key)]
+                return MISSING
+            self._entries.move_to_end((namespace, key))
+            return entry[1]
+
+    def set(self, namespace: str, key: str, value, ttl: float) -> list:
+        """
+        Returns the namespaces of the entries evicted to make room
+        """
+        evicted = []
+        with self._lock:
+            self._entries[(namespace, key)] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.size:
+                (evicted_namespace, _), _ = self._entries.popitem(last=False)
+                evicted.append(evicted_namespace)
+        return evicted
+
+    def delete(self, namespace: str, key: str = None) -> None:
+        with self._lock:
+            if key is not None:
+                self._entries.pop((namespace, key), None)
+                return
+            for entry_key in [k for k in self._entries if k[0] == namespace]:
+                del self._entries[entry_key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskTier:
+    """
+    sqlite file shared by the processes on a node, one connection per process
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS entries ("
+        " namespace TEXT, key TEXT, expires REAL, value BLOB, PRIMARY KEY (namespace, key))",
+        "CREATE TABLE IF NOT EXISTS events ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT, key TEXT, at REAL)",
+        "CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)",
+        "CREATE TABLE IF NOT EXISTS claims (namespace TEXT, key TEXT, expires REAL, PRIMARY KEY (namespace, key))",
+    )
+
+    def __init__(self, directory: str, max_entries: int):
+        self.path = os.path.join(directory, "cache.sqlite")
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._writes = 0
+        # Entries are unpickled, so nobody else may be able to plant them
+        private_directory(directory)
+        for suffix in ("", "-wal", "-shm"):
+            check_private_file(self.path + suffix)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections must not cross fork()
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None, check_same_thread=False
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+            self._pid = os.getpid()
+        return self._db
+
+    def get(self, namespace: str, key: str):
+        """
+        (value, seconds left) or MISSING
+        """
+        now = time.time()
+        with self._lock:
+            row = (
+                self._connection()
+                .execute(
+                    "SELECT value, expires FROM entries WHERE namespace = ? AND key = ? AND expires > ?",
+                    (namespace, key, now),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return MISSING
+        return pickle.loads(row[0]), row[1] - now
+
+    def set(self, namespace: str, key: str, value, ttl: float) -> dict:
+        """
+        Returns evicted entry counts by namespace, when this write trimmed the table
+        """
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            db = self._connection()
+            db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (namespace, key, time.time() + ttl, blob),
+            )
+            self._writes += 1
+            if self._writes % 256:
+                return {}
+            return self._trim(db)
+
+    def _trim(self, db) -> dict:
+        now = time.time()
+        evicted = defaultdict(int)
+        condition = "expires <= ?"
+        params = (now,)
+        excess = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+        if excess > 0:
+            # Expired entries and the ones closest to expiring
+            condition = (
+                "rowid IN (SELECT rowid FROM entries ORDER BY expires LIMIT ?) OR expires <= ?"
+            )
+            params = (excess, now)
+        for namespace, count in db.execute(
+            f"SELECT namespace, COUNT(*) FROM entries WHERE {condition} GROUP BY namespace", params
+        ):
+            evicted[namespace] = count
+        db.execute(f"DELETE FROM entries WHERE {condition}", params)
+        db.execute("DELETE FROM events WHERE at < ?", (now - 3600,))
+        return evicted
+
+    def delete(self, namespace: str, key: str = None, event: bool = True) -> None:
+        with self._lock:
+            db = self._connection()
+            if key is None:
+                db.execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+            else:
+                db.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+            if event:
+                db.execute(
+                    "INSERT INTO events (namespace, key, at) VALUES (?, ?, ?)",
+                    (namespace, key, time.time()),
+                )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM entries")
+
+    def claim(self, namespace: str, key: str, ttl: float) -> bool:
+        """
+        True for the one process claiming key until released or ttl seconds have passed
+        """
+        now = time.time()
+        with self._lock:
+            db = self._connection()
+            db.execute(
+                "DELETE FROM claims WHERE namespace = ? AND key = ? AND expires <= ?",
+                (namespace, key, now),
+            )
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO claims VALUES (?, ?, ?)", (namespace, key, now + ttl)
+            )
+            return cursor.rowcount == 1
+
+    def release(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._connection().execute(
+                "DELETE FROM claims WHERE namespace = ? AND key = ?", (namespace, key)
+            )
+
+    def events_after(self, event_id: int) -> list:
+        with self._lock:
+            return (
+                self._connection()
+                .execute(
+                    "SELECT id, namespace, key FROM events WHERE id > ? ORDER BY id", (event_id,)
+                )
+                .fetchall()
+            )
+
+    def last_event(self) -> int:
+        with self._lock:
+            return (
+                self._connection().execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+            )
+
+
+class Cache:
+    """
+    Flask extension with the memory and disk tiers
+    """
+
+    def __init__(self):
+        self.memory = MemoryTier(4096)
+        self.disk = None
+        self.default_ttl = 300
+        self.ttls = {}
+        self.sync_seconds = 1.0
+        self._enabled = False
+        self._last_sync = 0.0
+        self._last_event = 0
+        self._sync_pid = None
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)
+        self._evictions = defaultdict(int)
+        self._errors = 0
+
+    def init_app(self, app) -> None:
+        app.config.setdefault("CACHE_ENABLED", True)
+        app.config.setdefault("CACHE_SIZE", 4096)
+        app.config.setdefault("CACHE_DEFAULT_TTL", 300)
+        app.config.setdefault("CACHE_TTLS", {})
+        app.config.setdefault("CACHE_DIR", None)
+        app.config.setdefault("CACHE_DISK_MAX_ENTRIES", 100000)
+        app.config.setdefault("CACHE_SYNC_SECONDS", 1.0)
+
+        self._enabled = app.config["CACHE_ENABLED"]
+        self.memory = MemoryTier(app.config["CACHE_SIZE"])
+        self.default_ttl = app.config["CACHE_DEFAULT_TTL"]
+        self.ttls = dict(app.config["CACHE_TTLS"])
+        self.sync_seconds = app.config["CACHE_SYNC_SECONDS"]
+        self.disk = None
+        if self._enabled and app.config["CACHE_DIR"]:
+            try:
+                self.disk = DiskTier(app.config["CACHE_DIR"], app.config["CACHE_DISK_MAX_ENTRIES"])
+            except OSError as ex:
+                app.logger.warning(
+                    f"No shared cache in {app.config['CACHE_DIR']}, memory only: {ex}"
+                )
+        app.extensions["cache"] = self
+
+    def enabled(self, namespace: str) -> bool:
+        return self._enabled and self.ttl(namespace) > 0
+
+    def ttl(self, namespace: str) -> float:
+        return self.ttls.get(namespace, self.default_ttl)
+
+    def get(self, namespace: str, key: str):
+        """
+        Cached value or MISSING
+        """
+        if not self.enabled(namespace):
+            return MISSING
+        self._sync()
+        value = self.memory.get(namespace, key)
+        if value is not MISSING:
+            self._count(namespace, "memory", "hit")
+            return value
+        self._count(namespace, "memory", "miss")
+        if self.disk is None:
+            return MISSING
+
+        found = self._disk("get", namespace, key)
+        if found is None or found is MISSING:
+            self._count(namespace, "disk", "miss")
+            return MISSING
+        self._count(namespace, "disk", "hit")
+        value, ttl = found
+        self._memory_set(namespace, key, value, ttl)
+        return value
+
+    def set(self, namespace: str, key: str, value) -> None:
+        if not self.enabled(namespace):
+            return
+        ttl = self.ttl(namespace)
+        self._memory_set(namespace, key, value, ttl)
+        if self.disk is not None:
+            for evicted_namespace, count in (
+                self._disk("set", namespace, key, value, ttl) or {}
+            ).items():
+                self._evict(evicted_namespace, "disk", count)
+
+    def get_or_set(self, namespace: str, key: str, compute):
+        value = self.get(namespace, key)
+        if value is MISSING:
+            value = compute()
+            self.set(namespace, key, value)
+        return value
+
+    def invalidate(self, namespace: str, key: str = None, propagate: bool = True) -> None:
+        """
+        Drop key, or the whole namespace, here and from the disk tier. propagate also tells
+        the other workers on this node, not needed when each of them gets the invalidation anyway.
+        """
+        self.memory.delete(namespace, key)
+        if self.disk is not None:
+            self._disk("delete", namespace, key, propagate)
+
+    def claim(self, namespace: str, key: str, ttl: float) -> bool:
+        """
+        Claim key among the workers of the node, always granted without the disk tier
+        """
+        if self.disk is None:
+            return True
+        claimed = self._disk("claim", namespace, key, ttl)
+        return True if claimed is None else claimed
+
+    def release(self, namespace: str, key: str) -> None:
+        if self.disk is not None:
+            self._disk("release", namespace, key)
+
+    def clear(self) -> None:
+        """
+        Drop everything from this worker and the disk tier
+        """
+        self.memory.clear()
+        if self.disk is not None:
+            self._disk("clear")
+
+    def _memory_set(self, namespace: str, key: str, value, ttl: float) -> None:
+        for evicted_namespace in self.memory.set(namespace, key, value, ttl):
+            self._evict(evicted_namespace, "memory")
+
+    def _disk(self, operation: str, *args):
+        # A broken shared tier costs a miss, never the request
+        try:
+            return getattr(self.disk, operation)(*args)
+        except (sqlite3.Error, pickle.PickleError, AttributeError, TypeError) as ex:
+            with self._lock:
+                self._errors += 1
+            LOG.warning("Shared cache %s failed: %s", operation, ex)
+            return None
+
+    def _sync(self) -> None:
+        """
+        Apply invalidations other workers wrote to the disk tier
+        """
+        if self.disk is None:
+            return
+        now = time.monotonic()
+        if self._sync_pid == os.getpid() and now - self._last_sync < self.sync_seconds:
+            return
+        with self._lock:
+            if self._sync_pid == os.getpid() and now - self._last_sync < self.sync_seconds:
+                return
+            self._last_sync = now
+        if self._sync_pid is None:
+            # Nothing in memory yet that older events could concern
+            self._last_event = self._disk("last_event") or 0
+        # A forked worker continues from the events its master had seen
+        self._sync_pid = os.getpid()
+        for event_id, namespace, key in self._disk("events_after", self._last_event) or []:
+            self.memory.delete(namespace, key)
+            self._last_event = event_id
+
+    def _count(self, namespace: str, tier: str, result: str) -> None:
+        with self._lock:
+            self._requests[(namespace, tier, result)] += 1
+
+    def _evict(self, namespace: str, tier: str, count: int = 1) -> None:
+        with self._lock:
+            self._evictions[(namespace, tier)] += count
+
+    def metrics_lines(self) -> list:
+        with self._lock:
+            requests = sorted(self._requests.items())
+            evictions = sorted(self._evictions.items())
+            errors = self._errors
+        lines = [
+            "# HELP coyote_cache_requests_total Cache lookups by namespace, tier and result",
+            "# TYPE coyote_cache_requests_total counter",
+        ]
+        lines += [
+            f'coyote_cache_requests_total{{namespace="{ns}",tier="{tier}",result="{result}"}} {count}'
+            for (ns, tier, result), count in requests
+        ]
+        lines += [
+            "# HELP coyote_cache_evictions_total Entries evicted for space or expiry by namespace and tier",
+            "# TYPE coyote_cache_evictions_total counter",
+        ]
+        lines += [
+            f'coyote_cache_evictions_total{{namespace="{ns}",tier="{tier}"}} {count}'
+            for (ns, tier), count in evictions
+        ]
+        lines += [
+            "# HELP coyote_cache_entries Entries in the memory tier of this worker",
+            "# TYPE coyote_cache_entries gauge",
+            f"coyote_cache_entries {len(self.memory)}",
+            "# HELP coyote_cache_errors_total Failed reads and writes of the shared disk tier",
+            "# TYPE coyote_cache_errors_total counter",
+            f"coyote_cache_errors_total {errors}",
+        ]
+        return lines
@@ -0,0 +1,271 @@
+"""
+Capture of the mongo workload of live requests, for replay against a dump.
+
+With CAPTURE_ENABLED, a CAPTURE_SAMPLE_RATE share of requests record the
+mongo commands they issue, in order, with duration, documents returned
+and (CAPTURE_BYTES) reply size. getMores are counted with the command
+that opened their cursor. Each request is one JSON line (Extended JSON
+commands) in CAPTURE_DIR/capture-<host>-<pid>.jsonl, holding its endpoint
+and url rule, status and duration. A worker stops capturing once its
+file reaches CAPTURE_MAX_BYTES.
+
+With CAPTURE_ANONYMIZE_KEY set, the string values of the fields in
+CAPTURE_ANONYMIZE_FIELDS (collection -> field names, anywhere in a
+command on that collection) are replaced by keyed HMAC pseudonyms, and
+view arguments are dropped. Equal values still match each other, so
+benchmarks/replay.py can pseudonymize a restored dump with the same key
+and replay against it. Regex searches on those fields match nothing then.
+
+Commands are attributed through the request context, as by the timing
+instrumentation, so those issued by the motor adapter (VARIANTS_ASYNC)
+on its event loop thread are not captured.
+"""
+import hashlib
+import hmac
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+import bson
+from bson import json_util
+from flask import g, has_request_context, request
+from pymongo import monitoring
+
+from coyote.extensions.querystats import COLLECTION_COMMANDS, MAX_OPEN_CURSORS, awaits_data
+
+LOG = logging.getLogger(__name__)
+
+
+PSEUDONYM_PREFIX = "anon-"
+
+
+def pseudonym(key: bytes, value: str) -> str:
+    return PSEUDONYM_PREFIX + hmac.new(key, value.encode(), hashlib.sha256).hexdigest()[:20]
+
+
+def pseudonymize(value, fields: frozenset, key: bytes, inside: bool = False):
+    """
+    Copy of value with the strings under the keys in fields, at any depth, pseudonymized.
+    Pseudonyms are left as they are, so pseudonymizing twice changes nothing.
+    """
+    if isinstance(value, dict):
+        return {k: pseudonymize(v, fields, key, inside or k in fields) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [pseudonymize(v, fields, key, inside) for v in value]
+    if inside and isinstance(value, str) and not value.startswith(PSEUDONYM_PREFIX):
+        return pseudonym(key, value)
+    return value
+
+
+class CapturedCommand:
+    """
+    One command of a captured request, its cursor's getMores included
+    """
+
+    __slots__ = ("database", "collection", "name", "command", "ms", "docs", "bytes")
+
+    def __init__(self, database: str, collection: str, name: str, command: dict):
+        self.database = database
+        self.collection = collection
+        self.name = name
+        self.command = command
+        self.ms = 0.0
+        self.docs = 0
+        self.bytes = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "db": self.database,
+            "collection": self.collection,
+            "name": self.name,
+            "command": self.command,
+            "ms": round(self.ms, 3),
+            "docs": self.docs,
+            "bytes": self.bytes,
+        }
+
+
+class WorkloadCapture(monitoring.CommandListener):
+    """
+    Flask extension and pymongo CommandListener writing the commands of sampled requests
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._cursors = {}
+        self._file = None
+        self._pid = None
+        self._registered = False
+        self.enabled = False
+        self.directory = None
+        self.sample_rate = 1.0
+        self.measure_bytes = True
+        self.max_bytes = 0
+        self.anonymize_key = None
+        self.anonymize_fields = {}
+        self.requests = 0
+        self.commands = 0
+        self.full = False
+
+    def init_app(self, app) -> None:
+        app.config.setdefault("CAPTURE_ENABLED", False)
+        app.config.setdefault("CAPTURE_DIR", "/tmp/coyote-capture")
+        app.config.setdefault("CAPTURE_SAMPLE_RATE", 1.0)
+        app.config.setdefault("CAPTURE_BYTES", True)
+        app.config.setdefault("CAPTURE_MAX_BYTES", 512 * 1024 * 1024)
+        app.config.setdefault("CAPTURE_ANONYMIZE_KEY", None)
+        app.config.setdefault("CAPTURE_ANONYMIZE_FIELDS", {})
+
+        self.enabled = app.config["CAPTURE_ENABLED"]
+        self.directory = app.config["CAPTURE_DIR"]
+        self.sample_rate = app.config["CAPTURE_SAMPLE_RATE"]
+        self.measure_bytes = app.config["CAPTURE_BYTES"]
+        self.max_bytes = app.config["CAPTURE_MAX_BYTES"]
+        key = app.config["CAPTURE_ANONYMIZE_KEY"]
+        self.anonymize_key = key.encode() if isinstance(key, str) else key
+        self.anonymize_fields = {
+            collection: frozenset(fields)
+            for collection, fields in app.config["CAPTURE_ANONYMIZE_FIELDS"].items()
+        }
+        app.extensions["capture"] = self
+
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # Process wide, applies to every MongoClient created afterwards
+        if not self._registered:
+            monitoring.register(self)
+            self._registered = True
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    # Requests
+
+    def _before_request(self):
+        if not self.full and random.random() < self.sample_rate:
+            g.coyote_capture = (time.perf_counter(), [])
+
+    def _after_request(self, response):
+        captured = g.pop("coyote_capture", None)
+        if captured is None:
+            return response
+        start, commands = captured
+        line = {
+            "time": time.time(),
+            "method": request.method,
+            "endpoint": request.endpoint,
+            "rule": request.url_rule.rule if request.url_rule else None,
+            "status": response.status_code,
+            "ms": round((time.perf_counter() - start) * 1000, 3),
+            "commands": [command.as_dict() for command in commands],
+        }
+        if self.anonymize_key is None:
+            line["args"] = request.view_args
+        self._write(json_util.dumps(line, json_options=json_util.RELAXED_JSON_OPTIONS))
+        return response
+
+    def _write(self, line: str) -> None:
+        with self._lock:
+            if self._pid != os.getpid():
+                # Workers forked from a preloading master write their own file
+                path = os.path.join(
+                    self.directory, f"capture-{socket.gethostname()}-{os.getpid()}.jsonl"
+                )
+                self._file = open(path, "a", encoding="utf-8")
+                self._pid = os.getpid()
+            if self.full:
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.requests += 1
+            if self.max_bytes and self._file.tell() >= self.max_bytes:
+                self.full = True
+                LOG.warning(
+                    "Capture file %s reached CAPTURE_MAX_BYTES, capture stopped", self._file.name
+                )
+
+    # CommandListener
+
+    def started(self, event):
+        if event.command_name == "killCursors":
+            # Cursors closed before they were exhausted, also outside requests
+            with self._lock:
+                for cursor_id in event.command.get("cursors", []):
+                    self._cursors.pop(cursor_id, None)
+            return
+        if not has_request_context():
+            return
+        captured = g.get("coyote_capture")
+        if captured is None:
+            return
+        cursor_id = None
+        if event.command_name == "getMore":
+            cursor_id = event.command.get("getMore")
+            with self._lock:
+                command = self._cursors.get(cursor_id)
+        elif event.command_name in COLLECTION_COMMANDS and not awaits_data(event.command):
+            collection = event.command.get(event.command_name)
+            doc = {
+                key: val
+                for key, val in event.command.items()
+                if not key.startswith("$") and key != "lsid"
+            }
+            fields = self.anonymize_fields.get(collection)
+            if self.anonymize_key is not None and fields:
+                doc = pseudonymize(doc, fields, self.anonymize_key)
+            command = CapturedCommand(event.database_name, collection, event.command_name, doc)
+            captured[1].append(command)
+        else:
+            return
+        if command is not None:
+            with self._lock:
+                # Succeeded and failed events do not carry the command, keep the getMore's cursor id
+                self._pending[(event.connection_id, event.request_id)] = (command, cursor_id)
+
+    def succeeded(self, event):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        command, cursor_id = pending
+        reply = event.reply or {}
+        command.ms += event.duration_micros / 1000
+        cursor = reply.get("cursor")
+        if isinstance(cursor, dict):
+            command.docs += len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+            with self._lock:
+                if cursor.get("id"):
+                    self._cursors[cursor["id"]] = command
+                    if len(self._cursors) > MAX_OPEN_CURSORS:
+                        # Cursors left to time out on the server, never killed nor exhausted
+                        del self._cursors[next(iter(self._cursors))]
+                else:
+                    self._cursors.pop(cursor_id, None)
+        elif "n" in reply:
+            command.docs += reply["n"]
+        if self.measure_bytes:
+            command.bytes += len(bson.encode(reply))
+        self.commands += 1
+
+    def failed(self, event):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+            if pending is not None:
+                self._cursors.pop(pending[1], None)
+        if pending is not None:
+            pending[0].ms += event.duration_micros / 1000
+
+    def metrics_lines(self) -> list:
+        return [
+            "# HELP coyote_capture_requests_total Requests written to the workload capture",
+            "# TYPE coyote_capture_requests_total counter",
+            f"coyote_capture_requests_total {self.requests}",
+            "# HELP coyote_capture_commands_total Mongo commands recorded by the workload capture",
+            "# TYPE coyote_capture_commands_total counter",
+            f"coyote_capture_commands_total {self.commands}",
+            f"coyote_capture_full {int(self.full)}",
+        ]
@@ -0,0 +1,368 @@
+"""
+Request timing instrumentation.
+
+Named spans (context manager or decorator), a pymongo CommandListener that
+attributes database time and command counts to the current request,
+Server-Timing response headers and per-route latency summaries exported in
+Prometheus text format on /metrics.
+
+Requests reporting row counts with rows() also get their RSS and the
+process peak RSS logged, for tuning ROW_BUDGET.
+
+Metrics are kept per process, so each gunicorn worker reports its own.
+"""
+import bisect
+import functools
+import logging
+import os
+import resource
+import threading
+import time
+from collections import defaultdict, deque
+
+from flask import Response, current_app, g, has_request_context, request
+from pymongo import monitoring
+
+LOG = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+# Server error code for operations exceeding maxTimeMS
+MAX_TIME_MS_EXPIRED = 50
+MIB = 1024 * 1024
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes() -> int:
+    """
+    Current resident set size, the peak where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RequestTimings:
+    """
+    Spans and database time for one request, stored on flask.g
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.db_seconds = 0.0
+        self.db_commands = 0
+        self.rows = {}
+        self.rss_start = None
+        self.peak_start = None
+
+    def add(self, name: str, seconds: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def server_timing(self, total: float) -> str:
+        parts = [f'db;dur={self.db_seconds * 1000:.1f};desc="mongo {self.db_commands} cmds"']
+        parts += [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.spans.items()]
+        parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+
+def current_timings():
+    if has_request_context():
+        return g.get("coyote_timings")
+    return None
+
+
+class Span:
+    """
+    Time a block or a function as a named span of the current request.
+    Outside a request it does nothing.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._starts = threading.local()
+
+    def __enter__(self):
+        stack = getattr(self._starts, "stack", None)
+        if stack is None:
+            stack = self._starts.stack = []
+        stack.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._starts.stack.pop()
+        timings = current_timings()
+        if timings is not None:
+            timings.add(self.name, elapsed)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    Adds the duration of every mongo command to the request that issued it.
+    pymongo calls listeners on the thread running the command.
+    """
+
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+
+    def started(self, event):
+        timings = current_timings()
+        if timings is not None:
+            timings.db_commands += 1
+
+    def succeeded(self, event):
+        timings = current_timings()
+        if timings is not None:
+            timings.db_seconds += event.duration_micros / 1e6
+
+    def failed(self, event):
+        self.succeeded(event)
+        if isinstance(event.failure, dict) and event.failure.get("code") == MAX_TIME_MS_EXPIRED:
+            self.instrumentation.inc("coyote_mongo_timeouts_total", command=event.command_name)
+
+
+class Summary:
+    """
+    Count, sum and sliding window quantiles for one series
+    """
+
+    def __init__(self, window: int):
+        self.count = 0
+        self.total = 0.0
+        self.window = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.window.append(value)
+
+    def quantiles(self) -> dict:
+        values = sorted(self.window)
+        if not values:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES}
+
+
+class Histogram:
+    """
+    Cumulative bucket counts for one series, Prometheus style
+    """
+
+    def __init__(self, buckets: list):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            yield bound, total
+
+
+class Instrumentation:
+    """
+    Flask extension collecting request timings and serving /metrics
+    """
+
+    def __init__(self):
+        self.command_listener = CommandTimer(self)
+        self._lock = threading.Lock()
+        self._window = 1024
+        self._buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+        self._latency = {}
+        self._latency_buckets = {}
+        self._db_queries = {}
+        self._db_seconds = defaultdict(float)
+        self._counters = defaultdict(float)
+        self._collectors = []
+        self._listener_registered = False
+
+    def init_app(self, app) -> None:
+        app.config.setdefault("INSTRUMENTATION_ENABLED", True)
+        app.config.setdefault("SERVER_TIMING_HEADER", True)
+        app.config.setdefault("METRICS_WINDOW", 1024)
+        app.config.setdefault("METRICS_BUCKETS", self._buckets)
+
+        self._window = app.config["METRICS_WINDOW"]
+        self._buckets = list(app.config["METRICS_BUCKETS"])
+        app.extensions["instrumentation"] = self
+
+        if not app.config["INSTRUMENTATION_ENABLED"]:
+            return
+
+        # Process wide, applies to every MongoClient created afterwards
+        if not self._listener_registered:
+            monitoring.register(self.command_listener)
+            self._listener_registered = True
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule("/metrics", "metrics", self.metrics_view)
+
+    def span(self, name: str) -> Span:
+        return Span(name)
+
+    def record(self, name: str, seconds: float) -> None:
+        """
+        Add an already measured duration as a span of the current request
+        """
+        timings = current_timings()
+        if timings is not None:
+            timings.add(name, seconds)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Increase a counter exported on /metrics
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def rows(self, name: str, count: int) -> None:
+        """
+        Record rows materialized by the current request, its memory use is then logged
+        """
+        timings = current_timings()
+        if timings is None:
+            return
+        if timings.rss_start is None:
+            timings.rss_start = rss_bytes()
+            timings.peak_start = peak_rss_bytes()
+        timings.rows[name] = timings.rows.get(name, 0) + count
+
+    def register_collector(self, collector) -> None:
+        """
+        collector() returns extra Prometheus text lines for /metrics
+        """
+        self._collectors.append(collector)
+
+    def _before_request(self):
+        g.coyote_timings = RequestTimings()
+
+    def _after_request(self, response):
+        timings = g.pop("coyote_timings", None)
+        if timings is None:
+            return response
+        total = time.perf_counter() - timings.start
+        route = request.endpoint or "unmatched"
+        if route != "metrics":
+            self._observe(route, total, timings)
+        if timings.rows:
+            self._log_memory(route, timings)
+        if current_app.config["SERVER_TIMING_HEADER"]:
+            response.headers["Server-Timing"] = timings.server_timing(total)
+        return response
+
+    @staticmethod
+    def _log_memory(route: str, timings: RequestTimings) -> None:
+        peak = peak_rss_bytes()
+        LOG.info(
+            "%s rows %s, rss %.0f -> %.0f MiB, process peak %.0f MiB (%+.0f MiB)",
+            route,
+            timings.rows,
+            timings.rss_start / MIB,
+            rss_bytes() / MIB,
+            peak / MIB,
+            (peak - timings.peak_start) / MIB,
+        )
+
+    def _observe(self, route: str, total: float, timings: RequestTimings) -> None:
+        with self._lock:
+            if route not in self._latency:
+                self._latency[route] = Summary(self._window)
+                self._latency_buckets[route] = Histogram(self._buckets)
+                self._db_queries[route] = Summary(self._window)
+            self._latency[route].observe(total)
+            self._latency_buckets[route].observe(total)
+            self._db_queries[route].observe(timings.db_commands)
+            self._db_seconds[route] += timings.db_seconds
+
+    def metrics_view(self):
+        return Response(self.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+    def render_metrics(self) -> str:
+        lines = []
+        with self._lock:
+            lines += [
+                "# HELP coyote_request_duration_seconds Request latency per route",
+                "# TYPE coyote_request_duration_seconds summary",
+            ]
+            for route, summary in sorted(self._latency.items()):
+                lines += _summary_lines("coyote_request_duration_seconds", route, summary)
+
+            lines += [
+                "# HELP coyote_request_duration_hist_seconds Request latency buckets per route",
+                "# TYPE coyote_request_duration_hist_seconds histogram",
+            ]
+            for route, hist in sorted(self._latency_buckets.items()):
+                for bound, count in hist.cumulative():
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(
+                        f'coyote_request_duration_hist_seconds_bucket{{route="{route}",le="{le}"}} {count}'
+                    )
+                lines.append(
+                    f'coyote_request_duration_hist_seconds_count{{route="{route}"}} {self._latency[route].count}'
+                )
+                lines.append(
+                    f'coyote_request_duration_hist_seconds_sum{{route="{route}"}} {self._latency[route].total:.6f}'
+                )
+
+            lines += [
+                "# HELP coyote_request_db_queries Mongo commands per request",
+                "# TYPE coyote_request_db_queries summary",
+            ]
+            for route, summary in sorted(self._db_queries.items()):
+                lines += _summary_lines("coyote_request_db_queries", route, summary)
+
+            lines += [
+                "# HELP coyote_request_db_seconds_total Time spent in mongo commands per route",
+                "# TYPE coyote_request_db_seconds_total counter",
+            ]
+            for route, seconds in sorted(self._db_seconds.items()):
+                lines.append(f'coyote_request_db_seconds_total{{route="{route}"}} {seconds:.6f}')
+
+            for (name, labels), value in sorted(self._counters.items()):
+                label_str = ",".join(f'{key}="{val}"' for key, val in labels)
+                lines.append(
+                    f"{name}{{{label_str}}} {value:g}" if label_str else f"{name} {value:g}"
+                )
+
+        lines += [
+            "# HELP coyote_process_peak_rss_bytes Peak resident set size of this worker",
+            "# TYPE coyote_process_peak_rss_bytes gauge",
+            f"coyote_process_peak_rss_bytes {peak_rss_bytes()}",
+        ]
+        for collector in self._collectors:
+            try:
+                lines += list(collector())
+            except Exception:
+                LOG.exception("Metrics collector %r failed", collector)
+        return "\n".join(lines) + "\n"
+
+
+def _summary_lines(name: str, route: str, summary: Summary) -> list:
+    lines = [
+        f'{name}{{route="{route}",quantile="{q}"}} {value:.6f}'
+        for q, value in summary.quantiles().items()
+    ]
+    lines.append(f'{name}_count{{route="{route}"}} {summary.count}')
+    lines.append(f'{name}_sum{{route="{route}"}} {summary.total:.6f}')
+    return lines
@@ -0,0 +1,212 @@
+"""
+Cache invalidation across nodes.
+
+Writers call publish(namespace, key), which invalidates the local cache
+and appends {namespace, key, origin} to a capped collection. Each worker
+process tails that collection with a tailable await cursor in a
+background thread and drops the matching entries from its memory tier
+and from the node's disk tier, so a write on one node reaches the caches
+of every other node within one round trip.
+
+The listener starts on the first request of each worker process (threads
+do not survive the gunicorn fork) and reconnects after errors. It reads
+in natural (insertion) order and resumes after the last event it saw,
+ObjectIds of different hosts are not ordered. If the capped collection
+has wrapped past that event, events were lost and the whole cache is
+dropped.
+
+External loaders (panels, canonical transcripts) publish with:
+
+    flask cache-invalidate reference panels
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+import click
+import pymongo
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+LOG = logging.getLogger(__name__)
+
+
+class InvalidationBus:
+    """
+    Flask extension publishing and tailing cache invalidation events
+    """
+
+    def __init__(self):
+        self.cache = None
+        self.store = None
+        self.enabled = False
+        self.collection_name = "cache_events"
+        self.collection_size = 1024 * 1024
+        self.retry_seconds = 5.0
+        self.published = 0
+        self.received = 0
+        self.resets = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._collection_pid = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._last_id = None
+
+    def init_app(self, app, cache, store) -> None:
+        app.config.setdefault("INVALIDATION_BUS_ENABLED", True)
+        app.config.setdefault("INVALIDATION_COLLECTION", "cache_events")
+        app.config.setdefault("INVALIDATION_COLLECTION_SIZE", 1024 * 1024)
+        app.config.setdefault("INVALIDATION_RETRY_SECONDS", 5.0)
+
+        self.cache = cache
+        self.store = store
+        self.enabled = app.config["INVALIDATION_BUS_ENABLED"]
+        self.collection_name = app.config["INVALIDATION_COLLECTION"]
+        self.collection_size = app.config["INVALIDATION_COLLECTION_SIZE"]
+        self.retry_seconds = app.config["INVALIDATION_RETRY_SECONDS"]
+        app.extensions["invalidation"] = self
+        app.cli.add_command(invalidate_command)
+
+        if self.enabled:
+            app.before_request(self._ensure_listener)
+
+    @property
+    def origin(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    @property
+    def collection(self) -> pymongo.collection.Collection:
+        return self.store.client[self.store.db_name][self.collection_name]
+
+    def publish(self, namespace: str, key: str = None) -> None:
+        """
+        Invalidate here and tell every other worker. A failed publish is logged, the other nodes then expire by TTL.
+        """
+        self.cache.invalidate(namespace, key)
+        if not self.enabled:
+            return
+        event = {"namespace": namespace, "key": key, "origin": self.origin, "at": time.time()}
+        try:
+            self._ensure_collection()
+            self.collection.insert_one(event)
+            self.published += 1
+        except PyMongoError as ex:
+            self.errors += 1
+            LOG.warning("Could not publish invalidation of %s %s: %s", namespace, key, ex)
+
+    def _ensure_collection(self) -> None:
+        if self._collection_pid == os.getpid():
+            return
+        db = self.store.client[self.store.db_name]
+        if self.collection_name not in db.list_collection_names():
+            try:
+                db.create_collection(self.collection_name, capped=True, size=self.collection_size)
+                # A tailable cursor on an empty collection dies at once, start with a marker
+                db[self.collection_name].insert_one(
+                    {"namespace": None, "origin": self.origin, "at": time.time()}
+                )
+            except CollectionInvalid:
+                # Created by another process meanwhile
+                pass
+        self._collection_pid = os.getpid()
+
+    # Listener
+
+    def _ensure_listener(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(
+                target=self._listen, name="coyote-invalidation", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _listen(self) -> None:
+        self._last_id = None
+        while not self._stop.is_set():
+            try:
+                self._ensure_collection()
+                self._tail()
+            except PyMongoError as ex:
+                self.errors += 1
+                LOG.warning(
+                    "Invalidation listener failed, retrying in %ss: %s", self.retry_seconds, ex
+                )
+            self._stop.wait(self.retry_seconds)
+
+    def _tail(self) -> None:
+        collection = self.collection
+        if (
+            self._last_id is not None
+            and collection.find_one({"_id": self._last_id}, {"_id": 1}) is None
+        ):
+            # Overwritten in the capped collection, together with any events after it not seen yet
+            LOG.warning(
+                "Invalidation events were lost while disconnected, dropping the whole cache"
+            )
+            self.resets += 1
+            self.cache.clear()
+            self._last_id = None
+        if self._last_id is None:
+            newest = collection.find_one({}, sort=[("$natural", -1)])
+            if newest is None:
+                return
+            self._last_id = newest["_id"]
+
+        cursor = collection.find(cursor_type=pymongo.CursorType.TAILABLE_AWAIT).max_await_time_ms(
+            1000
+        )
+        resumed = False
+        while cursor.alive and not self._stop.is_set():
+            for event in cursor:
+                if resumed:
+                    self.apply(event)
+                else:
+                    resumed = event["_id"] == self._last_id
+                if self._stop.is_set():
+                    break
+
+    def apply(self, event: dict) -> None:
+        self._last_id = event["_id"]
+        if event.get("namespace") is None or event.get("origin") == self.origin:
+            return
+        self.received += 1
+        self.cache.invalidate(event["namespace"], event.get("key"), propagate=False)
+
+    def metrics_lines(self) -> list:
+        return [
+            "# HELP coyote_invalidation_events_total Cache invalidation events by direction",
+            "# TYPE coyote_invalidation_events_total counter",
+            f'coyote_invalidation_events_total{{direction="published"}} {self.published}',
+            f'coyote_invalidation_events_total{{direction="received"}} {self.received}',
+            "# HELP coyote_invalidation_resets_total Whole cache drops after lost events",
+            "# TYPE coyote_invalidation_resets_total counter",
+            f"coyote_invalidation_resets_total {self.resets}",
+            "# HELP coyote_invalidation_errors_total Failed publishes and listener errors",
+            "# TYPE coyote_invalidation_errors_total counter",
+            f"coyote_invalidation_errors_total {self.errors}",
+        ]
+
+
+@click.command("cache-invalidate")
+@click.argument("namespace")
+@click.argument("key", required=False)
+@with_appcontext
+def invalidate_command(namespace, key):
+    """
+    Drop a cache namespace, or one key of it, on every node
+    """
+    current_app.extensions["invalidation"].publish(namespace, key)
+    click.echo(f"Invalidated {namespace} {key or '(all keys)'}")
@@ -1,70 +1,351 @@
-import logging
-import ssl
-
-from flask_ldapconn import LDAPConn
-from ldap3 import ALL, SYNC, Server, Tls
-
-LOG = logging.getLogger(__name__)
-
-
-class LdapManager(LDAPConn):
-    """Interface to LDAP login"""
-
-    def init_app(self, app):
-        ssl_defaults = ssl.get_default_verify_paths()
-
-        # Default config
-        app.config.setdefault("LDAP_SERVER", "localhost")
-        app.config.setdefault("LDAP_PORT", 389)
-        app.config.setdefault("LDAP_BINDDN", None)
-        app.config.setdefault("LDAP_SECRET", None)
-        app.config.setdefault("LDAP_CONNECT_TIMEOUT", 10)
-        app.config.setdefault("LDAP_READ_ONLY", False)
-        app.config.setdefault("LDAP_VALID_NAMES", None)
-        app.config.setdefault("LDAP_PRIVATE_KEY_PASSWORD", None)
-        app.config.setdefault("LDAP_RAISE_EXCEPTIONS", False)
-
-        app.config.setdefault("LDAP_CONNECTION_STRATEGY", SYNC)
-
-        app.config.setdefault("LDAP_USE_SSL", False)
-        app.config.setdefault("LDAP_USE_TLS", True)
-        app.config.setdefault("LDAP_TLS_VERSION", ssl.PROTOCOL_TLSv1_2)
-        app.config.setdefault("LDAP_REQUIRE_CERT", ssl.CERT_REQUIRED)
-
-        app.config.setdefault("LDAP_CLIENT_PRIVATE_KEY", None)
-        app.config.setdefault("LDAP_CLIENT_CERT", None)
-
-        app.config.setdefault("LDAP_CA_CERTS_FILE", ssl_defaults.cafile)
-        app.config.setdefault("LDAP_CA_CERTS_PATH", ssl_defaults.capath)
-        app.config.setdefault("LDAP_CA_CERTS_DATA", None)
-
-        app.config.setdefault("FORCE_ATTRIBUTE_VALUE_AS_LIST", False)
-
-        self.tls = Tls(
-            local_private_key_file=app.config["LDAP_CLIENT_PRIVATE_KEY"],
-            local_certificate_file=app.config["LDAP_CLIENT_CERT"],
-            validate=app.config["LDAP_REQUIRE_CERT"]
-            if app.config.get("LDAP_CLIENT_CERT")
-            else ssl.CERT_NONE,
-            version=app.config["LDAP_TLS_VERSION"],
-            ca_certs_file=app.config["LDAP_CA_CERTS_FILE"],
-            valid_names=app.config["LDAP_VALID_NAMES"],
-            ca_certs_path=app.config["LDAP_CA_CERTS_PATH"],
-            ca_certs_data=app.config["LDAP_CA_CERTS_DATA"],
-            local_private_key_password=app.config["LDAP_PRIVATE_KEY_PASSWORD"],
-        )
-
-        self.ldap_server = Server(
-            host=app.config.get("LDAP_HOST") or app.config.get("LDAP_SERVER"),
-            port=app.config["LDAP_PORT"],
-            use_ssl=app.config["LDAP_USE_SSL"],
-            connect_timeout=app.config["LDAP_CONNECT_TIMEOUT"],
-            tls=self.tls,
-            get_info=ALL,
-        )
-
-        # Store ldap_conn object to extensions
-        app.extensions["ldap_conn"] = self
-
-        # Teardown appcontext
-        app.teardown_appcontext(self.teardown)
\ No newline at end of file
+"""
+LDAP login.
+
+Lookups of user DNs go through service connections bound once as
+LDAP_BINDDN and reused across requests, and user binds reuse an open
+connection with rebind() instead of a new TLS handshake per login. Each
+kind is kept in a pool of up to LDAP_POOL_SIZE idle connections per
+process. A login checks a connection out and uses it alone, so logins
+run concurrently and a slow server only holds up its own requests.
+Successful logins are remembered for LDAP_AUTH_CACHE_TTL seconds as an
+HMAC of username and password under a random per-process key, so a
+repeated login skips the directory without any password being kept.
+
+Set LDAP_CONNECTION_STRATEGY to ldap3.MOCK_SYNC to run against an
+in-memory directory, e.g. for local development.
+
+ldap3 is imported and the Server built on the first login, keeping them
+out of app start-up.
+"""
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import ssl
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from flask import current_app
+
+LOG = logging.getLogger(__name__)
+
+# LDAP_GET_INFO names to ldap3 constants
+GET_INFO = {"ALL": "ALL", "DSA": "DSA", "SCHEMA": "SCHEMA", "NONE": "NO_INFO"}
+
+
+class AuthCache:
+    """
+    Bounded, expiring set of recently verified (username, password) HMACs
+    """
+
+    def __init__(self, ttl: float = 300, size: int = 256):
+        self.ttl = ttl
+        self.size = size
+        self._key = secrets.token_bytes(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, username: str, password: str) -> bytes:
+        return hmac.new(self._key, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+
+    def check(self, username: str, password: str) -> bool:
+        if self.ttl <= 0:
+            return False
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return False
+            expires, digest = entry
+            if expires <= time.monotonic():
+                del self._entries[username]
+                return False
+        return hmac.compare_digest(digest, self._digest(username, password))
+
+    def add(self, username: str, password: str) -> None:
+        if self.ttl <= 0:
+            return
+        digest = self._digest(username, password)
+        with self._lock:
+            self._entries.pop(username, None)
+            self._entries[username] = (time.monotonic() + self.ttl, digest)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, username: str) -> None:
+        with self._lock:
+            self._entries.pop(username, None)
+
+
+class ConnectionPool:
+    """
+    Idle LDAP connections of one kind. get() checks one out for the caller
+    alone, put() returns it. The lock only guards the list, never I/O.
+    """
+
+    def __init__(self, size: int = 4):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self):
+        """
+        An idle connection, None when there is none and the caller opens one
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections opened by the gunicorn master are not used in workers
+                self._idle = []
+                self._pid = os.getpid()
+            return self._idle.pop() if self._idle else None
+
+    def put(self, conn) -> None:
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.unbind()
+
+    def __len__(self) -> int:
+        return len(self._idle)
+
+
+class LdapManager:
+    """Interface to LDAP login"""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._server = None
+        self._service_pool = ConnectionPool()
+        self._auth_pool = ConnectionPool()
+        self.auth_cache = AuthCache()
+        self.stats = Counter({"cache_hits": 0, "binds": 0, "failures": 0, "reconnects": 0})
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        ssl_defaults = ssl.get_default_verify_paths()
+
+        # Default config
+        app.config.setdefault("LDAP_SERVER", "localhost")
+        app.config.setdefault("LDAP_PORT", 389)
+        app.config.setdefault("LDAP_BINDDN", None)
+        app.config.setdefault("LDAP_SECRET", None)
+        app.config.setdefault("LDAP_CONNECT_TIMEOUT", 10)
+        app.config.setdefault("LDAP_READ_ONLY", False)
+        app.config.setdefault("LDAP_VALID_NAMES", None)
+        app.config.setdefault("LDAP_PRIVATE_KEY_PASSWORD", None)
+        app.config.setdefault("LDAP_RAISE_EXCEPTIONS", False)
+
+        app.config.setdefault("LDAP_CONNECTION_STRATEGY", "SYNC")
+
+        app.config.setdefault("LDAP_USE_SSL", False)
+        app.config.setdefault("LDAP_USE_TLS", True)
+        app.config.setdefault("LDAP_TLS_VERSION", ssl.PROTOCOL_TLSv1_2)
+        app.config.setdefault("LDAP_REQUIRE_CERT", ssl.CERT_REQUIRED)
+
+        app.config.setdefault("LDAP_CLIENT_PRIVATE_KEY", None)
+        app.config.setdefault("LDAP_CLIENT_CERT", None)
+
+        app.config.setdefault("LDAP_CA_CERTS_FILE", ssl_defaults.cafile)
+        app.config.setdefault("LDAP_CA_CERTS_PATH", ssl_defaults.capath)
+        app.config.setdefault("LDAP_CA_CERTS_DATA", None)
+
+        app.config.setdefault("FORCE_ATTRIBUTE_VALUE_AS_LIST", False)
+
+        # Server info read at connect time, ALL also reads the schema
+        app.config.setdefault("LDAP_GET_INFO", "NONE")
+        app.config.setdefault("LDAP_AUTH_CACHE_TTL", 300)
+        app.config.setdefault("LDAP_AUTH_CACHE_SIZE", 256)
+        app.config.setdefault("LDAP_POOL_SIZE", 4)
+
+        self.config = app.config
+        self._server = None
+        self.use_tls = app.config["LDAP_USE_TLS"]
+        self.strategy = app.config["LDAP_CONNECTION_STRATEGY"]
+        self.auth_cache = AuthCache(
+            app.config["LDAP_AUTH_CACHE_TTL"], app.config["LDAP_AUTH_CACHE_SIZE"]
+        )
+        self._service_pool = ConnectionPool(app.config["LDAP_POOL_SIZE"])
+        self._auth_pool = ConnectionPool(app.config["LDAP_POOL_SIZE"])
+
+        # Store ldap_conn object to extensions
+        app.extensions["ldap_conn"] = self
+
+        # Teardown appcontext
+        app.teardown_appcontext(self.teardown)
+
+    @property
+    def ldap_server(self):
+        if self._server is None:
+            from ldap3 import Server, Tls
+
+            config = self.config
+            tls = Tls(
+                local_private_key_file=config["LDAP_CLIENT_PRIVATE_KEY"],
+                local_certificate_file=config["LDAP_CLIENT_CERT"],
+                validate=config["LDAP_REQUIRE_CERT"]
+                if config.get("LDAP_CLIENT_CERT")
+                else ssl.CERT_NONE,
+                version=config["LDAP_TLS_VERSION"],
+                ca_certs_file=config["LDAP_CA_CERTS_FILE"],
+                valid_names=config["LDAP_VALID_NAMES"],
+                ca_certs_path=config["LDAP_CA_CERTS_PATH"],
+                ca_certs_data=config["LDAP_CA_CERTS_DATA"],
+                local_private_key_password=config["LDAP_PRIVATE_KEY_PASSWORD"],
+            )
+            self._server = Server(
+                host=config.get("LDAP_HOST") or config.get("LDAP_SERVER"),
+                port=config["LDAP_PORT"],
+                use_ssl=config["LDAP_USE_SSL"],
+                connect_timeout=config["LDAP_CONNECT_TIMEOUT"],
+                tls=tls,
+                get_info=GET_INFO[config["LDAP_GET_INFO"].upper()],
+            )
+        return self._server
+
+    def connect(self, user, password, anonymous=False):
+        """
+        Open, start TLS and bind, raising LDAPBindError for bad credentials
+        """
+        from ldap3 import Connection
+        from ldap3.core.exceptions import LDAPBindError
+
+        conn = Connection(
+            self.ldap_server,
+            client_strategy=self.strategy,
+            raise_exceptions=current_app.config["LDAP_RAISE_EXCEPTIONS"],
+            user=None if anonymous else user,
+            password=None if anonymous else password,
+            read_only=current_app.config["LDAP_READ_ONLY"],
+        )
+        conn.open()
+        if self.use_tls:
+            conn.start_tls()
+        if not conn.bind():
+            conn.unbind()
+            raise LDAPBindError(conn.last_error or "invalid credentials")
+        return conn
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def _service_connection(self):
+        """
+        A bound service connection checked out of the pool, return it with _service_pool.put()
+        """
+        conn = self._service_pool.get()
+        if conn is not None and not conn.closed and conn.bound:
+            return conn
+        if conn is not None:
+            self._count("reconnects")
+        binddn = current_app.config["LDAP_BINDDN"]
+        secret = current_app.config["LDAP_SECRET"]
+        return self.connect(binddn, secret, anonymous=None in [binddn, secret])
+
+    def teardown(self, exception):
+        # Pooled connections outlive the request
+        pass
+
+    def find_user_dn(
+        self, username, attribute, base_dn, search_filter=None, search_scope="SUBTREE"
+    ):
+        from ldap3.core.exceptions import LDAPException
+        from ldap3.utils.conv import escape_filter_chars
+
+        user_filter = f"({attribute}={escape_filter_chars(username)})"
+        if search_filter is not None:
+            user_filter = f"(&{user_filter}{search_filter})"
+        for attempt in range(2):
+            conn = self._service_connection()
+            try:
+                conn.search(base_dn, user_filter, search_scope, attributes=[attribute])
+                break
+            except LDAPException:
+                # Dropped by the server while idle, reconnect once
+                conn.unbind()
+                if attempt:
+                    raise
+        response = [entry for entry in conn.response or [] if entry.get("type") == "searchResEntry"]
+        self._service_pool.put(conn)
+        return response[0]["dn"] if response else None
+
+    def bind_user(self, user_dn, password) -> bool:
+        """
+        Check a password with a bind, on a kept open connection when possible
+        """
+        from ldap3.core.exceptions import LDAPBindError, LDAPException
+
+        conn = self._auth_pool.get()
+        try:
+            if conn is None or conn.closed:
+                conn = self.connect(user_dn, password)
+                self._auth_pool.put(conn)
+                return True
+            if conn.rebind(user_dn, password):
+                self._auth_pool.put(conn)
+                return True
+        except LDAPBindError:
+            pass
+        except LDAPException:
+            LOG.exception("LDAP bind failed")
+        # A failed rebind leaves the connection unbound, it is not returned to the pool
+        if conn is not None:
+            conn.unbind()
+        return False
+
+    def authenticate(
+        self,
+        username,
+        password,
+        attribute=None,
+        base_dn=None,
+        search_filter=None,
+        search_scope="SUBTREE",
+    ):
+        """
+        True if the credentials are valid, from the cache of recent logins or a bind
+        """
+        from ldap3.core.exceptions import LDAPInvalidDnError, LDAPInvalidFilterError
+        from ldap3.utils.dn import parse_dn
+
+        if not password:
+            return False
+        if self.auth_cache.check(username, password):
+            self._count("cache_hits")
+            return True
+
+        user_dn = username
+        try:
+            parse_dn(username)
+        except LDAPInvalidDnError:
+            try:
+                user_dn = self.find_user_dn(
+                    username, attribute, base_dn, search_filter, search_scope
+                )
+            except (LDAPInvalidDnError, LDAPInvalidFilterError):
+                user_dn = None
+        if user_dn is None:
+            self._count("failures")
+            return False
+
+        self._count("binds")
+        if not self.bind_user(user_dn, password):
+            self._count("failures")
+            self.auth_cache.discard(username)
+            return False
+        self.auth_cache.add(username, password)
+        return True
+
+    def metrics_lines(self) -> list:
+        lines = [
+            "# HELP coyote_ldap_logins_total LDAP authentications by result",
+            "# TYPE coyote_ldap_logins_total counter",
+        ]
+        with self._lock:
+            stats = list(self.stats.items())
+        lines += [f'coyote_ldap_logins_total{{result="{key}"}} {value}' for key, value in stats]
+        return lines
@@ -0,0 +1,148 @@
+"""
+Forked children for the CPU bound parts of large variant pages.
+
+Selecting consequences, filtering and tagging tens of thousands of
+variants is pure Python and holds the GIL, stalling the other request
+threads of the worker. With OFFLOAD_ENABLED, requests processing at least
+OFFLOAD_MIN_ROWS rows split them in slices, one per child process, up to
+OFFLOAD_WORKERS (0 for one per core) children at a time per gunicorn
+worker.
+
+The children are forked for the request, so they see its rows as they
+are in the worker, copy-on-write, and nothing is serialized on the way
+out. What comes back is what the task returns, pickled, which should be
+small: offload_stage in the SNV pipeline returns the survivors' indexes
+and the few INFO fields its stages set, not the variants. A long lived
+pool would need the rows sent to it, and encoding them costs the worker
+more than running the stages does.
+
+Tasks run the same functions as the in-process path, so results are the
+same whichever path ran them. A slice whose child cannot be started or
+dies runs in process. Children only run their task on the inherited rows,
+they touch neither clients nor locks of the worker, and exit without
+running the worker's exit handlers.
+
+Waiting for the children blocks the calling thread, which suits gthread
+workers; under gevent it blocks the worker like the in-process path.
+"""
+import gc
+import logging
+import multiprocessing
+import os
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+def _run_child(conn, task, rows) -> None:
+    # A collection would walk, and copy, every page of the worker's heap. The child is short lived
+    gc.disable()
+    conn.send(task(rows))
+    conn.close()
+
+
+class Offload:
+    """
+    Flask extension running a task on slices of rows in forked children
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.workers = 1
+        self.min_rows = 5000
+        self.tasks = 0
+        self.fallbacks = 0
+        self._active = 0
+        self._slots = threading.Condition()
+
+    def init_app(self, app) -> None:
+        app.config.setdefault("OFFLOAD_ENABLED", False)
+        app.config.setdefault("OFFLOAD_WORKERS", 0)
+        app.config.setdefault("OFFLOAD_MIN_ROWS", 5000)
+
+        self.enabled = app.config["OFFLOAD_ENABLED"]
+        self.workers = app.config["OFFLOAD_WORKERS"] or os.cpu_count() or 1
+        self.min_rows = app.config["OFFLOAD_MIN_ROWS"]
+        app.extensions["offload"] = self
+
+    def wanted(self, rows: int) -> bool:
+        """
+        True if a request processing rows rows should offload
+        """
+        return self.enabled and rows >= self.min_rows
+
+    def _acquire(self, wanted: int) -> int:
+        """
+        Take up to wanted child slots, waiting until at least one is free. All are
+        taken at once, so requests never wait on each other holding slots.
+        """
+        with self._slots:
+            while self._active >= self.workers:
+                self._slots.wait()
+            granted = min(wanted, self.workers - self._active)
+            self._active += granted
+            return granted
+
+    def _release(self, count: int) -> None:
+        with self._slots:
+            self._active -= count
+            self._slots.notify_all()
+
+    def _start(self, task, rows: list):
+        """
+        Child running task(rows) and the end of the pipe its result comes from, None if it cannot be forked
+        """
+        try:
+            mp = multiprocessing.get_context("fork")
+            reader, writer = mp.Pipe(duplex=False)
+            child = mp.Process(
+                target=_run_child, args=(writer, task, rows), name="coyote-offload", daemon=True
+            )
+            child.start()
+        except (OSError, ValueError) as ex:
+            LOG.warning("Offload child could not be started, running in process: %s", ex)
+            return None
+        writer.close()
+        return child, reader
+
+    def _result(self, started, task, rows: list):
+        if started is not None:
+            child, reader = started
+            try:
+                result = reader.recv()
+                self.tasks += 1
+                return result
+            except EOFError:
+                LOG.warning(
+                    "Offload child exited with %s, running its slice in process", child.exitcode
+                )
+            finally:
+                reader.close()
+                child.join()
+        self.fallbacks += 1
+        return task(rows)
+
+    def map_slices(self, task, rows: list) -> list:
+        """
+        (slice, task(slice)) for consecutive slices of rows, one per child
+        """
+        if not rows:
+            return []
+        granted = self._acquire(len(rows))
+        try:
+            size = -(-len(rows) // granted)
+            slices = [rows[start : start + size] for start in range(0, len(rows), size)]
+            started = [self._start(task, part) for part in slices]
+            return [(part, self._result(child, task, part)) for part, child in zip(slices, started)]
+        finally:
+            self._release(granted)
+
+    def metrics_lines(self) -> list:
+        return [
+            "# HELP coyote_offload_tasks_total Slices processed by offload children",
+            "# TYPE coyote_offload_tasks_total counter",
+            f"coyote_offload_tasks_total {self.tasks}",
+            "# HELP coyote_offload_fallbacks_total Slices processed in process after their child failed",
+            "# TYPE coyote_offload_fallbacks_total counter",
+            f"coyote_offload_fallbacks_total {self.fallbacks}",
+        ]
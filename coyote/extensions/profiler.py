@@ -0,0 +1,224 @@
+"""
+Sampling profiler for live workers.
+
+A sampler thread reads the stacks of the profiled threads with
+sys._current_frames() every PROFILER_INTERVAL seconds and counts them in
+collapsed stack format ("outer;inner;leaf count"), which flamegraph.pl,
+speedscope and inferno read directly.
+
+Admins profile a single request by adding ?_profile=1 to its url, the
+response is then the collapsed stacks instead of the page. A time window
+of the whole worker is profiled from /admin/profile, written to
+PROFILER_OUTPUT_DIR as the worker keeps serving requests.
+
+Nothing runs unless a profile is requested. At most one sampler runs per
+process, so concurrent requests cannot multiply the overhead.
+"""
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, current_app, g, request
+from flask_login import current_user
+
+LOG = logging.getLogger(__name__)
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame, max_depth: int) -> str:
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class Sampler:
+    """
+    Samples the stacks of thread_ids, or of every other thread when None, until stopped
+    """
+
+    def __init__(self, thread_ids: set = None, interval: float = 0.005, max_depth: int = 128):
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.max_depth = max_depth
+        # Threads never sampled, besides the sampler itself
+        self.exclude = set()
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="coyote-profiler", daemon=True)
+
+    def start(self) -> "Sampler":
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        return self.stacks
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or thread_id in self.exclude:
+                    continue
+                if self.thread_ids is not None and thread_id not in self.thread_ids:
+                    continue
+                stack = collapse(frame, self.max_depth)
+                if self.thread_ids is None:
+                    # Whole process, keep threads apart
+                    if thread_id not in names:
+                        names = {thread.ident: thread.name for thread in threading.enumerate()}
+                    stack = f"{names.get(thread_id, thread_id)};{stack}"
+                self.stacks[stack] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+    """
+    Flask extension for per request and time window sampling profiles
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = None
+        self.interval = 0.005
+        self.max_depth = 128
+        self.max_seconds = 300
+        self.output_dir = None
+
+    def init_app(self, app) -> None:
+        app.config.setdefault("PROFILER_ENABLED", True)
+        app.config.setdefault("PROFILER_INTERVAL", 0.005)
+        app.config.setdefault("PROFILER_MAX_DEPTH", 128)
+        app.config.setdefault("PROFILER_MAX_SECONDS", 300)
+        app.config.setdefault("PROFILER_OUTPUT_DIR", "/tmp/coyote-profiles")
+
+        self.interval = app.config["PROFILER_INTERVAL"]
+        self.max_depth = app.config["PROFILER_MAX_DEPTH"]
+        self.max_seconds = app.config["PROFILER_MAX_SECONDS"]
+        self.output_dir = app.config["PROFILER_OUTPUT_DIR"]
+        app.extensions["profiler"] = self
+
+        if app.config["PROFILER_ENABLED"]:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+
+    @property
+    def busy(self) -> bool:
+        return self._active is not None
+
+    def _acquire(self, sampler: Sampler) -> bool:
+        with self._lock:
+            if self._active is not None:
+                return False
+            self._active = sampler
+        sampler.start()
+        return True
+
+    def _release(self, sampler: Sampler) -> Counter:
+        stacks = sampler.stop()
+        with self._lock:
+            self._active = None
+        return stacks
+
+    # Per request
+
+    def _before_request(self):
+        if "_profile" not in request.args or not _user_is_admin():
+            return
+        sampler = Sampler({threading.get_ident()}, self.interval, self.max_depth)
+        if self._acquire(sampler):
+            g.coyote_profile = sampler
+        else:
+            g.coyote_profile_busy = True
+
+    def _after_request(self, response):
+        sampler = g.pop("coyote_profile", None)
+        if sampler is None:
+            if g.pop("coyote_profile_busy", False):
+                response.headers["X-Coyote-Profile"] = "busy"
+            return response
+        self._release(sampler)
+        LOG.info("Profiled %s: %d samples in %.2fs", request.path, sampler.samples, sampler.elapsed)
+        return Response(
+            sampler.collapsed(),
+            mimetype="text/plain",
+            headers={
+                "Content-Disposition": f'inline; filename="{request.endpoint}.collapsed"',
+                "X-Coyote-Profile-Samples": str(sampler.samples),
+            },
+        )
+
+    # Time window
+
+    def profile_window(self, seconds: float) -> str:
+        """
+        Sample every thread of this worker for seconds in the background.
+        Returns the file name the collapsed stacks will be written to, None if a profile is running.
+        """
+        seconds = float(seconds)
+        if not (math.isfinite(seconds) and seconds > 0):
+            raise ValueError(f"profile window of {seconds} seconds")
+        seconds = min(seconds, self.max_seconds)
+        sampler = Sampler(None, self.interval, self.max_depth)
+        if not self._acquire(sampler):
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = f"profile-{os.getpid()}-{int(time.time())}.collapsed"
+
+        def finish():
+            sampler.exclude.add(threading.get_ident())
+            try:
+                time.sleep(seconds)
+            finally:
+                # Never leave the sampler running, whatever happens to the window
+                self._release(sampler)
+            path = os.path.join(self.output_dir, name)
+            with open(path + ".tmp", "w") as fh:
+                fh.write(sampler.collapsed())
+            os.replace(path + ".tmp", path)
+            LOG.info(
+                "Wrote profile %s: %d samples in %.1fs", path, sampler.samples, sampler.elapsed
+            )
+
+        threading.Thread(target=finish, name="coyote-profiler-window", daemon=True).start()
+        return name
+
+    def profiles(self) -> list:
+        """
+        Finished window profiles, newest first, from all workers sharing PROFILER_OUTPUT_DIR
+        """
+        if not os.path.isdir(self.output_dir):
+            return []
+        names = [name for name in os.listdir(self.output_dir) if name.endswith(".collapsed")]
+        return sorted(
+            names,
+            key=lambda name: os.path.getmtime(os.path.join(self.output_dir, name)),
+            reverse=True,
+        )
+
+
+def _user_is_admin() -> bool:
+    if current_app.config.get("LOGIN_DISABLED"):
+        return True
+    is_admin = getattr(current_user, "is_admin", None)
+    return callable(is_admin) and is_admin()
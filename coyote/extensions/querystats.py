@@ -0,0 +1,495 @@
+"""
+Query shape statistics and slow query log, collected from the pymongo driver.
+
+Every command is normalized into a shape with literal values replaced by
+"?", so all variant page loads for an assay share one shape whatever the
+sample id or filter values. Count, total and max time, documents and
+(optionally) bytes returned are aggregated per shape. Commands slower than
+QUERY_SLOW_MS are kept in a ring buffer of examples; their explain plans
+are fetched on demand.
+
+With QUERY_STATS_COLLECTION set, every worker periodically adds its shape
+counters to that collection and slow examples go to the capped
+QUERY_SLOWLOG_COLLECTION, so the admin page and `flask query-stats` see
+all workers and hosts.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+import bson
+import click
+from bson import json_util
+from flask.cli import with_appcontext
+from pymongo import UpdateOne, monitoring
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+LOG = logging.getLogger(__name__)
+
+# Commands that are driver housekeeping rather than queries
+IGNORED_COMMANDS = frozenset(
+    [
+        "isMaster",
+        "ismaster",
+        "hello",
+        "ping",
+        "buildInfo",
+        "buildinfo",
+        "saslStart",
+        "saslContinue",
+        "endSessions",
+        "killCursors",
+        "getnonce",
+        "authenticate",
+        "explain",
+    ]
+)
+COLLECTION_COMMANDS = frozenset(
+    ["find", "aggregate", "count", "distinct", "update", "insert", "delete", "findAndModify"]
+)
+EXPLAINABLE_COMMANDS = frozenset(["find", "aggregate", "count", "distinct"])
+# Open cursors followed for their getMores, the oldest are forgotten beyond this
+MAX_OPEN_CURSORS = 10000
+# Operators whose array argument is a set of literals, not a list of clauses
+LITERAL_ARRAY_OPERATORS = frozenset(["$in", "$nin", "$all"])
+
+
+def awaits_data(command: dict) -> bool:
+    """
+    A tailable await cursor, as the invalidation bus tails. Its getMores wait
+    up to maxAwaitTimeMS for new documents, they are idle rather than slow.
+    """
+    return bool(command.get("tailable") and command.get("awaitData"))
+
+
+def query_shape(value):
+    """
+    Replace literal values in a query document with "?", keeping fields and operators
+    """
+    if isinstance(value, dict):
+        return {
+            key: "?" if key in LITERAL_ARRAY_OPERATORS else query_shape(val)
+            for key, val in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [query_shape(val) for val in value]
+    return "?"
+
+
+def command_shape(command_name: str, command: dict):
+    """
+    Collection and shape document for a command, None for commands not tracked
+    """
+    if command_name not in COLLECTION_COMMANDS:
+        return None
+    collection = command.get(command_name)
+    if command_name == "find":
+        shape = {"filter": query_shape(command.get("filter", {}))}
+        if command.get("sort"):
+            shape["sort"] = dict(command["sort"])
+        if command.get("projection"):
+            shape["projection"] = sorted(command["projection"])
+    elif command_name == "aggregate":
+        shape = {"pipeline": query_shape(command.get("pipeline", []))}
+    elif command_name == "count":
+        shape = {"query": query_shape(command.get("query", {}))}
+    elif command_name == "distinct":
+        shape = {"key": command.get("key"), "query": query_shape(command.get("query", {}))}
+    elif command_name == "update":
+        updates = command.get("updates") or [{}]
+        shape = {"q": query_shape(updates[0].get("q", {})), "u": sorted(updates[0].get("u", {}))}
+    elif command_name == "delete":
+        deletes = command.get("deletes") or [{}]
+        shape = {"q": query_shape(deletes[0].get("q", {}))}
+    elif command_name == "findAndModify":
+        shape = {"query": query_shape(command.get("query", {}))}
+    else:
+        shape = {}
+    return collection, shape
+
+
+def shape_key(database: str, collection: str, command_name: str, shape: dict) -> str:
+    return (
+        f"{database}.{collection} {command_name} {json.dumps(shape, sort_keys=True, default=str)}"
+    )
+
+
+class ShapeStats:
+    """
+    Aggregated counters for one query shape
+    """
+
+    FIELDS = ("count", "total_ms", "docs", "bytes")
+
+    def __init__(self, namespace: str, command: str, shape: str):
+        self.namespace = namespace
+        self.command = command
+        self.shape = shape
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.docs = 0
+        self.bytes = 0
+        # Not yet flushed to QUERY_STATS_COLLECTION
+        self.unflushed = dict.fromkeys(self.FIELDS, 0)
+        self.unflushed_max_ms = 0.0
+
+    def add(self, ms: float, docs: int, nbytes: int, calls: int = 1) -> None:
+        """
+        calls is 0 for getMore, which continues a query already counted
+        """
+        self.count += calls
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.docs += docs
+        self.bytes += nbytes
+        for field, value in zip(self.FIELDS, (calls, ms, docs, nbytes)):
+            self.unflushed[field] += value
+        self.unflushed_max_ms = max(self.unflushed_max_ms, ms)
+
+    def as_dict(self) -> dict:
+        return {
+            "namespace": self.namespace,
+            "command": self.command,
+            "shape": self.shape,
+            "count": self.count,
+            "total_ms": self.total_ms,
+            "max_ms": self.max_ms,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "docs": self.docs,
+            "bytes": self.bytes,
+        }
+
+
+class QueryStatsMonitor(monitoring.CommandListener):
+    """
+    Flask extension and pymongo CommandListener aggregating query shapes
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._cursor_shapes = {}
+        self.shapes = {}
+        self.slow = deque(maxlen=50)
+        self._unflushed_slow = []
+        self._last_flush = time.monotonic()
+        self._registered = False
+        self.enabled = False
+        self.slow_ms = 100
+        self.measure_bytes = False
+        self.stats_collection = None
+        self.slowlog_collection = None
+        self.slowlog_size = 16 * 1024 * 1024
+        self.flush_seconds = 60
+
+    def init_app(self, app) -> None:
+        app.config.setdefault("QUERY_STATS_ENABLED", True)
+        app.config.setdefault("QUERY_SLOW_MS", 100)
+        app.config.setdefault("QUERY_SLOW_EXAMPLES", 50)
+        app.config.setdefault("QUERY_STATS_BYTES", False)
+        app.config.setdefault("QUERY_STATS_COLLECTION", None)
+        app.config.setdefault("QUERY_SLOWLOG_COLLECTION", None)
+        app.config.setdefault("QUERY_SLOWLOG_SIZE", 16 * 1024 * 1024)
+        app.config.setdefault("QUERY_STATS_FLUSH_SECONDS", 60)
+
+        self.enabled = app.config["QUERY_STATS_ENABLED"]
+        self.slow_ms = app.config["QUERY_SLOW_MS"]
+        self.slow = deque(self.slow, maxlen=app.config["QUERY_SLOW_EXAMPLES"])
+        self.measure_bytes = app.config["QUERY_STATS_BYTES"]
+        self.stats_collection = app.config["QUERY_STATS_COLLECTION"]
+        self.slowlog_collection = app.config["QUERY_SLOWLOG_COLLECTION"]
+        self.slowlog_size = app.config["QUERY_SLOWLOG_SIZE"]
+        self.flush_seconds = app.config["QUERY_STATS_FLUSH_SECONDS"]
+        app.extensions["query_stats"] = self
+        app.cli.add_command(query_stats_command)
+
+        if not self.enabled:
+            return
+        if not self._registered:
+            monitoring.register(self)
+            self._registered = True
+        if self.stats_collection:
+            app.after_request(self._maybe_flush)
+
+    @property
+    def _own_collections(self) -> set:
+        return {self.stats_collection, self.slowlog_collection}
+
+    # CommandListener
+
+    def started(self, event):
+        if not self.enabled:
+            return
+        if event.command_name == "killCursors":
+            # Cursors closed before they were exhausted
+            with self._lock:
+                for cursor_id in event.command.get("cursors", []):
+                    self._cursor_shapes.pop(cursor_id, None)
+            return
+        if event.command_name in IGNORED_COMMANDS or awaits_data(event.command):
+            return
+        cursor_id = None
+        if event.command_name == "getMore":
+            cursor_id = event.command.get("getMore")
+            with self._lock:
+                tracked = self._cursor_shapes.get(cursor_id)
+            if tracked is None:
+                return
+            key, namespace, command_name, shape, command = tracked
+        else:
+            described = command_shape(event.command_name, event.command)
+            if described is None:
+                return
+            collection, shape = described
+            if collection in self._own_collections:
+                return
+            namespace = f"{event.database_name}.{collection}"
+            command_name = event.command_name
+            key = shape_key(event.database_name, collection, command_name, shape)
+            shape = json.dumps(shape, sort_keys=True, default=str)
+            command = event.command
+        with self._lock:
+            # Succeeded and failed events do not carry the command, keep the getMore's cursor id
+            self._pending[(event.connection_id, event.request_id)] = (
+                (key, namespace, command_name, shape, command),
+                cursor_id,
+            )
+
+    def succeeded(self, event):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        tracked, cursor_id = pending
+        key, namespace, command_name, shape, command = tracked
+        reply = event.reply or {}
+        docs = 0
+        cursor = reply.get("cursor")
+        if isinstance(cursor, dict):
+            batch = cursor.get("firstBatch", cursor.get("nextBatch", []))
+            docs = len(batch)
+            with self._lock:
+                if cursor.get("id"):
+                    self._cursor_shapes[cursor["id"]] = tracked
+                    if len(self._cursor_shapes) > MAX_OPEN_CURSORS:
+                        # Cursors left to time out on the server, never killed nor exhausted
+                        del self._cursor_shapes[next(iter(self._cursor_shapes))]
+                else:
+                    self._cursor_shapes.pop(cursor_id, None)
+        elif "n" in reply:
+            docs = reply["n"]
+        nbytes = len(bson.encode(reply)) if self.measure_bytes else 0
+        ms = event.duration_micros / 1000
+        self._record(
+            key, namespace, command_name, shape, ms, docs, nbytes, command, event.command_name
+        )
+
+    def failed(self, event):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+            if pending is not None:
+                self._cursor_shapes.pop(pending[1], None)
+
+    def _record(self, key, namespace, command_name, shape, ms, docs, nbytes, command, issued_as):
+        with self._lock:
+            stats = self.shapes.get(key)
+            if stats is None:
+                stats = self.shapes[key] = ShapeStats(namespace, command_name, shape)
+            stats.add(ms, docs, nbytes, calls=0 if issued_as == "getMore" else 1)
+            if ms >= self.slow_ms:
+                example = {
+                    "time": time.time(),
+                    "namespace": namespace,
+                    "command": command_name,
+                    "issued_as": issued_as,
+                    "shape": shape,
+                    "ms": ms,
+                    "docs": docs,
+                    # Extended JSON, query operators cannot be stored as keys in the slowlog
+                    "query": json_util.dumps(_clean_command(command)),
+                }
+                self.slow.append(example)
+                if self.slowlog_collection:
+                    self._unflushed_slow.append(example)
+
+    # Reporting
+
+    def worst_shapes(self, top: int = 20, sort: str = "total_ms") -> list:
+        """
+        Shape statistics, worst first. Reads the shared collection when
+        QUERY_STATS_COLLECTION is set, this process otherwise.
+        """
+        if self.stats_collection:
+            rows = list(_db()[self.stats_collection].find({}, {"_id": 0}))
+            for row in rows:
+                row["mean_ms"] = row["total_ms"] / row["count"] if row.get("count") else 0.0
+        else:
+            with self._lock:
+                rows = [stats.as_dict() for stats in self.shapes.values()]
+        return sorted(rows, key=lambda row: row.get(sort, 0), reverse=True)[:top]
+
+    def slow_examples(self, top: int = 20) -> list:
+        if self.slowlog_collection:
+            return list(
+                _db()[self.slowlog_collection].find({}, {"_id": 0}).sort("ms", -1).limit(top)
+            )
+        with self._lock:
+            examples = list(self.slow)
+        return sorted(examples, key=lambda example: example["ms"], reverse=True)[:top]
+
+    def metrics_lines(self) -> list:
+        """
+        Per collection and command totals for /metrics, shapes are too many to export as labels
+        """
+        totals = {}
+        with self._lock:
+            for stats in self.shapes.values():
+                count, total_ms = totals.get((stats.namespace, stats.command), (0, 0.0))
+                totals[(stats.namespace, stats.command)] = (
+                    count + stats.count,
+                    total_ms + stats.total_ms,
+                )
+            slow = len(self.slow)
+        lines = [
+            "# HELP coyote_mongo_commands_total Mongo commands per collection and command",
+            "# TYPE coyote_mongo_commands_total counter",
+        ]
+        lines += [
+            f'coyote_mongo_commands_total{{ns="{ns}",command="{cmd}"}} {count}'
+            for (ns, cmd), (count, _) in sorted(totals.items())
+        ]
+        lines += [
+            "# HELP coyote_mongo_command_seconds_total Time in mongo commands per collection and command",
+            "# TYPE coyote_mongo_command_seconds_total counter",
+        ]
+        lines += [
+            f'coyote_mongo_command_seconds_total{{ns="{ns}",command="{cmd}"}} {total_ms / 1000:.6f}'
+            for (ns, cmd), (_, total_ms) in sorted(totals.items())
+        ]
+        lines.append(f"coyote_mongo_slow_examples {slow}")
+        return lines
+
+    @staticmethod
+    def explain(example: dict) -> dict:
+        """
+        queryPlanner explain for a slow example, re-runs nothing for writes
+        """
+        if example["command"] not in EXPLAINABLE_COMMANDS:
+            return {"error": f"{example['command']} is not explainable"}
+        database = example["namespace"].split(".", 1)[0]
+        try:
+            return (
+                _db()
+                .client[database]
+                .command(
+                    {"explain": json_util.loads(example["query"]), "verbosity": "queryPlanner"}
+                )
+            )
+        except PyMongoError as ex:
+            return {"error": str(ex)}
+
+    # Persistence
+
+    def _maybe_flush(self, response):
+        if time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+        return response
+
+    def flush(self) -> None:
+        """
+        Add unflushed shape counters to QUERY_STATS_COLLECTION and slow examples to QUERY_SLOWLOG_COLLECTION
+        """
+        with self._lock:
+            self._last_flush = time.monotonic()
+            updates = []
+            for key, stats in self.shapes.items():
+                if not stats.unflushed["count"]:
+                    continue
+                updates.append(
+                    UpdateOne(
+                        {"_id": key},
+                        {
+                            "$inc": dict(stats.unflushed),
+                            "$max": {"max_ms": stats.unflushed_max_ms},
+                            "$set": {
+                                "namespace": stats.namespace,
+                                "command": stats.command,
+                                "shape": stats.shape,
+                            },
+                        },
+                        upsert=True,
+                    )
+                )
+                stats.unflushed = dict.fromkeys(ShapeStats.FIELDS, 0)
+                stats.unflushed_max_ms = 0.0
+            slow, self._unflushed_slow = self._unflushed_slow, []
+        try:
+            db = _db()
+            if updates:
+                db[self.stats_collection].bulk_write(updates, ordered=False)
+            if slow and self.slowlog_collection:
+                self._ensure_slowlog(db)
+                db[self.slowlog_collection].insert_many(slow, ordered=False)
+        except PyMongoError:
+            LOG.exception("Could not flush query statistics")
+
+    def _ensure_slowlog(self, db) -> None:
+        if self.slowlog_collection in db.list_collection_names():
+            return
+        try:
+            db.create_collection(self.slowlog_collection, capped=True, size=self.slowlog_size)
+        except CollectionInvalid:
+            pass
+
+
+def _clean_command(command: dict) -> dict:
+    """
+    Command without session and driver fields, usable for explain
+    """
+    return {key: val for key, val in command.items() if not key.startswith("$") and key != "lsid"}
+
+
+def _db():
+    from coyote.extensions import store
+
+    return store.coyote_db
+
+
+@click.command("query-stats")
+@click.option("--top", default=20, show_default=True, help="Number of shapes to list")
+@click.option(
+    "--sort",
+    default="total_ms",
+    show_default=True,
+    type=click.Choice(["total_ms", "max_ms", "mean_ms", "count", "docs", "bytes"]),
+)
+@click.option("--explain", is_flag=True, help="Show explain plans for the slowest examples")
+@with_appcontext
+def query_stats_command(top, sort, explain):
+    """
+    List the worst mongo query shapes recorded in QUERY_STATS_COLLECTION
+    """
+    from flask import current_app
+
+    monitor = current_app.extensions["query_stats"]
+    if not monitor.stats_collection:
+        raise click.ClickException(
+            "QUERY_STATS_COLLECTION is not set, statistics are per process only."
+        )
+
+    click.echo(f"{'count':>8} {'total ms':>12} {'mean ms':>10} {'max ms':>10} {'docs':>10}  shape")
+    for row in monitor.worst_shapes(top=top, sort=sort):
+        click.echo(
+            f"{row['count']:>8} {row['total_ms']:>12.1f} {row['mean_ms']:>10.1f} "
+            f"{row['max_ms']:>10.1f} {row['docs']:>10}  {row['namespace']} {row['command']} {row['shape']}"
+        )
+
+    if explain:
+        for example in monitor.slow_examples(top=5):
+            click.echo(f"\n{example['ms']:.1f} ms {example['namespace']} {example['shape']}")
+            plan = monitor.explain(example)
+            winning = plan.get("queryPlanner", {}).get("winningPlan", plan)
+            click.echo(json.dumps(winning, indent=2, default=str))
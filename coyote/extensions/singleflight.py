@@ -0,0 +1,132 @@
+"""
+Request coalescing for expensive pages.
+
+single_flight.do(key, compute) runs compute once for concurrent callers
+with the same key: the first becomes the leader, the others wait up to
+SINGLE_FLIGHT_TIMEOUT seconds for its result, then compute on their own.
+The result is shared between the callers, it must not be modified. When
+the leader raises, the callers waiting on it raise the same exception and
+the next call computes again.
+
+With SINGLE_FLIGHT_SHARED the workers of a node coalesce too, through
+the disk tier of the cache: the leader claims the key in sqlite and
+stores its result in the "single_flight" namespace for a few seconds
+(CACHE_TTLS), the other workers poll for it instead of computing.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from coyote.extensions.cache import MISSING
+
+NAMESPACE = "single_flight"
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = MISSING
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Flask extension coalescing identical concurrent computations
+    """
+
+    def __init__(self):
+        self.cache = None
+        self.enabled = True
+        self.shared = False
+        self.timeout = 60.0
+        self.poll_seconds = 0.05
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+
+    def init_app(self, app, cache) -> None:
+        app.config.setdefault("SINGLE_FLIGHT_ENABLED", True)
+        app.config.setdefault("SINGLE_FLIGHT_SHARED", False)
+        app.config.setdefault("SINGLE_FLIGHT_TIMEOUT", 60.0)
+
+        self.cache = cache
+        self.enabled = app.config["SINGLE_FLIGHT_ENABLED"]
+        self.shared = app.config["SINGLE_FLIGHT_SHARED"]
+        self.timeout = app.config["SINGLE_FLIGHT_TIMEOUT"]
+        app.extensions["single_flight"] = self
+
+    def do(self, key: str, compute):
+        if not self.enabled:
+            return compute()
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            if flight.done.wait(self.timeout):
+                if flight.error is not None:
+                    self._count("follower")
+                    raise flight.error
+                if flight.result is not MISSING:
+                    self._count("follower")
+                    return flight.result
+            # The leader is too slow or was interrupted
+            self._count("timeout")
+            return compute()
+
+        try:
+            flight.result = self._lead(key, compute)
+            return flight.result
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _lead(self, key: str, compute):
+        if not (self.shared and self.cache.enabled(NAMESPACE)):
+            self._count("leader")
+            return compute()
+
+        result = self.cache.get(NAMESPACE, key)
+        if result is not MISSING:
+            self._count("shared")
+            return result
+        if not self.cache.claim(NAMESPACE, key, self.timeout):
+            # Another worker computes it
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.poll_seconds)
+                result = self.cache.get(NAMESPACE, key)
+                if result is not MISSING:
+                    self._count("shared")
+                    return result
+            self._count("timeout")
+            return compute()
+
+        self._count("leader")
+        try:
+            result = compute()
+            self.cache.set(NAMESPACE, key, result)
+            return result
+        finally:
+            self.cache.release(NAMESPACE, key)
+
+    def _count(self, role: str) -> None:
+        with self._lock:
+            self._counts[role] += 1
+
+    def metrics_lines(self) -> list:
+        with self._lock:
+            counts = sorted(self._counts.items())
+        lines = [
+            "# HELP coyote_single_flight_total Coalesced computations by role: leader computed, "
+            "follower or shared reused a result, timeout computed after waiting",
+            "# TYPE coyote_single_flight_total counter",
+        ]
+        lines += [f'coyote_single_flight_total{{role="{role}"}} {count}' for role, count in counts]
+        return lines
@@ -0,0 +1,160 @@
+"""
+Warm-up stage and health endpoints.
+
+WarmUp.run() checks that mongo answers, that the collections have the
+indexes the handlers rely on (WARMUP_EXPECTED_INDEXES) and loads the
+reference data (canonical transcripts, panels, groups) into the cache the
+store then serves them from. It runs at the end of init_app, so with gunicorn
+--preload it runs once in the master and the workers share the loaded
+data. Templates are compiled before it, in init_templates.
+
+/healthz answers as long as the process serves requests. /readyz answers
+503 until a warm-up has succeeded and retries a failed one at most every
+WARMUP_RETRY_SECONDS, so a worker started while mongo was down becomes
+ready on its own. Missing indexes are reported but do not block readiness.
+"""
+import os
+import threading
+import time
+
+from flask import jsonify
+
+MONGO_STEPS = ("canonical", "panels", "groups")
+
+
+def missing_indexes(collection, expected: list) -> list:
+    """
+    Expected key field lists not covered by the prefix of any index on the collection
+    """
+    prefixes = [
+        [field for field, _ in index["key"]] for index in collection.index_information().values()
+    ]
+    return [
+        fields
+        for fields in expected
+        if not any(prefix[: len(fields)] == fields for prefix in prefixes)
+    ]
+
+
+class WarmUp:
+    """
+    Flask extension warming the store and answering /healthz and /readyz
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.store = None
+        self.logger = None
+        self.expected_indexes = {}
+        self.retry_seconds = 30
+        self.started = time.time()
+        self.ready = False
+        self.last_attempt = None
+        self.steps = {}
+        self.missing = {}
+        self.error = None
+
+    def init_app(self, app, store) -> None:
+        app.config.setdefault("WARMUP_ON_START", True)
+        app.config.setdefault("WARMUP_RETRY_SECONDS", 30)
+        app.config.setdefault("WARMUP_EXPECTED_INDEXES", {})
+
+        self.store = store
+        self.logger = app.logger
+        self.started = time.time()
+        self.expected_indexes = app.config["WARMUP_EXPECTED_INDEXES"]
+        self.retry_seconds = app.config["WARMUP_RETRY_SECONDS"]
+        app.extensions["warmup"] = self
+
+        app.add_url_rule("/healthz", "healthz", self.healthz)
+        app.add_url_rule("/readyz", "readyz", self.readyz)
+
+    def run(self) -> bool:
+        """
+        Run every warm-up step, returns True when the app is ready. Nothing is raised, failures are logged.
+        """
+        if not self._lock.acquire(blocking=False):
+            # Already warming in another thread
+            return self.ready
+        try:
+            self.last_attempt = time.monotonic()
+            start = time.perf_counter()
+            self.steps = {}
+            self.error = None
+            try:
+                self._step("mongo", self._ping)
+                self._step("indexes", self._check_indexes)
+                for name in MONGO_STEPS:
+                    self._step(name, getattr(self.store, f"load_{name}"))
+            except Exception as ex:
+                self.error = f"{type(ex).__name__}: {ex}"
+                self.logger.error(
+                    f"Warm-up failed after {time.perf_counter() - start:.2f}s: {self.error}"
+                )
+                self.ready = False
+                return False
+            self.ready = True
+            self.logger.info(f"Warm-up finished in {time.perf_counter() - start:.2f}s")
+            return True
+        finally:
+            self._lock.release()
+
+    def _step(self, name: str, func) -> None:
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        self.steps[name] = {"seconds": round(elapsed, 4), "result": result}
+        self.logger.info(f"Warm-up {name}: {result} in {elapsed:.3f}s")
+
+    def _ping(self) -> str:
+        self.store.coyote_db.command("ping")
+        return "ok"
+
+    def _check_indexes(self) -> str:
+        db = self.store.coyote_db
+        self.missing = {}
+        for collection, expected in self.expected_indexes.items():
+            missing = missing_indexes(db[collection], expected)
+            if missing:
+                self.missing[collection] = missing
+                self.logger.warning(f"Collection {collection} has no index on {missing}")
+        checked = sum(len(expected) for expected in self.expected_indexes.values())
+        return f"{checked - sum(len(m) for m in self.missing.values())}/{checked} present"
+
+    def healthz(self):
+        return jsonify(status="ok", pid=os.getpid(), uptime=round(time.time() - self.started, 1))
+
+    def readyz(self):
+        retry_due = (
+            self.last_attempt is None or time.monotonic() - self.last_attempt >= self.retry_seconds
+        )
+        if not self.ready and retry_due:
+            self.run()
+        if self.ready:
+            status = "ready"
+        elif self._lock.locked() or self.last_attempt is None:
+            status = "warming"
+        else:
+            status = "failed"
+        body = {
+            "status": status,
+            "steps": self.steps,
+            "missing_indexes": self.missing,
+        }
+        if self.error:
+            body["error"] = self.error
+        return jsonify(body), 200 if self.ready else 503
+
+    def metrics_lines(self) -> list:
+        lines = [
+            "# HELP coyote_ready Whether the warm-up of this worker has succeeded",
+            "# TYPE coyote_ready gauge",
+            f"coyote_ready {int(self.ready)}",
+            "# HELP coyote_warmup_seconds Duration of the last warm-up by step",
+            "# TYPE coyote_warmup_seconds gauge",
+        ]
+        lines += [
+            f'coyote_warmup_seconds{{step="{name}"}} {step["seconds"]}'
+            for name, step in self.steps.items()
+        ]
+        return lines
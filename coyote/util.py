@@ -1,4 +1,5 @@
 import os
+import stat
 from copy import deepcopy
 
 from flask import current_app as app
@@ -122,3 +123,36 @@ def get_active_branch_name():
         for line in content:
             if line[0:4] == "ref:":
                 return line.partition("refs/heads/")[2]
+
+
+def private_directory(path: str) -> str:
+    """
+    Create path if missing and check that only this user can use it, for
+    caches whose files are loaded as code (pickle, marshal). Raises
+    PermissionError when another user owns it or may write to it, e.g.
+    when someone else created it first in /tmp.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"{path} is not a directory")
+    if info.st_uid != os.getuid():
+        raise PermissionError(f"{path} is owned by uid {info.st_uid}, not this user")
+    if info.st_mode & 0o077:
+        raise PermissionError(
+            f"{path} is open to other users (mode {stat.S_IMODE(info.st_mode):o}), expected 700"
+        )
+    return path
+
+
+def check_private_file(path: str) -> None:
+    """
+    Raise PermissionError if the existing file path is not a regular file of
+    this user or others may write to it
+    """
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o022:
+        raise PermissionError(f"{path} is not a file only this user can write to")
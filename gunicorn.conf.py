@@ -0,0 +1,43 @@
+"""
+gunicorn settings, used by the Dockerfile: gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is loaded once in the master (preload_app) and forked into the
+workers: config, compiled templates and imported modules are shared
+copy-on-write. gc.freeze() moves everything allocated so far out of the
+collector's reach, so collections in the workers do not write to (and
+copy) the shared pages. Mongo and LDAP connections are created lazily in
+each worker after the fork.
+
+Variant pages mostly wait on mongo, so each worker serves several
+requests at once: GUNICORN_WORKER_CLASS gthread (the default) with
+GUNICORN_THREADS threads, or gevent (pip install gevent) with up to
+GUNICORN_WORKER_CONNECTIONS greenlets. Keep workers * threads within the
+mongo pool, MONGO_CLIENT_OPTIONS maxPoolSize is per worker. The sampling
+profiler samples OS threads, ?_profile=1 finds nothing to sample under gevent.
+"""
+import gc
+import os
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+
+if worker_class == "gevent":
+    # Before the app is imported by the preloading master, or its locks and sockets stay blocking
+    from gevent import monkey
+
+    monkey.patch_all()
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+loglevel = os.getenv("CDM_LOG_LEVEL", "info").lower()
+
+
+def when_ready(server):
+    if preload_app:
+        gc.collect()
+        gc.freeze()
+        server.log.info(
+            "Preloaded app, %d objects frozen before forking workers", gc.get_freeze_count()
+        )
@@ -0,0 +1,375 @@
+#!/usr/bin/python
+"""
+Load the variants of samples into variants_idref and add the samples.
+
+    python scripts/load_variants.py --group myeloid_GMSv1 [--subpanel lung]
+                                    [--uri mongodb://localhost:27017] [--db coyote]
+                                    [--jobs 4] [--batch-size 1000] [--format vcf|jsonl]
+                                    [NAME=]PATH [[NAME=]PATH ...]
+
+PATH is a VEP annotated VCF or a JSON lines file of variant documents,
+either gzipped or not. The sample is named NAME, or after the file. Up to
+--jobs samples load in parallel, each in its own process and connection.
+
+VCF records become documents in the shape the variant views read:
+CHROM (a number where it is one, without "chr"), POS, REF, ALT, QUAL,
+FILTER as a list, GT with type/sample/GT/AF/DP/VD per sample column (the
+first column is the case, a second the control, unless --case names the
+case column) and INFO with CSQ as a list of dicts of the VEP fields,
+Consequence a list and population frequencies numbers. Multi-allelic
+records are skipped, split them first with bcftools norm -m-. JSON lines
+hold the documents themselves, any _id and SAMPLE_ID are replaced.
+
+Variants are written with unordered bulk writes of --batch-size
+documents. The samples document comes last, in one upsert that creates
+it only if the name is still free, so the app never lists a partly
+loaded sample and two loaders do not add the same name. A sample whose
+name is taken is not loaded, and the variants of a sample that fails are
+removed again. Inputs naming the same sample twice are rejected before
+anything loads. When the app's cache invalidation collection exists, the
+new sample's cached lookups are invalidated on every node. Throughput is
+reported in variants per second, per sample and in total.
+"""
+import argparse
+import gzip
+import os
+import re
+import socket
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from multiprocessing import Pool
+
+from bson import ObjectId, json_util
+from pymongo import InsertOne, MongoClient
+from pymongo.errors import PyMongoError
+
+DEFAULT_URI = f"mongodb://{os.getenv('FLASK_MONGO_HOST') or 'localhost'}:{os.getenv('FLASK_MONGO_PORT') or 27017}"
+# Collection the app's cache invalidation bus tails, see coyote/extensions/invalidation.py
+INVALIDATION_COLLECTION = "cache_events"
+# Fields every variant document needs for the views
+REQUIRED_FIELDS = ("CHROM", "POS", "REF", "ALT", "GT", "INFO")
+# CSQ fields compared as numbers by the popfreq filter and the templates
+NUMERIC_CSQ_FIELDS = frozenset(["gnomAD_AF", "gnomADg_AF", "ExAC_MAF", "GMAF", "MAX_AF"])
+# INFO fields holding lists, the VCF separates values by commas, some callers by |
+LIST_INFO_FIELDS = frozenset(["variant_callers"])
+CSQ_FORMAT = re.compile(r'ID=CSQ,.*Format: ([^"]+)"')
+SAMPLE_SUFFIXES = (".gz", ".vcf", ".jsonl", ".json", ".ndjson")
+
+_client = None
+
+
+def number(value: str):
+    """
+    value as an int or a float where it is one, else as it is
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def csq_value(field: str, value: str):
+    if field == "Consequence":
+        return value.split("&")
+    if field in NUMERIC_CSQ_FIELDS:
+        # Several known variants are joined by &, keep the first frequency
+        first = value.split("&")[0]
+        return number(first) if first else ""
+    return value
+
+
+def parse_info(info: str, csq_fields: list) -> dict:
+    parsed = {}
+    if info == ".":
+        return parsed
+    for item in info.split(";"):
+        key, sep, value = item.partition("=")
+        if not sep:
+            parsed[key] = True
+        elif key == "CSQ":
+            parsed["CSQ"] = [
+                {field: csq_value(field, val) for field, val in zip(csq_fields, entry.split("|"))}
+                for entry in value.split(",")
+            ]
+        elif key in LIST_INFO_FIELDS:
+            parsed[key] = re.split(r"[,|]", value)
+        elif "," in value:
+            parsed[key] = [number(val) for val in value.split(",")]
+        else:
+            parsed[key] = number(value)
+    return parsed
+
+
+def parse_gt(fmt: list, values: str, sample: str, gt_type: str) -> dict:
+    call = dict(zip(fmt, values.split(":")))
+    gt = {"type": gt_type, "sample": sample, "GT": call.get("GT", ".")}
+    if call.get("AF", ".") != ".":
+        gt["AF"] = float(call["AF"].split(",")[0])
+    if call.get("DP", ".") != ".":
+        gt["DP"] = int(call["DP"])
+    if call.get("VD", ".") != ".":
+        gt["VD"] = int(call["VD"])
+    elif call.get("AD", ".") != "." and "," in call["AD"]:
+        gt["VD"] = int(call["AD"].split(",")[1])
+    return gt
+
+
+def read_vcf(fh, case: str = None, stats: dict = None):
+    """
+    Variant documents, without SAMPLE_ID, of a VEP annotated VCF
+    """
+    csq_fields, calls, n_fields = [], [], 8
+    for line_no, line in enumerate(fh, start=1):
+        if line.startswith("##"):
+            match = CSQ_FORMAT.search(line)
+            if match:
+                csq_fields = match.group(1).split("|")
+            continue
+        if line.startswith("#"):
+            columns = line.rstrip("\n").split("\t")[9:]
+            if case is not None and case not in columns:
+                raise ValueError(
+                    f"no sample column {case} in the VCF, columns are {', '.join(columns)}"
+                )
+            # (column index, name, type), the case first and then the control
+            case_index = columns.index(case) if case is not None else 0
+            order = [case_index] + [index for index in range(len(columns)) if index != case_index]
+            calls = [
+                (index, columns[index], gt_type)
+                for index, gt_type in zip(order, ("case", "control"))
+            ]
+            n_fields = 10 + max(index for index, _, _ in calls) if calls else 8
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) < n_fields:
+            raise ValueError(f"line {line_no} has {len(fields)} columns, expected {n_fields}")
+        if "," in fields[4]:
+            stats["multiallelic"] = stats.get("multiallelic", 0) + 1
+            continue
+        chrom = fields[0][3:] if fields[0].startswith("chr") else fields[0]
+        fmt = fields[8].split(":") if len(fields) > 8 else []
+        yield {
+            "CHROM": number(chrom),
+            "POS": int(fields[1]),
+            "REF": fields[3],
+            "ALT": fields[4],
+            "QUAL": None if fields[5] == "." else float(fields[5]),
+            "FILTER": ["PASS"] if fields[6] in ("PASS", ".") else fields[6].split(";"),
+            "GT": [
+                parse_gt(fmt, fields[9 + index], name, gt_type) for index, name, gt_type in calls
+            ],
+            "INFO": parse_info(fields[7], csq_fields),
+        }
+
+
+def read_jsonl(fh, case: str = None, stats: dict = None):
+    """
+    Variant documents of a JSON lines file, checked for the fields the views need
+    """
+    for line_no, line in enumerate(fh, start=1):
+        if not line.strip():
+            continue
+        doc = json_util.loads(line)
+        missing = [field for field in REQUIRED_FIELDS if field not in doc]
+        if missing:
+            raise ValueError(f"line {line_no} lacks {', '.join(missing)}")
+        doc.pop("_id", None)
+        yield doc
+
+
+READERS = {"vcf": read_vcf, "jsonl": read_jsonl}
+
+
+def file_format(path: str) -> str:
+    name = path[:-3] if path.endswith(".gz") else path
+    return "vcf" if name.endswith(".vcf") else "jsonl"
+
+
+def sample_name(path: str) -> str:
+    name = os.path.basename(path)
+    while name.endswith(SAMPLE_SUFFIXES):
+        name = os.path.splitext(name)[0]
+    return name
+
+
+def open_text(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def init_worker(uri: str) -> None:
+    # One client per process, clients do not survive a fork
+    global _client
+    _client = MongoClient(uri)
+
+
+def load_sample(job: dict) -> dict:
+    """
+    Write the variants of one sample in batches, then its samples document.
+    The outcome, counts and seconds, as a dict.
+    """
+    db = _client[job["db"]]
+    name = job["name"]
+    result = {
+        "name": name,
+        "path": job["path"],
+        "variants": 0,
+        "batches": 0,
+        "seconds": 0.0,
+        "error": None,
+    }
+    sample_id = ObjectId()
+    start = time.perf_counter()
+    stats = {}
+    try:
+        if db.samples.find_one({"name": name}, {"_id": 1}):
+            raise ValueError("a sample of this name exists")
+        with open_text(job["path"]) as fh:
+            batch = []
+            for doc in READERS[job["format"]](fh, job["case"], stats):
+                doc["SAMPLE_ID"] = str(sample_id)
+                batch.append(InsertOne(doc))
+                if len(batch) >= job["batch_size"]:
+                    db.variants_idref.bulk_write(batch, ordered=False)
+                    result["variants"] += len(batch)
+                    result["batches"] += 1
+                    batch = []
+            if batch:
+                db.variants_idref.bulk_write(batch, ordered=False)
+                result["variants"] += len(batch)
+                result["batches"] += 1
+        sample = {
+            "_id": sample_id,
+            "name": name,
+            "groups": job["groups"],
+            "time_added": datetime.utcnow(),
+            "vcf_files": [os.path.abspath(job["path"])],
+        }
+        if job["subpanel"]:
+            sample["subpanel"] = job["subpanel"]
+        # Created only if still missing, another loader may have taken the name meanwhile
+        if (
+            db.samples.update_one({"name": name}, {"$setOnInsert": sample}, upsert=True).upserted_id
+            is None
+        ):
+            raise ValueError("a sample of this name was added during the load")
+    except Exception as ex:
+        # Anything wrong with one file fails only its own sample, not the whole run
+        result["error"] = (
+            str(ex)
+            if isinstance(ex, (OSError, ValueError, PyMongoError))
+            else f"{type(ex).__name__}: {ex}"
+        )
+        try:
+            db.variants_idref.delete_many({"SAMPLE_ID": str(sample_id)})
+        except PyMongoError:
+            result["error"] += f" (variants of SAMPLE_ID {sample_id} left behind)"
+        return result
+    finally:
+        result["seconds"] = time.perf_counter() - start
+        result["multiallelic"] = stats.get("multiallelic", 0)
+
+    publish_invalidation(db, name)
+    return result
+
+
+def publish_invalidation(db, name: str) -> None:
+    """
+    Drop a cached miss of the new sample's name on every node running the invalidation bus
+    """
+    try:
+        if INVALIDATION_COLLECTION in db.list_collection_names():
+            db[INVALIDATION_COLLECTION].insert_one(
+                {
+                    "namespace": "samples",
+                    "key": name,
+                    "origin": f"{socket.gethostname()}:load_variants",
+                    "at": time.time(),
+                }
+            )
+    except PyMongoError as ex:
+        print(f"{name}: could not publish the cache invalidation: {ex}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "inputs", nargs="+", metavar="[NAME=]PATH", help="VCF or JSON lines files, one per sample"
+    )
+    parser.add_argument(
+        "--group", action="append", required=True, help="group of the samples, repeat for several"
+    )
+    parser.add_argument("--subpanel", help="subpanel of the samples")
+    parser.add_argument("--case", help="VCF sample column of the case, default the first")
+    parser.add_argument(
+        "--format", choices=sorted(READERS), help="input format, default from the file name"
+    )
+    parser.add_argument("--uri", default=DEFAULT_URI)
+    parser.add_argument("--db", default="coyote")
+    parser.add_argument(
+        "--jobs", type=int, default=min(4, os.cpu_count() or 1), help="samples loaded in parallel"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000, help="variants per bulk write")
+    args = parser.parse_args()
+
+    jobs = []
+    for spec in args.inputs:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            name, path = sample_name(spec), spec
+        jobs.append(
+            {
+                "name": name,
+                "path": path,
+                "format": args.format or file_format(path),
+                "case": args.case,
+                "groups": args.group,
+                "subpanel": args.subpanel,
+                "db": args.db,
+                "batch_size": args.batch_size,
+            }
+        )
+
+    duplicates = sorted(
+        name for name, count in Counter(job["name"] for job in jobs).items() if count > 1
+    )
+    if duplicates:
+        parser.error(f"more than one input for sample {', '.join(duplicates)}")
+
+    start = time.perf_counter()
+    loaded, failed = 0, 0
+    with Pool(min(args.jobs, len(jobs)), initializer=init_worker, initargs=(args.uri,)) as pool:
+        for result in pool.imap_unordered(load_sample, jobs):
+            if result["error"]:
+                failed += 1
+                print(f"{result['name']}: not loaded, {result['error']}", file=sys.stderr)
+                continue
+            loaded += result["variants"]
+            rate = result["variants"] / result["seconds"] if result["seconds"] else 0.0
+            skipped = (
+                f", {result['multiallelic']} multi-allelic records skipped"
+                if result["multiallelic"]
+                else ""
+            )
+            print(
+                f"{result['name']}: {result['variants']} variants in {result['batches']} batches, "
+                f"{result['seconds']:.1f}s, {rate:.0f} variants/s{skipped}"
+            )
+    wall = time.perf_counter() - start
+    print(
+        f"{len(jobs) - failed} of {len(jobs)} samples, {loaded} variants in {wall:.1f}s, "
+        f"{loaded / wall if wall else 0.0:.0f} variants/s"
+    )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+from pathlib import Path
+
+# config reads it on import, the app tests use the benchmark groups
+os.environ.setdefault(
+    "FLASK_GROUPS_CONFIG",
+    str(Path(__file__).resolve().parent.parent / "benchmarks" / "config" / "groups.toml"),
+)
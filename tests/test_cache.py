@@ -0,0 +1,105 @@
+"""
+Memory and disk tiers of the handler cache, and the private cache directory check
+"""
+import os
+
+import pytest
+from flask import Flask
+
+from coyote.extensions.cache import MISSING, Cache, MemoryTier
+from coyote.util import private_directory
+
+
+def make_cache(directory=None, **config) -> Cache:
+    app = Flask(__name__)
+    app.config.update(CACHE_DIR=directory, CACHE_SYNC_SECONDS=0, **config)
+    cache = Cache()
+    cache.init_app(app)
+    return cache
+
+
+def test_memory_tier_evicts_least_recently_used():
+    memory = MemoryTier(2)
+    memory.set("users", "a", 1, 60)
+    memory.set("users", "b", 2, 60)
+    assert memory.get("users", "a") == 1
+    assert memory.set("groups", "c", 3, 60) == ["users"]
+    assert memory.get("users", "b") is MISSING
+    assert memory.get("users", "a") == 1
+    assert memory.get("groups", "c") == 3
+
+
+def test_memory_tier_expires_entries():
+    memory = MemoryTier(2)
+    memory.set("users", "a", 1, 0)
+    assert memory.get("users", "a") is MISSING
+    assert len(memory) == 0
+
+
+def test_memory_miss_falls_back_to_disk_tier(tmp_path):
+    writer = make_cache(str(tmp_path / "cache"))
+    reader = make_cache(str(tmp_path / "cache"))
+    writer.set("users", "u1", {"name": "u1"})
+    assert reader.get("users", "u1") == {"name": "u1"}
+    # Now in the reader's memory tier too
+    reader.disk = None
+    assert reader.get("users", "u1") == {"name": "u1"}
+
+
+def test_invalidation_reaches_other_processes_memory(tmp_path):
+    writer = make_cache(str(tmp_path / "cache"))
+    reader = make_cache(str(tmp_path / "cache"))
+    writer.set("users", "u1", 1)
+    assert reader.get("users", "u1") == 1
+    writer.invalidate("users", "u1")
+    assert reader.get("users", "u1") is MISSING
+
+
+def test_disabled_namespace_is_not_cached():
+    cache = make_cache(CACHE_TTLS={"users": 0})
+    cache.set("users", "u1", 1)
+    assert cache.get("users", "u1") is MISSING
+    assert cache.get_or_set("users", "u1", lambda: 2) == 2
+
+
+def test_private_directory_is_created_for_this_user_only(tmp_path):
+    path = str(tmp_path / "cache")
+    assert private_directory(path) == path
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    # Existing and still private
+    private_directory(path)
+
+
+def test_private_directory_rejects_shared_directories(tmp_path):
+    path = tmp_path / "cache"
+    path.mkdir(mode=0o700)
+    path.chmod(0o777)
+    with pytest.raises(PermissionError):
+        private_directory(str(path))
+
+
+def test_private_directory_rejects_symlinks(tmp_path):
+    target = tmp_path / "elsewhere"
+    target.mkdir(mode=0o700)
+    (tmp_path / "cache").symlink_to(target)
+    with pytest.raises(PermissionError):
+        private_directory(str(tmp_path / "cache"))
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="needs root to chown")
+def test_private_directory_rejects_other_owners(tmp_path):
+    path = tmp_path / "cache"
+    path.mkdir(mode=0o700)
+    os.chown(path, os.getuid() + 1000, -1)
+    with pytest.raises(PermissionError):
+        private_directory(str(path))
+
+
+def test_cache_without_private_directory_is_memory_only(tmp_path):
+    path = tmp_path / "cache"
+    path.mkdir(mode=0o700)
+    path.chmod(0o777)
+    cache = make_cache(str(path))
+    assert cache.disk is None
+    cache.set("users", "u1", 1)
+    assert cache.get("users", "u1") == 1
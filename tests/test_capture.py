@@ -0,0 +1,83 @@
+"""
+Workload capture from synthetic pymongo command events
+"""
+import datetime
+
+from flask import Flask, g
+from pymongo.monitoring import CommandFailedEvent, CommandStartedEvent, CommandSucceededEvent
+
+from coyote.extensions.capture import WorkloadCapture
+
+CONNECTION = ("localhost", 27017)
+
+
+def run(capture, request_id: int, command: dict, reply: dict) -> None:
+    capture.started(CommandStartedEvent(command, "coyote", request_id, CONNECTION, request_id))
+    capture.succeeded(
+        CommandSucceededEvent(
+            datetime.timedelta(milliseconds=2),
+            reply,
+            next(iter(command)),
+            request_id,
+            CONNECTION,
+            request_id,
+        )
+    )
+
+
+def test_cursor_commands_are_captured_and_released():
+    capture = WorkloadCapture()
+    with Flask(__name__).test_request_context():
+        g.coyote_capture = (0.0, [])
+        run(
+            capture,
+            1,
+            {"find": "samples", "filter": {"name": "S1"}},
+            {"ok": 1, "cursor": {"id": 0, "firstBatch": [{}]}},
+        )
+        run(
+            capture,
+            2,
+            {"find": "variants_idref", "filter": {}},
+            {"ok": 1, "cursor": {"id": 42, "firstBatch": [{}, {}]}},
+        )
+        run(
+            capture,
+            3,
+            {"getMore": 42, "collection": "variants_idref"},
+            {"ok": 1, "cursor": {"id": 0, "nextBatch": [{}]}},
+        )
+        run(
+            capture,
+            4,
+            {"find": "variants_idref", "filter": {}},
+            {"ok": 1, "cursor": {"id": 7, "firstBatch": [{}]}},
+        )
+        run(
+            capture,
+            5,
+            {"find": "variants_idref", "filter": {}},
+            {"ok": 1, "cursor": {"id": 8, "firstBatch": [{}]}},
+        )
+        commands = g.coyote_capture[1]
+    # Cursors are killed outside requests too
+    run(capture, 6, {"killCursors": "variants_idref", "cursors": [7]}, {"ok": 1})
+    assert [command.docs for command in commands] == [1, 3, 1, 1]
+    assert all(command.bytes > 0 for command in commands)
+    assert capture.commands == 5
+    assert list(capture._cursors) == [8]
+
+    with Flask(__name__).test_request_context():
+        g.coyote_capture = (0.0, [])
+        capture.started(
+            CommandStartedEvent(
+                {"getMore": 8, "collection": "variants_idref"}, "coyote", 7, CONNECTION, 7
+            )
+        )
+        capture.failed(
+            CommandFailedEvent(
+                datetime.timedelta(milliseconds=1), {"ok": 0}, "getMore", 7, CONNECTION, 7
+            )
+        )
+    assert capture._cursors == {}
+    assert capture._pending == {}
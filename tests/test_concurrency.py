@@ -0,0 +1,94 @@
+"""
+Concurrent variant page requests against mongomock
+"""
+import copy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mongomock
+import pytest
+
+from benchmarks.common import bench_app
+from benchmarks.synthetic import make_case
+
+ASSAYS = ["myeloid", "solid", "gmsonco", "tumwgs"]
+N_VARIANTS = 60
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = bench_app()
+    from coyote.extensions import store
+
+    store._setup_dbs(mongomock.MongoClient())
+    db = store.coyote_db
+    for seed, assay in enumerate(ASSAYS, start=1):
+        for collection, docs in make_case(assay, N_VARIANTS, seed=seed, name=f"test_{assay}"):
+            docs = list(docs)
+            if collection == "panels":
+                # Same lists for every case
+                db.panels.delete_many({})
+            if docs:
+                db[collection].insert_many(docs)
+    return app
+
+
+def fetch(app, name: str) -> tuple:
+    with app.test_client() as client:
+        resp = client.get(f"/sample/{name}")
+    return resp.status_code, resp.get_data(as_text=True)
+
+
+def test_concurrent_requests_match_serial_ones(app):
+    names = [f"test_{assay}" for assay in ASSAYS]
+    group_filters = copy.deepcopy(app.config["GROUP_FILTERS"])
+    expected = {name: fetch(app, name) for name in names}
+    assert all(status == 200 for status, _ in expected.values())
+
+    plan = names * 10
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(lambda name: fetch(app, name), plan))
+
+    assert [expected[name] for name in plan] == responses
+    assert app.config["GROUP_FILTERS"] == group_filters
+
+
+def test_identical_requests_are_computed_once(app, monkeypatch):
+    from coyote.blueprints.variants import views
+    from coyote.extensions import single_flight
+
+    n_requests = 6
+    arrived = []
+    computed = []
+    do = single_flight.do
+    assemble = views.assemble_variants_context
+
+    def counting_do(key, compute):
+        arrived.append(key)
+        return do(key, compute)
+
+    def slow_assemble(*args, **kwargs):
+        computed.append(args[0]["name"])
+        # Hold the flight open until every request waits on it
+        deadline = time.monotonic() + 5
+        while len(arrived) < n_requests and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        return assemble(*args, **kwargs)
+
+    monkeypatch.setattr(single_flight, "do", counting_do)
+    monkeypatch.setattr(views, "assemble_variants_context", slow_assemble)
+    monkeypatch.setattr(single_flight, "_counts", type(single_flight._counts)(int))
+    start = threading.Barrier(n_requests)
+
+    def request(_):
+        start.wait()
+        return fetch(app, "test_myeloid")
+
+    with ThreadPoolExecutor(max_workers=n_requests) as pool:
+        responses = list(pool.map(request, range(n_requests)))
+
+    assert computed == ["test_myeloid"]
+    assert len(set(responses)) == 1 and responses[0][0] == 200
+    assert dict(single_flight._counts) == {"leader": 1, "follower": n_requests - 1}
@@ -0,0 +1,125 @@
+"""
+Query shape statistics from synthetic pymongo command events
+"""
+import datetime
+
+from pymongo.monitoring import CommandFailedEvent, CommandStartedEvent, CommandSucceededEvent
+
+from coyote.extensions.querystats import QueryStatsMonitor
+
+CONNECTION = ("localhost", 27017)
+
+
+def monitor() -> QueryStatsMonitor:
+    stats = QueryStatsMonitor()
+    stats.enabled = True
+    return stats
+
+
+def run(stats, request_id: int, command: dict, reply: dict) -> None:
+    stats.started(CommandStartedEvent(command, "coyote", request_id, CONNECTION, request_id))
+    stats.succeeded(
+        CommandSucceededEvent(
+            datetime.timedelta(milliseconds=2),
+            reply,
+            next(iter(command)),
+            request_id,
+            CONNECTION,
+            request_id,
+        )
+    )
+
+
+def test_single_batch_find_is_recorded():
+    stats = monitor()
+    run(
+        stats,
+        1,
+        {"find": "samples", "filter": {"name": "S1"}},
+        {"ok": 1, "cursor": {"id": 0, "firstBatch": [{}]}},
+    )
+    (shape,) = stats.shapes.values()
+    assert shape.as_dict()["count"] == 1
+    assert shape.as_dict()["docs"] == 1
+
+
+def test_get_mores_count_with_their_find_and_release_the_cursor():
+    stats = monitor()
+    run(
+        stats,
+        1,
+        {"find": "variants_idref", "filter": {"SAMPLE_ID": "x"}},
+        {"ok": 1, "cursor": {"id": 42, "firstBatch": [{}, {}]}},
+    )
+    assert 42 in stats._cursor_shapes
+    run(
+        stats,
+        2,
+        {"getMore": 42, "collection": "variants_idref"},
+        {"ok": 1, "cursor": {"id": 0, "nextBatch": [{}]}},
+    )
+    (shape,) = stats.shapes.values()
+    assert shape.as_dict()["count"] == 1
+    assert shape.as_dict()["docs"] == 3
+    assert stats._cursor_shapes == {}
+
+
+def test_killed_and_failed_cursors_are_released():
+    stats = monitor()
+    run(
+        stats,
+        1,
+        {"find": "variants_idref", "filter": {}},
+        {"ok": 1, "cursor": {"id": 7, "firstBatch": [{}]}},
+    )
+    run(
+        stats,
+        2,
+        {"find": "variants_idref", "filter": {}},
+        {"ok": 1, "cursor": {"id": 8, "firstBatch": [{}]}},
+    )
+    run(
+        stats, 3, {"killCursors": "variants_idref", "cursors": [7]}, {"ok": 1, "cursorsKilled": [7]}
+    )
+    assert list(stats._cursor_shapes) == [8]
+    stats.started(
+        CommandStartedEvent(
+            {"getMore": 8, "collection": "variants_idref"}, "coyote", 4, CONNECTION, 4
+        )
+    )
+    stats.failed(
+        CommandFailedEvent(
+            datetime.timedelta(milliseconds=1), {"ok": 0}, "getMore", 4, CONNECTION, 4
+        )
+    )
+    assert stats._cursor_shapes == {}
+    assert stats._pending == {}
+
+
+def test_awaited_tailable_cursors_are_not_recorded():
+    stats = monitor()
+    stats.slow_ms = 100
+    tail = {"find": "cache_events", "filter": {}, "tailable": True, "awaitData": True}
+    run(stats, 1, tail, {"ok": 1, "cursor": {"id": 9, "firstBatch": []}})
+    stats.started(
+        CommandStartedEvent(
+            {"getMore": 9, "collection": "cache_events", "maxTimeMS": 1000},
+            "coyote",
+            2,
+            CONNECTION,
+            2,
+        )
+    )
+    stats.succeeded(
+        CommandSucceededEvent(
+            datetime.timedelta(seconds=1),
+            {"ok": 1, "cursor": {"id": 9, "nextBatch": []}},
+            "getMore",
+            2,
+            CONNECTION,
+            2,
+        )
+    )
+    assert stats.shapes == {}
+    assert list(stats.slow) == []
+    assert stats._cursor_shapes == {}
@@ -0,0 +1,105 @@
+"""
+Single flight leaders and followers in threads
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from coyote.extensions.singleflight import SingleFlight
+
+KEY = "sample:S1"
+N_FOLLOWERS = 4
+
+
+class WaitCountingEvent(threading.Event):
+    def __init__(self):
+        super().__init__()
+        self.waiting = 0
+        self._count_lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        with self._count_lock:
+            self.waiting += 1
+        return super().wait(timeout)
+
+
+def run_flight(flights: SingleFlight, leader_compute, follower_compute) -> tuple:
+    """
+    Start a leader blocked in leader_compute, then N_FOLLOWERS callers once
+    it computes. The leader finishes when all of them wait on it.
+    Returns the futures of the leader and the followers.
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def lead():
+        started.set()
+        release.wait(5)
+        return leader_compute()
+
+    pool = ThreadPoolExecutor(max_workers=N_FOLLOWERS + 1)
+    leader = pool.submit(flights.do, KEY, lead)
+    assert started.wait(5)
+    done = flights._flights[KEY].done = WaitCountingEvent()
+    followers = [pool.submit(flights.do, KEY, follower_compute) for _ in range(N_FOLLOWERS)]
+    deadline = time.monotonic() + 5
+    while done.waiting < N_FOLLOWERS and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    pool.shutdown(wait=True)
+    return leader, followers
+
+
+def never():
+    raise AssertionError("followers must not compute")
+
+
+def test_followers_share_the_leaders_result():
+    flights = SingleFlight()
+    result = {"variants": [1, 2, 3]}
+    leader, followers = run_flight(flights, lambda: result, never)
+    assert leader.result() is result
+    assert all(follower.result() is result for follower in followers)
+    assert dict(flights._counts) == {"leader": 1, "follower": N_FOLLOWERS}
+    assert flights._flights == {}
+
+
+def test_leaders_exception_reaches_followers_and_clears_the_key():
+    flights = SingleFlight()
+
+    def fail():
+        raise ValueError("mongo went away")
+
+    leader, followers = run_flight(flights, fail, never)
+    for future in [leader] + followers:
+        with pytest.raises(ValueError, match="mongo went away"):
+            future.result()
+    assert flights._flights == {}
+    # Not remembered, the next caller computes again
+    assert flights.do(KEY, lambda: "ok") == "ok"
+
+
+def test_followers_compute_after_the_timeout():
+    flights = SingleFlight()
+    flights.timeout = 0.01
+    release = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flights.do, KEY, lambda: release.wait(5) and "leader")
+        while KEY not in flights._flights:
+            time.sleep(0.01)
+        assert flights.do(KEY, lambda: "own") == "own"
+        release.set()
+        assert leader.result() == "leader"
+    assert flights._counts["timeout"] == 1
+
+
+def test_disabled_computes_every_call():
+    flights = SingleFlight()
+    flights.enabled = False
+    calls = []
+    for _ in range(3):
+        flights.do(KEY, lambda: calls.append(1))
+    assert len(calls) == 3
+    assert flights._flights == {}